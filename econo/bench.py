@@ -0,0 +1,186 @@
+"""
+econo.bench -- benchmarks of the simulation hot paths across economy sizes
+
+For every size, benchmark() generates a synthetic economy (see econo.generate)
+in a fresh worker process and times parsing, pricing, op choice, stepping and
+saving. Because each size runs in its own process, the peak resident memory
+it reports belongs to that size alone.
+
+save_golden() records the trajectory of the reference configuration, its
+market deltas, trade counts and career populations step by step, on a
+generated economy into a golden file. check_golden() verifies a
+configuration against such a file: it regenerates the same economy, runs it
+with the same seed and compares its trajectory with the recorded one, so a
+change that alters the reference configuration itself is caught as well.
+Configurations that store or schedule units differently break balance ties
+(such as between newborns, who all start at zero) in a different order, so
+both run with name_ties (see econo.order), in which every configuration
+visits tied units in order of name.
+
+With totals, a trajectory also records the total balance and total profit of
+every career. Configurations add these up in different orders, so
+same_record() compares them to within TOLERANCE.
+"""
+import logging; logger = logging.getLogger(__name__)
+from copy import deepcopy
+from multiprocessing import Pool
+from timeit import default_timer as clock
+import random
+import resource
+from yaml import safe_load as load_yaml, safe_dump as save_yaml
+
+from .generate import generate_description
+from .market import parse_market, save_market, price_op
+from .unit import (parse_careers, parse_units, save_careers, save_units,
+        choose_op)
+from .simulation import parse_simulation
+
+# Relative and absolute tolerance of the balance and profit totals
+TOLERANCE = 1e-6
+
+def timed(func, *args, **kwargs):
+    """
+    Call a function and return its result and the elapsed time in seconds
+    """
+    start = clock()
+    result = func(*args, **kwargs)
+    return result, clock() - start
+
+def bench_size(task):
+    """
+    Benchmark one economy size. The task is a tuple of (size, steps,
+    generator options, simulation options).
+    """
+    size, steps, generate_options, options = task
+    description = generate_description(units=size, **generate_options)
+    result = dict(units=size)
+
+    # Parsing
+    config = deepcopy(description)
+    market, result['parse_market'] = timed(parse_market, config['market'])
+    careers, result['parse_careers'] = timed(parse_careers, config['careers'],
+                                             market)
+    units, result['parse_units'] = timed(parse_units, config['units'],
+                                         careers)
+
+    # Pricing and op choice, per call
+    ops = careers[sorted(careers.keys())[0]]['ops']
+    calls = 1000
+    start = clock()
+    for i in xrange(calls):
+        for op in ops:
+            price_op(market, op, 0.05, 100.0)
+    result['price_op'] = (clock() - start) / (calls * len(ops))
+    start = clock()
+    for i in xrange(calls):
+        choose_op(market, ops, 0.05, 100.0, -500.0, 1000)
+    result['choose_op'] = (clock() - start) / calls
+
+    # Saving
+    _, result['save_market'] = timed(save_market, market)
+    _, result['save_careers'] = timed(save_careers, careers)
+    _, result['save_units'] = timed(save_units, units)
+
+    # Stepping
+    random.seed(0)
+    sim = parse_simulation(deepcopy(description), **options)
+    start = clock()
+    for i in xrange(steps):
+        sim.step()
+    elapsed = clock() - start
+    result['steps_per_sec'] = steps / elapsed if elapsed else float('inf')
+    result['peak_rss_mb'] = (resource.getrusage(resource.RUSAGE_SELF)
+                             .ru_maxrss / 1024.0)
+    return result
+
+def benchmark(sizes, steps=10, generate_options=None, **options):
+    """
+    Benchmark each economy size in its own worker process. Other keyword
+    arguments are passed on to parse_simulation.
+    """
+    tasks = [(size, steps, generate_options or {}, options) for size in sizes]
+    pool = Pool(processes=1, maxtasksperchild=1)
+    try:
+        return pool.map(bench_size, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def trajectory(description, steps, seed, options, totals=False):
+    """
+    Record the per-step market deltas, trade counts and career populations
+    of a simulation, followed with totals by the career total balances and
+    total profits
+    """
+    random.seed(seed)
+    sim = parse_simulation(deepcopy(description), **options)
+    records = []
+    for i in xrange(steps):
+        t = sim.step()
+        record = [t]
+        for name in sorted(sim.market.keys()):
+            rec = sim.market[name]
+            record.extend((rec['delta'], rec['bought'], rec['sold']))
+        careers = sorted(sim.careers.keys())
+        for career in careers:
+            record.append(sim.careers[career]['stats']['population'])
+        if totals:
+            for career in careers:
+                stats = sim.careers[career]['stats']
+                record.extend((float(stats['total_balance']),
+                               float(stats['total_profit'])))
+        records.append(record)
+    return records
+
+def same_record(expected, actual):
+    """
+    Compare two trajectory records: integers exactly, floats to within
+    TOLERANCE
+    """
+    if len(expected) != len(actual):
+        return False
+    for a, b in zip(expected, actual):
+        if isinstance(a, float) or isinstance(b, float):
+            if abs(a - b) > TOLERANCE * max(1.0, abs(a), abs(b)):
+                return False
+        elif a != b:
+            return False
+    return True
+
+def save_golden(path, generate_options, steps=100, seed=0):
+    """
+    Record the trajectory of the reference configuration on an economy
+    generated with a dictionary of generate_description options into a
+    golden file
+    """
+    description = generate_description(**generate_options)
+    golden = dict(generate=generate_options, steps=steps, seed=seed,
+                  trajectory=trajectory(description, steps, seed,
+                                        dict(name_ties=True)))
+    with open(path, 'w') as out:
+        save_yaml(golden, out, default_flow_style=None)
+
+def load_golden(path):
+    """
+    Read a golden file written by save_golden
+    """
+    with open(path) as golden_file:
+        golden = load_yaml(golden_file)
+    if not isinstance(golden, dict) or 'trajectory' not in golden:
+        raise ValueError('%s is not a golden trajectory file' % path)
+    return golden
+
+def check_golden(path, **options):
+    """
+    Compare the trajectory of a configuration with the one recorded in a
+    golden file. Returns None if they match, otherwise the first step at
+    which they differ.
+    """
+    golden = load_golden(path)
+    description = generate_description(**golden['generate'])
+    candidate = trajectory(description, golden['steps'], golden['seed'],
+                           dict(options, name_ties=True))
+    for expected, actual in zip(golden['trajectory'], candidate):
+        if expected != actual:
+            return expected[0]
+    return None
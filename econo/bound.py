@@ -0,0 +1,134 @@
+"""
+econo.bound -- branch-and-bound op selection for wide op catalogs
+
+choose_op prices every op of a career before it compares their profit rates,
+although with hundreds of ops most of them cannot come close to the best. An
+op's costs, and the interest on any loan taken to pay them, are never
+negative, so its profit rate is at most
+
+    earnings / op.time
+
+where earnings are the sale value of its products, summed in the same order
+as quote_op sums them, so that the bound and the priced profit rate round
+alike. OpBounds caches the bid of every quantity of a resource that some op
+sells until the resource moves, so bounding an op costs a lookup per product.
+Ops that would take longer than the unit has left are dropped before they are
+bounded. A choice prices the remaining ops in order of decreasing bound and
+stops at the first op whose bound cannot beat the best op found so far. The
+op chosen is exactly the one the exhaustive search chooses, including the
+choice of the first of several ops with the same profit rate.
+
+The bound relies on prices that cannot be negative, so OpBounds falls back to
+the exhaustive search in markets with an exponential resource whose initial
+price or rate is negative, and for negative interest rates.
+"""
+import logging; logger = logging.getLogger(__name__)
+from collections import defaultdict
+
+from .market import bid_at, price_op
+
+class OpBounds(object):
+    """
+    Cached product bids and branch-and-bound choice of the best op. As in
+    QuoteCache, a resource's delta serves as its version counter: refresh()
+    drops the cached bids of every resource that moved. issued counts the
+    bids computed rather than reused.
+    """
+    def __init__(self):
+        self.seen = {}
+        self.bids = {}
+        self.counts = defaultdict(set)
+        self.safe = {}
+        self.issued = 0
+
+    def nonnegative(self, market):
+        """
+        Check, once per market, that no resource can have a negative price
+        """
+        key = id(market)
+        if key not in self.safe:
+            self.safe[key] = all(rec['type'] == 'linear' or
+                                 (rec['initial'] >= 0.0 and rec['rate'] > 0.0)
+                                 for rec in market.itervalues())
+        return self.safe[key]
+
+    def refresh(self, market):
+        """
+        Invalidate the bids of resources changed since the last refresh
+        """
+        for resource, rec in market.iteritems():
+            delta = rec['delta']
+            if self.seen.get(resource) != delta:
+                self.seen[resource] = delta
+                counts = self.counts[resource]
+                for count in counts:
+                    self.bids.pop((resource, count))
+                counts.clear()
+
+    def bid(self, market, resource, count):
+        """
+        Compute and cache the sale value of a quantity of a resource
+        """
+        self.counts[resource].add(count)
+        self.issued += 1
+        bid = self.bids[resource, count] = bid_at(market, resource, qty=count)
+        return bid
+
+    def choose(self, market, ops, rate, balance, min_balance, max_time,
+            noop_profit, price=price_op):
+        """
+        Equivalent to the exhaustive search of econo.unit.choose_op, starting
+        from the no-op profit and pricing ops with the given price function.
+        Also returns the number of ops priced and the number of resource price
+        quotes that pricing them with price_op requests; the bids of the
+        bounds are counted by issued.
+        """
+        # Bound the ops the unit has time for, and sort them by bound
+        exhaustive = rate < 0.0 or not self.nonnegative(market)
+        if not exhaustive:
+            self.refresh(market)
+        bids = self.bids
+        entries = []
+        for i, op in enumerate(ops):
+            if op.time > max_time:
+                continue
+            if exhaustive:
+                entries.append((0.0, i, op))
+                continue
+            earnings = 0.0
+            for product in op.products.iteritems():
+                if product in bids:
+                    earnings += bids[product]
+                else:
+                    earnings += self.bid(market, *product)
+            entries.append((-earnings / op.time, i, op))
+        if not exhaustive:
+            entries.sort()
+
+        # Price the ops in order of decreasing bound, as long as they can
+        # beat the best op so far or tie with it and come before it
+        best_op = None
+        best_index = None
+        best_rate = noop_profit
+        best_profit = noop_profit
+        priced = 0
+        quotes = 0
+        for neg_bound, i, op in entries:
+            if not exhaustive and (-neg_bound < best_rate or
+                                   (-neg_bound == best_rate and
+                                    (best_op is None or i > best_index))):
+                break
+            priced += 1
+            quotes += len(op.costs) + len(op.products)
+            profit_rate, profit, low_balance = price(market, op, rate, balance)
+            if low_balance < min_balance and low_balance < balance:
+                continue
+            elif profit_rate > best_rate or (profit_rate == best_rate and
+                                             best_op is not None and
+                                             i < best_index):
+                best_op = op
+                best_index = i
+                best_rate = profit_rate
+                best_profit = profit
+
+        return (best_op, best_profit, best_rate, priced, quotes)
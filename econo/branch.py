@@ -0,0 +1,128 @@
+"""
+econo.branch -- what-if branches forked from a running simulation
+
+A sweep parses its description again for every run and steps every run from
+the start. To compare variants of an economy from a common, warmed-up state,
+branch() instead forks the process that holds the simulation once per
+branch: the child starts with a copy-on-write image of the simulation, so
+branching costs neither serialization nor a warm-up, and only the pages a
+branch writes to are ever copied. Every branch applies its own parameter
+overrides, named as in econo.sweep, seeds the random number generator,
+steps to completion and sends its summary back to the parent through a
+pipe, as a sweep run does. Up to jobs branches run at a time.
+
+Branching relies on os.fork, so it is only available on POSIX systems, and
+the simulation must not hold worker processes, which a fork would share
+between the branches.
+"""
+import logging; logger = logging.getLogger(__name__)
+import cPickle as pickle
+from copy import deepcopy
+from multiprocessing import cpu_count
+import os
+import random
+
+from .market import parse_market
+from .simulation import parse_system
+from .sweep import apply_overrides, merge_replicates, run_summary
+
+def override_simulation(sim, overrides):
+    """
+    Set the system and market parameters of a simulation named by a list of
+    (name, value) pairs, as apply_overrides does for descriptions. The
+    changes are validated before the simulation is changed in place. The
+    time step t cannot be set, as the simulation keeps its own.
+    """
+    for name, value in overrides:
+        if name == 't':
+            raise ValueError('parameter %r cannot be set in a running '
+                             'simulation' % name)
+    description = dict(system=deepcopy(sim.system),
+                       market=deepcopy(sim.market))
+    apply_overrides(description, overrides)
+    parse_system(description['system'])
+    parse_market(description['market'])
+    sim.system.update(description['system'])
+    for resource, rec in description['market'].iteritems():
+        sim.market[resource].update(rec)
+    sim.refresh()
+
+def fork_branch(sim, overrides, seed, steps):
+    """
+    Fork a child that runs one branch and writes its summary, or the
+    exception it raised, to a pipe. Returns the child's pid and the read end
+    of the pipe.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(write_fd)
+        return pid, read_fd
+
+    # In the child: run the branch and exit without returning to the caller
+    os.close(read_fd)
+    status = 0
+    try:
+        sim.sinks = []
+        override_simulation(sim, overrides)
+        random.seed(seed)
+        result = run_summary(sim, steps)
+    except Exception as exc:
+        result = exc
+        status = 1
+    try:
+        with os.fdopen(write_fd, 'wb') as out:
+            pickle.dump(result, out, pickle.HIGHEST_PROTOCOL)
+    finally:
+        os._exit(status)
+
+def collect_branch(pid, read_fd):
+    """
+    Read the result of a branch and wait for its process to exit
+    """
+    with os.fdopen(read_fd, 'rb') as result_file:
+        data = result_file.read()
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError('branch process %d exited without a result' % pid)
+    result = pickle.loads(data)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def branch(sim, scenarios, replicates=1, steps=1000, seed=0, jobs=None):
+    """
+    Run every scenario, a list of (name, value) override pairs, the given
+    number of times from the current state of a simulation, in forked
+    processes. Returns one row per scenario, as econo.sweep.sweep does. The
+    simulation itself is left as it was.
+    """
+    if sim.clearing is not None and sim.clearing.workers:
+        raise ValueError('cannot branch a simulation with clearing workers')
+    if jobs is None:
+        jobs = cpu_count()
+    for overrides in scenarios:
+        apply_overrides(dict(system=deepcopy(sim.system),
+                             market=deepcopy(sim.market)), overrides)
+    sim.sync()
+    tasks = [(overrides, seed + i * replicates + r)
+             for i, overrides in enumerate(scenarios)
+             for r in xrange(replicates)]
+    logger.info('t=%06d: branching %d scenarios x %d replicates', sim.t,
+                len(scenarios), replicates)
+
+    # Keep up to jobs branches running, collecting them in order
+    running = []
+    summaries = []
+    try:
+        for overrides, branch_seed in tasks:
+            if len(running) >= max(jobs, 1):
+                summaries.append(collect_branch(*running.pop(0)))
+            running.append(fork_branch(sim, overrides, branch_seed, steps))
+        while running:
+            summaries.append(collect_branch(*running.pop(0)))
+    finally:
+        for pid, read_fd in running:
+            os.close(read_fd)
+            os.waitpid(pid, 0)
+    return merge_replicates(scenarios, summaries, replicates)
@@ -0,0 +1,125 @@
+"""
+econo.cache -- on-disk cache of parsed scenarios
+
+Every run from the same description files repeats the same YAML parsing and
+validation of the market, careers and units before its first step. A scenario
+cache keeps the result of that work: the parsed system, market, careers
+(including their Op objects and, with compile_ops, their OpTables), units and
+unit id table, pickled into one file per scenario. Later runs from identical
+inputs unpickle that file instead of reading any YAML.
+
+A scenario is identified by the SHA-1 of the econo version, the cache format,
+the options that shape the parsed state (unit_store and compile_ops) and the
+contents of every description file, in order. Changing any input file
+therefore simply misses the cache; stale entries are never read, only left
+behind.
+
+Unpickling rebuilds the units dictionary with its own iteration order, and
+step_time breaks balance ties in that order. A run that misses the cache
+therefore also starts from the state read back from the new entry, so that
+every cached run of a scenario follows the same trajectory, although ties may
+be broken in a different order than in an uncached run.
+"""
+import logging; logger = logging.getLogger(__name__)
+import cPickle as pickle
+import hashlib
+import os
+
+from . import VERSION
+from .loader import load_simulation
+from .unit import parse_unit_ids, save_unit_ids
+from .simulation import Simulation
+
+CACHE_FORMAT = 1
+
+def scenario_key(description_files, unit_store='dict', compile_ops=False):
+    """
+    Hash the contents of the description files, and the options that shape
+    the parsed scenario, into a cache key. The files are rewound afterwards.
+    """
+    digest = hashlib.sha1()
+    digest.update('econo %s scenario cache %d\n' % (VERSION, CACHE_FORMAT))
+    digest.update('unit_store=%s compile_ops=%d\n'
+                  % (unit_store, bool(compile_ops)))
+    for desc_file in description_files:
+        file_digest = hashlib.sha1()
+        for chunk in iter(lambda: desc_file.read(1 << 20), ''):
+            file_digest.update(chunk)
+        try:
+            desc_file.seek(0)
+        except IOError:
+            raise ValueError('the scenario cache cannot reread %r'
+                             % getattr(desc_file, 'name', desc_file))
+        digest.update(file_digest.hexdigest() + '\n')
+    return digest.hexdigest()
+
+def save_scenario(path, sim):
+    """
+    Write the state of a freshly parsed Simulation to a cache file, replacing
+    it atomically
+    """
+    state = dict(format=CACHE_FORMAT, system=sim.system, market=sim.market,
+                 careers=sim.careers, units=sim.units,
+                 next_unit_ids=save_unit_ids())
+
+    # Write to a temporary file first so that a concurrent run never reads a
+    # torn cache entry
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as out:
+        pickle.dump(state, out, protocol=2)
+    os.rename(tmp_path, path)
+    logger.debug('scenario cached in %s', path)
+
+def load_scenario(path, **options):
+    """
+    Read a cache file back into a Simulation. Other keyword arguments are
+    passed on to Simulation.
+    """
+    with open(path, 'rb') as cached:
+        state = pickle.load(cached)
+    if state.get('format') != CACHE_FORMAT:
+        raise ValueError('unsupported scenario cache format %r'
+                         % state.get('format'))
+    parse_unit_ids(state['next_unit_ids'])
+    return Simulation(state['system'], state['market'], state['careers'],
+                      state['units'], **options)
+
+def load_cached_simulation(description_files, cache_dir, unit_store='dict',
+        compile_ops=False, **options):
+    """
+    Load the Simulation described by the description files from the scenario
+    cache in cache_dir, or, on a miss, through load_simulation, caching the
+    result. Other keyword arguments are passed on to Simulation.
+    """
+    key = scenario_key(description_files, unit_store=unit_store,
+                       compile_ops=compile_ops)
+    path = os.path.join(cache_dir, key + '.pickle')
+
+    # Start from the cached scenario when there is one
+    if os.path.exists(path):
+        for desc_file in description_files:
+            desc_file.close()
+        try:
+            sim = load_scenario(path, **options)
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError) as exc:
+            logger.warn('ignoring scenario cache %s: %s', path, exc)
+        else:
+            logger.info('scenario loaded from cache %s', path)
+            return sim
+        description_files = [open(desc_file.name, 'r')
+                             for desc_file in description_files]
+
+    # Otherwise parse the files, cache the result and start from the cached
+    # state, as later runs will. The other options do not shape the parsed
+    # state, and only apply to the Simulation that is run.
+    parsed = load_simulation(description_files, unit_store=unit_store,
+                             compile_ops=compile_ops)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        save_scenario(path, parsed)
+    except (IOError, OSError) as exc:
+        logger.warn('could not cache scenario in %s: %s', path, exc)
+        return Simulation(parsed.system, parsed.market, parsed.careers,
+                          parsed.units, **options)
+    return load_scenario(path, **options)
@@ -0,0 +1,149 @@
+"""
+econo.checkpoint -- compact binary snapshots of a running simulation
+
+A checkpoint is a NumPy .npz archive. The units are stored as columns:
+
+    names: (string array) unit names
+    career: (int32 array) index into the sorted career names
+    age, busy, eat_phase, spawn_phase: (int64 arrays)
+    balance: (float64 array)
+
+and everything else (system, market, careers and the next unit ids), which is
+small, is pickled into the 'header' array. A checkpoint describes the state at
+the start of the time step stored as system.t, so resuming from it continues
+with exactly that step. Unlike the description written by econo run, which
+stores the last step it simulated as t, a checkpoint is only ever read back to
+continue the run.
+
+The header also keeps the state of the random number generator, which
+load_checkpoint restores, so that a resumed run draws the same careers and
+phases for its newborns as the uninterrupted run would have. Checkpoints
+written without it leave the generator as it is.
+"""
+import logging; logger = logging.getLogger(__name__)
+import os
+import cPickle as pickle
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .market import parse_market
+from .unit import parse_careers, parse_unit_ids, save_careers, save_unit_ids
+from .store import UnitStore
+from .simulation import Simulation, parse_system
+
+CHECKPOINT_FORMAT = 1
+UNIT_COLUMNS = [('career', 'int32'), ('age', 'int64'), ('busy', 'int64'),
+                ('balance', 'float64'), ('eat_phase', 'int64'),
+                ('spawn_phase', 'int64')]
+
+def unit_columns(units, career_names):
+    """
+    Convert a units dictionary into checkpoint columns
+    """
+    career_index = {career: i for i, career in enumerate(career_names)}
+    names = sorted(units.keys())
+    columns = dict(names=numpy.array(names, dtype='S'))
+    for column, dtype in UNIT_COLUMNS:
+        if column == 'career':
+            values = [career_index[units[name]['career']] for name in names]
+        else:
+            values = [units[name][column] for name in names]
+        columns[column] = numpy.array(values, dtype=dtype)
+    return columns
+
+def column_units(columns, career_names):
+    """
+    Convert checkpoint columns into a units dictionary
+    """
+    names = columns['names'].tolist()
+    values = [columns[column].tolist() for column, dtype in UNIT_COLUMNS]
+    units = {}
+    for i, name in enumerate(names):
+        u_rec = units[name] = dict(name=name)
+        for (column, dtype), column_values in zip(UNIT_COLUMNS, values):
+            u_rec[column] = column_values[i]
+        u_rec['career'] = career_names[u_rec['career']]
+    return units
+
+def save_checkpoint(path, sim):
+    """
+    Write a Simulation to a checkpoint file, replacing it atomically
+    """
+    if numpy is None:
+        raise ImportError('checkpoints require numpy')
+    sim.sync()
+    system = dict(sim.system, t=sim.t)
+    career_names = sorted(sim.careers.keys())
+    header = dict(format=CHECKPOINT_FORMAT, system=system, market=sim.market,
+                  careers=save_careers(sim.careers),
+                  next_unit_ids=save_unit_ids(), career_names=career_names,
+                  random_state=random.getstate())
+    if isinstance(sim.units, UnitStore):
+        columns = sim.units.columns()
+        columns['names'] = columns['names'].astype('S')
+    else:
+        columns = unit_columns(sim.units, career_names)
+    write_checkpoint(path, header, columns)
+    logger.debug('t=%06d: checkpoint written to %s', sim.t, path)
+
+def write_checkpoint(path, header, columns):
+    """
+    Write a checkpoint header and unit columns to a file, replacing it
+    atomically
+    """
+    columns = dict(columns)
+    columns['header'] = numpy.frombuffer(pickle.dumps(header, protocol=2),
+                                         dtype='uint8')
+
+    # Write to a temporary file first, and get it onto the disk before it
+    # replaces the checkpoint, so a crash never leaves a torn checkpoint
+    # behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        numpy.savez(out, **columns)
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(tmp_path, path)
+
+def read_checkpoint(path):
+    """
+    Read the header and the unit columns of a checkpoint file
+    """
+    if numpy is None:
+        raise ImportError('checkpoints require numpy')
+    archive = numpy.load(path)
+    try:
+        header = pickle.loads(archive['header'].tostring())
+        if header.get('format') != CHECKPOINT_FORMAT:
+            raise ValueError('unsupported checkpoint format %r'
+                             % header.get('format'))
+        columns = dict((column, archive[column]) for column in
+                       ['names'] + [column for column, _ in UNIT_COLUMNS])
+    finally:
+        archive.close()
+    return header, columns
+
+def load_checkpoint(path, unit_store='dict', compile_ops=False, **options):
+    """
+    Read a checkpoint file back into a Simulation, and restore the state of
+    the random number generator saved with it. Other keyword arguments are
+    passed on to Simulation.
+    """
+    header, columns = read_checkpoint(path)
+    system = parse_system(header['system'])
+    market = parse_market(header['market'])
+    careers = parse_careers(header['careers'], market, compiled=compile_ops)
+    if sorted(careers.keys()) != header['career_names']:
+        raise ValueError('checkpoint careers do not match its units')
+    if unit_store == 'array':
+        units = UnitStore.from_columns(careers, columns)
+    else:
+        units = column_units(columns, header['career_names'])
+    parse_unit_ids(header['next_unit_ids'])
+    if 'random_state' in header:
+        random.setstate(header['random_state'])
+    return Simulation(system, market, careers, units, **options)
@@ -0,0 +1,350 @@
+"""
+econo.clearing -- batch market clearing over shards of a unit population
+
+In the other step functions every unit trades with the market as soon as it
+has decided, so each unit sees the trades of the units before it and the
+units must be visited one at a time. With batch clearing, every unit instead
+decides against a snapshot of the market as of the start of the step:
+
+    eat: a unit due to eat pays the snapshot price of food, or starves if
+        that would take it below the minimum balance
+    spawn: a unit due to spawn then pays the snapshot price of a babykit, if
+        it can afford it, and has a child
+    choose: an idle unit chooses its op against the snapshot prices (see
+        OpTable.choose_batch)
+
+and the trades of all units are cleared at once at the end of the step: the
+delta of every resource moves by its net purchases, and its bought and sold
+counts by the units bought and sold. The same rules as step_time apply
+otherwise, including the statistics and the careers of newborns.
+
+Deciding against a snapshot, units that would compete for the same resource
+all take the same best op, and with many units the market swings from one
+extreme to the other at every step, until exponential prices overflow. With
+several clearing rounds per step, the units take turns: every round steps the
+units whose round key is the round number, modulo the number of rounds,
+against the market as cleared by the rounds before it. The round key of a unit
+is
+
+    spawn_phase * eat_every + eat_phase + t
+
+so that units are dealt evenly into up to eat_every * spawn_every rounds, in
+an order that rotates from one step to the next. More rounds bring the
+trajectory closer to that of the sequential step functions, at the cost of a
+pass over the units per round.
+
+No unit sees the trades of another in its round, so the units can be visited
+in any order and split into shards that are stepped independently. A Clearing
+keeps one shard in each of its worker processes, which receive the market
+snapshot every step and round and send back their trades, the career totals of
+their units and the names of the parents of their newborns. The main process
+names the newborns and draws their phases in order of parent name, so the
+trajectory does not depend on the number of shards, up to the rounding of the
+summed career totals. With a single job the whole store is stepped in the main
+process.
+"""
+import logging; logger = logging.getLogger(__name__)
+from collections import defaultdict
+from multiprocessing import Pipe, Process
+from random import randint
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .market import ask_at
+from .unit import new_name, reset_stats, finish_stats
+from .store import UnitStore
+
+def split_rounds(t, store, rounds, eat_every=100):
+    """
+    Deal the slots of the units of a UnitStore into a list of arrays of slots,
+    one per clearing round
+    """
+    live = store.live_slots()
+    if rounds == 1:
+        return [live]
+    keys = (store.spawn_phase[live] * eat_every + store.eat_phase[live] + t)
+    keys %= rounds
+    order = numpy.argsort(keys, kind='mergesort')
+    bounds = numpy.searchsorted(keys[order], numpy.arange(rounds + 1))
+    live = live[order]
+    return [live[start:stop]
+            for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+def clear_shard(t, market, careers, store, live, rate, min_balance=-100,
+        max_age=1000, eat_every=100, spawn_every=200, changes=False):
+    """
+    Step the units of a UnitStore in the given slots against a market
+    snapshot, without trading with it. Returns the trades of the units and
+    their career totals and, with changes, the states of the units whose
+    balance changed or that started an op and the names of the units removed.
+    """
+    age = store.age[live]
+    busy = store.busy[live]
+    balance = store.balance[live]
+    start_balance = balance
+    career = store.career[live]
+    bought = defaultdict(int)
+    sold = defaultdict(int)
+
+    # Eat at the snapshot price of food, or starve
+    due_eat = (age % eat_every) == store.eat_phase[live]
+    food = ask_at(market, 'food')
+    starved = due_eat & ((balance - food) < min_balance)
+    eats = due_eat & ~starved
+    balance = numpy.where(eats, balance - food, balance)
+    bought['food'] += int(eats.sum())
+
+    # Spawn at the snapshot price of babykits, if able
+    due_spawn = (age % spawn_every) == store.spawn_phase[live]
+    babykit = ask_at(market, 'babykits')
+    spawns = due_spawn & ~((balance - babykit) < min_balance)
+    balance = numpy.where(spawns, balance - babykit, balance)
+    bought['babykits'] += int(spawns.sum())
+
+    # Choose and perform the operations of the idle units, career by career
+    idle = busy == 0
+    profit = numpy.zeros(len(live))
+    busy = numpy.where(idle, 0, busy - 1)
+    for i, career_name in enumerate(store.career_names):
+        rows = numpy.flatnonzero(idle & (career == i))
+        if not len(rows):
+            continue
+        table = careers[career_name]['table']
+        best, profits, _ = table.choose_batch(market, rate, balance[rows],
+                                              min_balance,
+                                              max_age - age[rows])
+        balance[rows] += profits
+        profit[rows] = profits
+        chosen = best >= 0
+        ops = best[chosen]
+        busy[rows[chosen]] = table.time[ops]
+        costs = table.costs[ops].sum(axis=0).tolist()
+        products = table.products[ops].sum(axis=0).tolist()
+        for resource, cost, product in zip(table.names, costs, products):
+            bought[resource] += cost
+            sold[resource] += product
+
+    # Age everyone and total the careers over the units present at the start
+    # of the step
+    age = age + 1
+    store.age[live] = age
+    store.busy[live] = busy
+    store.balance[live] = balance
+    n_careers = len(store.career_names)
+    result = dict(
+        bought=dict(bought), sold=dict(sold),
+        population=numpy.bincount(career, minlength=n_careers).tolist(),
+        total_balance=numpy.bincount(career, weights=balance,
+                                     minlength=n_careers).tolist(),
+        total_age=numpy.bincount(career, weights=age,
+                                 minlength=n_careers).tolist(),
+        total_profit=numpy.bincount(career, weights=profit,
+                                    minlength=n_careers).tolist(),
+        parents=[store.names[slot] for slot in live[spawns].tolist()],
+        starvations=int(starved.sum()),
+        deaths=int((~starved & (age >= max_age)).sum()))
+
+    # Remove starved units and units that die of old age
+    removed = starved | (age >= max_age)
+    if changes:
+        changed = ~removed & ((balance != start_balance) | (idle & (busy > 0)))
+        result['changed'] = [store.unit(slot)
+                             for slot in live[changed].tolist()]
+        result['removed'] = [store.names[slot]
+                             for slot in live[removed].tolist()]
+    for slot in live[removed].tolist():
+        store.remove(slot)
+    return result
+
+def shard_worker(conn, careers, store):
+    """
+    Serve the requests of a Clearing for one shard of units
+    """
+    parts = None
+    while True:
+        request = conn.recv()
+        if request[0] == 'step':
+            t, market, part, params = request[1:]
+            try:
+                if part == 0:
+                    parts = split_rounds(t, store, params['rounds'],
+                                         eat_every=params['eat_every'])
+                result = clear_shard(t, market, careers, store, parts[part],
+                                     **params['step'])
+            except Exception as exc:
+                result = exc
+            conn.send(result)
+        elif request[0] == 'add':
+            for name, career, eat_phase, spawn_phase in request[1]:
+                store.add(name, career, eat_phase=eat_phase,
+                          spawn_phase=spawn_phase)
+        elif request[0] == 'collect':
+            conn.send(store.columns())
+        else:
+            break
+    conn.close()
+
+class Clearing(object):
+    """
+    Batch-clearing step function over a UnitStore split into shards, each
+    stepped in its own worker process
+    """
+    def __init__(self, careers, store, jobs=1, rounds=1):
+        if numpy is None:
+            raise ImportError('batch clearing requires numpy')
+        if rounds < 1:
+            raise ValueError('number of clearing rounds is not positive')
+        self.careers = careers
+        self.store = store
+        self.rounds = rounds
+        self.workers = []
+        self.sizes = []
+        if jobs <= 1:
+            return
+
+        # Deal the units out to the shards in contiguous runs of slots
+        columns = store.columns()
+        bounds = numpy.linspace(0, len(columns['names']), jobs + 1)
+        bounds = bounds.astype('int64').tolist()
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            shard = UnitStore.from_columns(careers, dict(
+                (column, values[start:stop])
+                for column, values in columns.iteritems()))
+            conn, worker_conn = Pipe()
+            worker = Process(target=shard_worker,
+                             args=(worker_conn, careers, shard))
+            worker.daemon = True
+            worker.start()
+            worker_conn.close()
+            self.workers.append((worker, conn))
+            self.sizes.append(len(shard))
+        logger.info('clearing %d units in %d shards', len(store), jobs)
+
+    def step(self, t, market, careers, units, rate, min_balance=-100,
+            max_age=1000, eat_every=100, spawn_every=200, order='descending',
+            profiler=None, changes=None):
+        """
+        Advance the units by one time step, clearing the market at the end of
+        every round. The order of the units does not matter and is ignored.
+        UnitChanges (see econo.journal) are given the states of the changed
+        units by the shards, so their units need not be collected.
+        """
+        spawn = reset_stats(careers)
+        params = dict(rate=rate, min_balance=min_balance, max_age=max_age,
+                      eat_every=eat_every, spawn_every=spawn_every,
+                      changes=changes is not None)
+        if not self.workers:
+            parts = split_rounds(t, self.store, self.rounds,
+                                 eat_every=eat_every)
+        results = []
+        for part in xrange(self.rounds):
+            # Step every shard against the same snapshot of the market
+            if self.workers:
+                for worker, conn in self.workers:
+                    conn.send(('step', t, market, part,
+                               dict(rounds=self.rounds, eat_every=eat_every,
+                                    step=params)))
+                cleared = [conn.recv() for worker, conn in self.workers]
+                for result in cleared:
+                    if isinstance(result, Exception):
+                        raise result
+            else:
+                cleared = [clear_shard(t, market, careers, self.store,
+                                       parts[part], **params)]
+
+            # Clear the trades of the round at once
+            for result in cleared:
+                for resource, count in result['bought'].iteritems():
+                    market[resource]['delta'] += count
+                    market[resource]['bought'] += count
+                for resource, count in result['sold'].iteritems():
+                    market[resource]['delta'] -= count
+                    market[resource]['sold'] += count
+                if changes is not None:
+                    for unit_state in result['changed']:
+                        changes.change(unit_state['name'], unit_state)
+                    for name in result['removed']:
+                        changes.remove(name)
+            results.extend(cleared)
+
+        # Sum the career totals of the shards and rounds
+        career_names = sorted(careers.keys())
+        for i, career in enumerate(career_names):
+            stats = careers[career]['stats']
+            stats['population'] = sum(result['population'][i]
+                                      for result in results)
+            stats['total_balance'] = sum(result['total_balance'][i]
+                                         for result in results)
+            stats['total_age'] = int(sum(result['total_age'][i]
+                                         for result in results))
+            stats['total_profit'] = sum(result['total_profit'][i]
+                                        for result in results)
+        finish_stats(careers)
+
+        # Name the newborns in order of parent name and add each to the
+        # smallest shard
+        if self.workers:
+            for i, result in enumerate(results):
+                self.sizes[i % len(self.workers)] -= (result['starvations'] +
+                                                      result['deaths'])
+        newborns = defaultdict(list)
+        parents = sorted(parent for result in results
+                         for parent in result['parents'])
+        for parent in parents:
+            name = new_name(spawn)
+            spawn_phase = randint(0, spawn_every - 1)
+            eat_phase = randint(0, eat_every - 1)
+            logger.debug('t=%06d: %r gives birth to %r', t, parent, name)
+            if changes is not None:
+                changes.change(name, dict(name=name, career=spawn, age=0,
+                                          busy=0, balance=0.0,
+                                          eat_phase=eat_phase,
+                                          spawn_phase=spawn_phase))
+            if self.workers:
+                shard = self.sizes.index(min(self.sizes))
+                self.sizes[shard] += 1
+                newborns[shard].append((name, spawn, eat_phase, spawn_phase))
+            else:
+                self.store.add(name, spawn, eat_phase=eat_phase,
+                               spawn_phase=spawn_phase)
+        for i, (worker, conn) in enumerate(self.workers):
+            if newborns[i]:
+                conn.send(('add', newborns[i]))
+
+        if profiler is not None:
+            profiler.count('units', sum(sum(result['population'])
+                                        for result in results))
+            profiler.count('births', len(parents))
+            profiler.count('deaths', sum(result['deaths']
+                                         for result in results))
+            profiler.count('starvations', sum(result['starvations']
+                                              for result in results))
+
+    def collect(self):
+        """
+        Gather the shards back into a single UnitStore and return it
+        """
+        if not self.workers:
+            return self.store
+        for worker, conn in self.workers:
+            conn.send(('collect',))
+        shards = [conn.recv() for worker, conn in self.workers]
+        columns = dict((column, numpy.concatenate([shard[column]
+                                                   for shard in shards]))
+                       for column in shards[0])
+        self.store = UnitStore.from_columns(self.careers, columns)
+        return self.store
+
+    def close(self):
+        """
+        Gather the shards and stop the worker processes
+        """
+        self.collect()
+        for worker, conn in self.workers:
+            conn.send(('close',))
+            conn.close()
+            worker.join()
+        self.workers = []
@@ -4,13 +4,28 @@ econo.cli -- CLI tools for the econo economic simulation
 import logging; logger = logging.getLogger(__name__)
 from argparse import ArgumentParser, FileType
 from yaml import (safe_load as load_yaml, dump as save_yaml)
-from sys import exit
+from csv import DictWriter
+import json
+from sys import exit, stdout
+import random
 
-from .unit import (parse_careers, parse_units, step_time, save_careers,
-        save_units, parse_unit_ids, save_unit_ids)
-from .market import (inflate, parse_market, save_market)
-
-VERSION = 0.1
+from . import VERSION
+from .loader import load_simulation
+from .cache import load_cached_simulation
+from .checkpoint import (save_checkpoint, load_checkpoint, write_checkpoint,
+        column_units)
+from .journal import JournalSink, replay_journal, compact_journal
+from .metrics import CSVSink
+from .profiling import Profiler
+from .trace import Tracer
+from .monitor import SharedStateSink, SharedStateReader
+from .sweep import sweep, expand_grid
+from .writer import iter_units, write_description, write_regions
+from .region import Region, Regions, region_names, combined_report
+from .server import SimulationServer
+from .branch import branch
+from .generate import generate_description
+from .bench import benchmark, check_golden, save_golden
 
 def main():
     """
@@ -21,18 +36,174 @@ def main():
 
     # Handle the new command
     subparser = subparsers.add_parser('new', help=cmd_new.__doc__)
+    subparser.add_argument('-u', '--units', type=int, default=100,
+            help='Number of units (default %(default)d)')
+    add_generate_arguments(subparser)
+    subparser.add_argument('-o', '--output', type=FileType('w'),
+            default=stdout,
+            help='YAML file for the description (default: standard output)')
     subparser.set_defaults(func=cmd_new)
 
     # Handle the run command
     subparser = subparsers.add_parser('run', help=cmd_run.__doc__)
+    add_run_arguments(subparser)
+    subparser.add_argument('--scenario-cache', metavar='DIR',
+            help='Cache the parsed description in DIR, keyed by the contents'
+                 ' of the description files, and start from the cache when'
+                 ' the files are unchanged')
+    subparser.add_argument('description_file', type=FileType('r'), nargs='+',
+            help='One or more YAML files containing economic descriptions to be'
+                 'read in order')
+    subparser.set_defaults(func=cmd_run)
+
+    # Handle the resume command
+    subparser = subparsers.add_parser('resume', help=cmd_resume.__doc__)
+    add_run_arguments(subparser)
+    subparser.add_argument('checkpoint_file',
+            help='A checkpoint written by run --checkpoint-every')
+    subparser.set_defaults(func=cmd_resume)
+
+    # Handle the sweep command
+    subparser = subparsers.add_parser('sweep', help=cmd_sweep.__doc__)
+    subparser.add_argument('-s', '--steps', type=int, default=10000,
+            help='Number of steps to simulate per run (default %(default)d)')
+    subparser.add_argument('-p', '--param', action='append', default=[],
+            metavar='NAME=VALUE[,VALUE...]',
+            help='Values of a system parameter (e.g. interest_rate) or market'
+                 ' parameter (market.rate, market.food.rate) to sweep over;'
+                 ' may be repeated')
+    subparser.add_argument('-r', '--replicates', type=int, default=1,
+            help='Number of runs per scenario (default %(default)d)')
+    subparser.add_argument('--seed', type=int, default=0,
+            help='Random seed of the first run (default %(default)d)')
+    subparser.add_argument('-j', '--jobs', type=int, default=None,
+            help='Number of worker processes (default: one per CPU)')
+    subparser.add_argument('-o', '--output', type=FileType('w'),
+            default=stdout,
+            help='CSV file for the result table (default: standard output)')
+    add_simulation_arguments(subparser)
+    subparser.add_argument('description_file', type=FileType('r'), nargs='+',
+            help='One or more YAML files containing the base economic'
+                 ' description, read in order')
+    subparser.set_defaults(func=cmd_sweep)
+
+    # Handle the branch command
+    subparser = subparsers.add_parser('branch', help=cmd_branch.__doc__)
+    subparser.add_argument('--at', type=int, default=0, metavar='T',
+            help='Time step at which to branch (default %(default)d: as'
+                 ' loaded)')
+    subparser.add_argument('-s', '--steps', type=int, default=10000,
+            help='Number of steps to simulate per branch'
+                 ' (default %(default)d)')
+    subparser.add_argument('-p', '--param', action='append', default=[],
+            metavar='NAME=VALUE[,VALUE...]',
+            help='Values of a system or market parameter to branch over, as'
+                 ' for sweep; may be repeated')
+    subparser.add_argument('-r', '--replicates', type=int, default=1,
+            help='Number of runs per branch (default %(default)d)')
+    subparser.add_argument('--seed', type=int, default=0,
+            help='Random seed of the steps before branching and of the first'
+                 ' branch (default %(default)d)')
+    subparser.add_argument('-j', '--jobs', type=int, default=None,
+            help='Number of branches run at a time (default: one per CPU)')
+    subparser.add_argument('-o', '--output', type=FileType('w'),
+            default=stdout,
+            help='CSV file for the comparison table (default: standard'
+                 ' output)')
+    add_simulation_arguments(subparser)
+    subparser.add_argument('description_file', type=FileType('r'), nargs='+',
+            help='One or more YAML files containing the economic'
+                 ' description, read in order')
+    subparser.set_defaults(func=cmd_branch)
+
+    # Handle the regions command
+    subparser = subparsers.add_parser('regions', help=cmd_regions.__doc__)
     subparser.add_argument('-s', '--steps', type=int, default=10000,
             help='Number of steps to simulate (default %(default)d)')
     subparser.add_argument('-i', '--report-interval', type=int, default=100,
             help='Number of steps between reports (default %(default)d)')
+    subparser.add_argument('-k', '--exchange-every', type=int, default=10,
+            metavar='K',
+            help='Number of steps between trades among the regions'
+                 ' (default %(default)d)')
+    subparser.add_argument('--max-trade', type=int, default=10000,
+            metavar='N',
+            help='Maximum number of units of a resource traded per exchange'
+                 ' (default %(default)d)')
+    subparser.add_argument('--seed', type=int, default=0,
+            help='Random seed of the first region (default %(default)d)')
+    subparser.add_argument('--serial', action='store_true',
+            help='Step the regions in turn in one process instead of one'
+                 ' worker process per region')
+    subparser.add_argument('-o', '--output', type=FileType('w'),
+            default=stdout,
+            help='YAML file for the resulting descriptions, keyed by region'
+                 ' name (default: standard output)')
+    add_simulation_arguments(subparser)
     subparser.add_argument('description_file', type=FileType('r'), nargs='+',
-            help='One or more YAML files containing economic descriptions to be'
-                 'read in order')
-    subparser.set_defaults(func=cmd_run)
+            help='YAML files containing the economic description of each'
+                 ' region, one file per region')
+    subparser.set_defaults(func=cmd_regions)
+
+    # Handle the serve command
+    subparser = subparsers.add_parser('serve', help=cmd_serve.__doc__)
+    subparser.add_argument('--socket', default='econo.sock', metavar='PATH',
+            help='Path of the Unix-domain socket to listen on'
+                 ' (default %(default)s)')
+    add_simulation_arguments(subparser)
+    subparser.add_argument('description_file', type=FileType('r'), nargs='+',
+            help='YAML files containing the economic description')
+    subparser.set_defaults(func=cmd_serve)
+
+    # Handle the replay command
+    subparser = subparsers.add_parser('replay', help=cmd_replay.__doc__)
+    subparser.add_argument('--at', type=int, default=None, metavar='T',
+            help='Time step to rebuild the state at the start of (default:'
+                 ' the last journaled step)')
+    subparser.add_argument('-c', '--checkpoint', metavar='PATH',
+            help='Write the state to a checkpoint for econo resume instead of'
+                 ' printing its description')
+    subparser.add_argument('--compact', action='store_true',
+            help='Fold the whole journal into its base checkpoint and start'
+                 ' a new log')
+    subparser.add_argument('journal',
+            help='A journal written by run --journal')
+    subparser.set_defaults(func=cmd_replay)
+
+    # Handle the monitor command
+    subparser = subparsers.add_parser('monitor', help=cmd_monitor.__doc__)
+    subparser.add_argument('-n', '--interval', type=float, default=1.0,
+            metavar='SECONDS',
+            help='Seconds between polls of the metrics (default'
+                 ' %(default)s)')
+    subparser.add_argument('--once', action='store_true',
+            help='Print the current metrics and exit')
+    subparser.add_argument('share_file',
+            help='A metrics file published by run --share')
+    subparser.set_defaults(func=cmd_monitor)
+
+    # Handle the bench command
+    subparser = subparsers.add_parser('bench', help=cmd_bench.__doc__)
+    subparser.add_argument('--sizes', default='10,100,1000,10000',
+            help='Comma-separated unit counts to benchmark'
+                 ' (default %(default)s)')
+    subparser.add_argument('-s', '--steps', type=int, default=10,
+            help='Number of steps to time per size (default %(default)d)')
+    subparser.add_argument('--golden', metavar='PATH',
+            help='Golden trajectory file to verify the configuration against'
+                 ' before timing it, such as tests/golden/reference.yaml')
+    subparser.add_argument('--record-golden', metavar='PATH',
+            help='Record the trajectory of the reference configuration to a'
+                 ' golden file before timing')
+    subparser.add_argument('--golden-steps', type=int, default=200,
+            help='Number of steps of a recorded golden trajectory (default'
+                 ' %(default)d)')
+    subparser.add_argument('--golden-units', type=int, default=100,
+            help='Number of units in the economy of a recorded golden'
+                 ' trajectory (default %(default)d)')
+    add_generate_arguments(subparser)
+    add_simulation_arguments(subparser)
+    subparser.set_defaults(func=cmd_bench)
 
     # Parse options
     args = parser.parse_args()
@@ -43,80 +214,461 @@ def main():
     # Run command
     args.func(args)
 
+def add_run_arguments(subparser):
+    """
+    Add the options shared by the commands that simulate an economy
+    """
+    subparser.add_argument('-s', '--steps', type=int, default=10000,
+            help='Number of steps to simulate (default %(default)d)')
+    subparser.add_argument('-i', '--report-interval', type=int, default=100,
+            help='Number of steps between reports (default %(default)d)')
+    subparser.add_argument('-o', '--output', type=FileType('w'),
+            default=stdout,
+            help='YAML file for the resulting description (default: standard'
+                 ' output)')
+    add_simulation_arguments(subparser)
+    subparser.add_argument('--clearing', action='store_true',
+            help='Let every unit trade against the market as of the start of'
+                 ' each step, and clear all trades at once at its end'
+                 ' (requires --unit-store array)')
+    subparser.add_argument('--clearing-jobs', type=int, default=1,
+            metavar='N',
+            help='Number of worker processes to split the units among with'
+                 ' --clearing (default %(default)d)')
+    subparser.add_argument('--clearing-rounds', type=int, default=1,
+            metavar='N',
+            help='Number of rounds in which the units take turns to trade'
+                 ' and clear each step with --clearing; more rounds damp the'
+                 ' swings of the market (default %(default)d)')
+    subparser.add_argument('--checkpoint-every', type=int, default=0,
+            metavar='N',
+            help='Write a checkpoint every N steps and at the end of the run'
+                 ' (default: never)')
+    subparser.add_argument('--checkpoint', default='econo-checkpoint.npz',
+            metavar='PATH',
+            help='Checkpoint file to write (default %(default)s)')
+    subparser.add_argument('--journal', metavar='PATH',
+            help='Append the changes of every step to a journal, with its'
+                 ' base checkpoint in PATH.base.npz; see econo replay')
+    subparser.add_argument('--compact-every', type=int, default=1000,
+            metavar='N',
+            help='Fold the journal into its base checkpoint every N steps'
+                 ' (default %(default)d)')
+    subparser.add_argument('--metrics', metavar='PATH',
+            help='Append per-step market and career metrics to a CSV file')
+    subparser.add_argument('--metrics-buffer', type=int, default=1024,
+            metavar='N',
+            help='Number of steps of metrics to buffer between writes'
+                 ' (default %(default)d)')
+    subparser.add_argument('--share', metavar='PATH',
+            help='Publish the latest per-step market and career metrics in a'
+                 ' memory-mapped file for econo monitor (e.g. under'
+                 ' /dev/shm)')
+    subparser.add_argument('--fast-forward', action='store_true',
+            help='Skip runs of steps in which no unit eats, spawns, chooses'
+                 ' an op or dies, with the same result as stepping them'
+                 ' (not with metrics, profiling, tracing, the event'
+                 ' scheduler or --clearing)')
+    subparser.add_argument('--profile', action='store_true',
+            help='Time the phases of every step and log a summary table at'
+                 ' the end of the run')
+    subparser.add_argument('--profile-interval', type=int, default=0,
+            metavar='N',
+            help='Also log the phase times and counts of every N steps'
+                 ' (default: never)')
+    subparser.add_argument('--trace', metavar='PATH',
+            help='Write the event histories of a sample of units to a CSV'
+                 ' file (scan schedule and dict unit store only)')
+    subparser.add_argument('--trace-sample', type=float, default=0.01,
+            metavar='FRACTION',
+            help='Fraction of units to trace, chosen by a hash of their name'
+                 ' (default %(default)s)')
+    subparser.add_argument('--trace-career', action='append', default=[],
+            metavar='CAREER',
+            help='Only trace units of this career; may be repeated')
+    subparser.add_argument('--trace-capacity', type=int, default=256,
+            metavar='N',
+            help='Number of most recent events kept per traced unit'
+                 ' (default %(default)d)')
+
+def add_simulation_arguments(subparser):
+    """
+    Add the options that choose how a Simulation steps its units
+    """
+    subparser.add_argument('--unit-store', choices=['dict', 'array'],
+            default='dict',
+            help='Storage for units: a dictionary per unit, or NumPy columns'
+                 ' for very large populations (default %(default)s)')
+    subparser.add_argument('--schedule', choices=['scan', 'events'],
+            default='scan',
+            help='Visit every unit each step, or only units with an event due'
+                 ' (default %(default)s)')
+    subparser.add_argument('--quote-cache', action='store_true',
+            help='Reuse op quotes until a resource they trade changes')
+    subparser.add_argument('--bound-ops', action='store_true',
+            help='Price ops in order of an upper bound on their profit rate'
+                 ' and skip those that cannot beat the best op so far')
+    subparser.add_argument('--compile-ops', action='store_true',
+            help='Price each career\'s ops with compiled NumPy tables')
+    subparser.add_argument('--batch-ops', action='store_true',
+            help='Let all idle units of a career choose their ops at once,'
+                 ' against the market left after eating and spawning')
+    subparser.add_argument('--name-ties', action='store_true',
+            help='Visit units with equal balances in order of name, as the'
+                 ' events schedule does')
+
+def add_generate_arguments(subparser):
+    """
+    Add the options that shape a generated economy
+    """
+    subparser.add_argument('-c', '--careers', type=int, default=3,
+            help='Number of careers (default %(default)d)')
+    subparser.add_argument('--ops', type=int, default=2,
+            help='Number of ops per career (default %(default)d)')
+    subparser.add_argument('-r', '--resources', type=int, default=3,
+            help='Number of resources, including food and babykits'
+                 ' (default %(default)d)')
+    subparser.add_argument('--cost-fanout', type=int, default=1,
+            help='Number of resources each op consumes (default %(default)d)')
+    subparser.add_argument('--product-fanout', type=int, default=1,
+            help='Number of resources each op produces (default %(default)d)')
+    subparser.add_argument('--seed', type=int, default=0,
+            help='Random seed of the generator (default %(default)d)')
+
+def generate_options(args):
+    """
+    Collect the generate_description options given on the command line
+    """
+    return dict(careers=args.careers, ops=args.ops, resources=args.resources,
+                cost_fanout=args.cost_fanout,
+                product_fanout=args.product_fanout, seed=args.seed)
+
+def simulation_options(args):
+    """
+    Collect the Simulation options given on the command line
+    """
+    return dict(unit_store=args.unit_store, schedule=args.schedule,
+                quote_cache=args.quote_cache, bound_ops=args.bound_ops,
+                compile_ops=args.compile_ops,
+                batch_ops=args.batch_ops, name_ties=args.name_ties)
+
+def run_options(args):
+    """
+    Collect the Simulation options given to the commands that simulate an
+    economy
+    """
+    options = simulation_options(args)
+    options.update(clearing=args.clearing, clearing_jobs=args.clearing_jobs,
+                   clearing_rounds=args.clearing_rounds)
+    return options
+
 def cmd_new(args):
     """
     Generate a new economic description
     """
-    pass
+    try:
+        description = generate_description(units=args.units,
+                                           **generate_options(args))
+    except ValueError as exc:
+        logger.error(exc.message)
+        exit(1)
+    args.output.write(save_yaml(description))
+    args.output.close()
 
-def cmd_run(args):
+def cmd_replay(args):
     """
-    Simulate an economy for a specified number of steps
+    Rebuild the state of a journaled run at a time step
+    """
+    try:
+        if args.compact:
+            t = compact_journal(args.journal)
+            logger.info('journal compacted at t=%06d', t)
+            return
+        header, columns = replay_journal(args.journal, until=args.at)
+    except (IOError, KeyError, ValueError, ImportError) as exc:
+        logger.error(str(exc), exc_info=True)
+        exit(1)
+    if args.checkpoint:
+        write_checkpoint(args.checkpoint, header, columns)
+        return
+    units = column_units(columns, header['career_names'])
+    sections = dict((section, header[section]) for section
+                    in ['system', 'market', 'careers', 'next_unit_ids'])
+    write_description(stdout, sections, iter_units(units))
+
+def cmd_monitor(args):
+    """
+    Print the live metrics of a run, one JSON object per new time step
+    """
+    try:
+        reader = SharedStateReader(args.share_file)
+    except (IOError, OSError, ValueError) as exc:
+        logger.error(str(exc))
+        exit(1)
+    try:
+        if args.once:
+            snapshot = reader.read()
+            if snapshot is not None:
+                print json.dumps(dict(snapshot[2], t=snapshot[1]),
+                                 sort_keys=True)
+            return
+        for t, metrics in reader.follow(interval=args.interval):
+            print json.dumps(dict(metrics, t=t), sort_keys=True)
+            stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+def cmd_bench(args):
+    """
+    Benchmark the simulation hot paths across economy sizes
+    """
+    sizes = [int(size) for size in args.sizes.split(',')]
+    options = simulation_options(args)
+
+    # Record the reference trajectory, and verify the configuration against
+    # a recorded one
+    if args.record_golden:
+        save_golden(args.record_golden,
+                    dict(generate_options(args), units=args.golden_units),
+                    steps=args.golden_steps, seed=args.seed)
+        logger.info('golden trajectory: recorded %d steps to %s',
+                    args.golden_steps, args.record_golden)
+    if args.golden:
+        diverged = check_golden(args.golden, **options)
+        if diverged is None:
+            logger.info('golden trajectory: match with %s', args.golden)
+        else:
+            logger.warn('golden trajectory: diverged from %s at t=%06d',
+                        args.golden, diverged)
+
+    # Time each size
+    results = benchmark(sizes, steps=args.steps,
+                        generate_options=generate_options(args), **options)
+    columns = ['units', 'steps_per_sec', 'peak_rss_mb', 'parse_market',
+               'parse_careers', 'parse_units', 'price_op', 'choose_op',
+               'save_market', 'save_careers', 'save_units']
+    print ' '.join('%13s' % column for column in columns)
+    for result in results:
+        print ' '.join('%13.6g' % result[column] for column in columns)
+
+def load_description(description_files):
+    """
+    Read and merge YAML economic descriptions, in order
     """
     description = {}
     logger.info('parsing input files...')
-    for desc_file in args.description_file:
+    for desc_file in description_files:
         data = load_yaml(desc_file)
         if data is None:
             data = {}
         description.update(data)
         desc_file.close()
     logger.info('input files parsed')
+    return description
 
-    # Extract major data substructures
-    config_system = description.get('system', None)
-    config_market = description.get('market', None)
-    config_careers = description.get('careers', None)
-    config_units = description.get('units', None)
-    config_unit_ids = description.get('next_unit_ids', None)
+def cmd_run(args):
+    """
+    Simulate an economy for a specified number of steps
+    """
+    # Stream the description files into a simulation, or start from the
+    # scenario cache
+    try:
+        if args.scenario_cache:
+            sim = load_cached_simulation(args.description_file,
+                                         args.scenario_cache,
+                                         **run_options(args))
+        else:
+            sim = load_simulation(args.description_file,
+                                  **run_options(args))
+    except (KeyError, ValueError, ImportError) as exc:
+        logger.error(exc.message, exc_info=True)
+        exit(1)
+
+    simulate(sim, args)
 
-    # Validate the system data substructure
+def cmd_resume(args):
+    """
+    Continue simulating an economy from a checkpoint
+    """
     try:
-        if not isinstance(config_system, dict):
-            raise ValueError('system configuration is not a dictionary')
-        if not isinstance(config_system['t'], int):
-            raise ValueError('iteration number t is not an integer')
-        if not isinstance(config_system['interest_rate'], float):
-            raise ValueError('interest rate is not a float')
-        if not isinstance(config_system['min_balance'], float):
-            raise ValueError('minimum balance is not a float')
-        if not isinstance(config_system['max_age'], int):
-            raise ValueError('maximum age is not an integer')
-        if not isinstance(config_system['eat_every'], int):
-            raise ValueError('eat interval is not an integer')
-        if not isinstance(config_system['spawn_every'], int):
-            raise ValueError('spawn interval is not an integer')
-
-        # Parse the data substructures
-        market = parse_market(config_market)
-        careers = parse_careers(config_careers, market)
-        units = parse_units(config_units, careers)
-        parse_unit_ids(config_unit_ids)
-    except (KeyError, ValueError) as exc:
+        sim = load_checkpoint(args.checkpoint_file, **run_options(args))
+    except (IOError, KeyError, ValueError, ImportError) as exc:
+        logger.error(str(exc), exc_info=True)
+        exit(1)
+    logger.info('resuming at t=%06d', sim.t)
+
+    simulate(sim, args)
+
+def cmd_regions(args):
+    """
+    Simulate several regional economies that trade every few steps
+    """
+    names = region_names([desc_file.name
+                          for desc_file in args.description_file])
+    try:
+        regions = []
+        for i, (name, desc_file) in enumerate(zip(names,
+                                                  args.description_file)):
+            sim = load_simulation([desc_file], **simulation_options(args))
+            regions.append(Region(name, sim, args.seed + i))
+        regions = Regions(regions, exchange_every=args.exchange_every,
+                          max_trade=args.max_trade, serial=args.serial)
+    except (KeyError, ValueError, ImportError) as exc:
+        logger.error(exc.message, exc_info=True)
+        exit(1)
+
+    # Run the regions epoch by epoch, reporting on the combined economy
+    done = 0
+    while done < args.steps:
+        steps = min(args.exchange_every, args.steps - done)
+        reports = regions.epoch(steps)
+        last = done
+        done += steps
+        if done // args.report_interval > last // args.report_interval:
+            combined = combined_report(reports)
+            for report in reports:
+                logger.info('t=%06d: region %s: population %d, traded %d',
+                            report['t'], report['name'],
+                            report['population'], report['traded'])
+            logger.info('step %d: regions: population %d, traded %d'
+                        ' (%d in total)', done, combined['population'],
+                        combined['traded'], regions.traded)
+            logger.info('step %d: regions: prices %r', done,
+                        combined['prices'])
+
+    # Stream the results out
+    write_regions(args.output, regions.save())
+    args.output.close()
+
+def cmd_serve(args):
+    """
+    Keep an economy in memory and step it on request over a local socket
+    """
+    try:
+        sim = load_simulation(args.description_file,
+                              **simulation_options(args))
+        server = SimulationServer(sim, args.socket)
+    except (IOError, KeyError, ValueError, ImportError) as exc:
+        logger.error(str(exc), exc_info=True)
+        exit(1)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        logger.info('interrupted at t=%06d', sim.t)
+
+def parse_grid(params):
+    """
+    Parse NAME=VALUE[,VALUE...] parameters into a parameter grid
+    """
+    grid = {}
+    for param in params:
+        name, sep, values = param.partition('=')
+        if not sep or not values:
+            logger.error('sweep parameter %r is not NAME=VALUE[,VALUE...]',
+                         param)
+            exit(1)
+        grid[name] = [load_yaml(value) for value in values.split(',')]
+    return grid
+
+def write_table(output, grid, rows):
+    """
+    Write the rows of a sweep or of branches as a CSV table, parameters first
+    """
+    columns = sorted(grid.keys()) + ['replicates']
+    columns += sorted(key for key in rows[0] if key not in columns)
+    writer = DictWriter(output, columns)
+    writer.writerow(dict(zip(columns, columns)))
+    writer.writerows(rows)
+    output.close()
+
+def cmd_sweep(args):
+    """
+    Simulate an economy over a grid of parameters and seeded replicates
+    """
+    description = load_description(args.description_file)
+    grid = parse_grid(args.param)
+
+    # Run the scenarios
+    try:
+        rows = sweep(description, grid, replicates=args.replicates,
+                     steps=args.steps, seed=args.seed, jobs=args.jobs,
+                     **simulation_options(args))
+    except (KeyError, ValueError, ImportError) as exc:
         logger.error(exc.message, exc_info=True)
         exit(1)
+    write_table(args.output, grid, rows)
 
-    t_0 = config_system['t']
-    rate = config_system['interest_rate']
-    min_balance = config_system['min_balance']
-    max_age = config_system['max_age']
-    eat_every = config_system['eat_every']
-    spawn_every = config_system['spawn_every']
+def cmd_branch(args):
+    """
+    Run what-if variants of an economy from a common state at a time step
+    """
+    grid = parse_grid(args.param)
+    try:
+        sim = load_simulation(args.description_file,
+                              **simulation_options(args))
+    except (KeyError, ValueError, ImportError) as exc:
+        logger.error(exc.message, exc_info=True)
+        exit(1)
+
+    # Step to the branching point, then fork the branches from there
+    random.seed(args.seed)
+    while sim.t < args.at:
+        sim.step()
+    try:
+        rows = branch(sim, expand_grid(grid), replicates=args.replicates,
+                      steps=args.steps, seed=args.seed, jobs=args.jobs)
+    except (KeyError, ValueError) as exc:
+        logger.error(str(exc), exc_info=True)
+        exit(1)
+    write_table(args.output, grid, rows)
+
+def simulate(sim, args):
+    """
+    Run a Simulation for the requested number of steps, reporting and
+    checkpointing along the way, and print the resulting description, with
+    the last step simulated as its t
+    """
+    market = sim.market
+    careers = sim.careers
+    if args.metrics:
+        sim.sinks.append(CSVSink(args.metrics, market, careers,
+                                 buffer_steps=args.metrics_buffer))
+    if args.share:
+        sim.sinks.append(SharedStateSink(args.share, market, careers))
+    if args.journal:
+        sim.journal(JournalSink(args.journal, sim,
+                                compact_every=args.compact_every))
+    if args.profile:
+        sim.profile(Profiler(sample_every=args.profile_interval))
+    if args.trace:
+        try:
+            sim.trace(Tracer(args.trace, sample=args.trace_sample,
+                             careers=args.trace_career,
+                             capacity=args.trace_capacity))
+        except ValueError as exc:
+            logger.error(str(exc))
+            exit(1)
 
     # Run the economy
     from .market import ask_at
-    for t in xrange(t_0, t_0 + args.steps):
-        # Step time
-        step_time(t, market, careers, units, rate, min_balance=min_balance,
-                max_age=max_age, eat_every=eat_every, spawn_every=spawn_every)
+    t = sim.t
+    step = 0
+    while step < args.steps:
+        # Skip quiet steps, short of the last step and of the next step that
+        # reports or writes a checkpoint
+        if args.fast_forward:
+            limit = min(args.steps - step - 1,
+                        -sim.t % args.report_interval)
+            if args.checkpoint_every:
+                limit = min(limit, args.checkpoint_every -
+                                   step % args.checkpoint_every - 1)
+            step += sim.fast_forward(limit)
 
-        # Calculate population
-        population = 0
-        for career_rec in careers.values():
-            population += career_rec['stats']['population']
-
-        # Inflate
-        inflate(market, population)
+        # Step time
+        t = sim.step()
+        step += 1
 
         # Display aggregate statistics every report_interval
         if (t % args.report_interval) == 0:
@@ -130,11 +682,14 @@ def cmd_run(args):
                 logger.info('t=%06d: career %s: %r',
                             t, career, career_rec['stats'])
 
-    # Save the results
-    config_system['t'] = t
-    results = dict(system=config_system,
-                   market=save_market(market),
-                   careers=save_careers(careers),
-                   units=save_units(units),
-                   next_unit_ids=save_unit_ids())
-    print save_yaml(results)
+        # Write a checkpoint every checkpoint_every steps
+        if args.checkpoint_every and (step % args.checkpoint_every == 0 or
+                                      step == args.steps):
+            save_checkpoint(args.checkpoint, sim)
+
+    # Stream the results out
+    sim.close()
+    sections = sim.save_header()
+    sections['system']['t'] = t
+    write_description(args.output, sections, iter_units(sim.units))
+    args.output.close()
@@ -0,0 +1,70 @@
+"""
+econo.generate -- synthetic economic descriptions of any size
+
+generate_description builds a description in the same form as the YAML files
+read by econo run. Resources are food, babykits and resource_NN; careers are
+career_NN, each with ops op_NNN that consume cost_fanout resources and produce
+product_fanout resources. The first two careers always have an op producing
+food and babykits respectively, so that units can eat and spawn.
+"""
+import logging; logger = logging.getLogger(__name__)
+from random import Random
+
+def generate_description(units=100, careers=3, ops=2, resources=3,
+        cost_fanout=1, product_fanout=1, seed=0, max_age=1000, eat_every=100,
+        spawn_every=200):
+    """
+    Generate a random economic description with the given numbers of units,
+    careers, ops per career and resources
+    """
+    if resources < 2:
+        raise ValueError('an economy needs at least food and babykits')
+    rng = Random(seed)
+
+    # Build the market
+    resource_names = ['food', 'babykits'] + ['resource_%02d' % i
+                                             for i in xrange(resources - 2)]
+    market = {}
+    for resource in resource_names:
+        market[resource] = dict(type='exponential', delta=0,
+                                initial=float(rng.choice([1, 10, 100, 200])),
+                                rate=1.1, inflation_rate=0.005)
+
+    # Build the careers and their ops
+    config_careers = {}
+    career_names = ['career_%02d' % i for i in xrange(careers)]
+    for i, career in enumerate(career_names):
+        config_ops = {}
+        for j in xrange(ops):
+            cost_names = rng.sample(resource_names,
+                                    min(cost_fanout, len(resource_names)))
+            product_names = rng.sample(resource_names,
+                                       min(product_fanout,
+                                           len(resource_names)))
+            if j == 0 and i < 2:
+                product_names = [resource_names[i]]
+                cost_names = [name for name in cost_names
+                              if name != resource_names[i]]
+            config_ops['op_%03d' % j] = dict(
+                costs={name: rng.randint(1, 10) for name in cost_names},
+                products={name: rng.randint(1, 10) for name in product_names},
+                time=rng.randint(10, 80))
+        config_careers[career] = dict(ops=config_ops)
+
+    # Build the units
+    config_units = {}
+    next_unit_ids = dict.fromkeys(career_names, 0)
+    for i in xrange(units):
+        career = career_names[i % careers]
+        next_unit_ids[career] += 1
+        name = '%s_%04d' % (career, next_unit_ids[career])
+        config_units[name] = dict(age=rng.randint(0, max_age - 1), busy=0,
+                                  career=career,
+                                  balance=round(rng.uniform(0.0, 1000.0), 2),
+                                  eat_phase=rng.randint(0, eat_every - 1),
+                                  spawn_phase=rng.randint(0, spawn_every - 1))
+
+    system = dict(t=0, interest_rate=0.05, min_balance=-500.0, max_age=max_age,
+                  eat_every=eat_every, spawn_every=spawn_every)
+    return dict(system=system, market=market, careers=config_careers,
+                units=config_units, next_unit_ids=next_unit_ids)
@@ -0,0 +1,295 @@
+"""
+econo.journal -- append-only journals of per-step changes between checkpoints
+
+A checkpoint rewrites every unit, although most units do not change from one
+step to the next. A journal is a base checkpoint, written to PATH.base.npz,
+and an append-only log at PATH of what changed in each step since. In the
+log, a unit is the row
+
+    career, born, wake, balance, eat_phase, spawn_phase
+
+where born is t - age and wake is t + busy as of the start of step t; an
+idle unit may have any wake time up to t. Both stay the same while a unit
+ages, waits on its op or stays idle, so a unit only appears in the log in a
+step that it is born in, eats, spawns, starts an op or otherwise changes its
+balance. Every entry of the log holds, for one step:
+
+    t: the time step the state is as of the start of
+    units: the rows of the units born or changed in the step
+    removed: the names of the units that died or starved in the step
+    market: the records of the resources that changed
+    stats: the statistics of every career
+    next_unit_ids: the unit id counters that were incremented
+    system: the system configuration, only if it changed
+
+so that writing the journal costs in proportion to the activity of a step,
+not to the population. The step functions report the units they change to
+the UnitChanges of the journal, attached with Simulation.journal(), and only
+those units are looked at when the entry is written. Every compact_every
+steps, JournalSink folds the log into a new base checkpoint, written from the
+live simulation, and starts a new log. The base is replaced before the log,
+so after a crash between the two the entries already in the base are
+skipped. replay_journal() rebuilds the state as of any step since the last
+compaction, and compact_journal() folds a log into its base without a running
+simulation.
+
+Entries are length-prefixed pickles. A torn entry at the end of the log, left
+by a crash, is ignored.
+"""
+import logging; logger = logging.getLogger(__name__)
+import cPickle as pickle
+import os
+from struct import Struct
+
+from .checkpoint import (column_units, read_checkpoint, save_checkpoint,
+        unit_columns, write_checkpoint)
+from .store import UnitStore
+from .unit import save_unit_ids
+
+JOURNAL_FORMAT = 1
+LENGTH = Struct('<I')
+
+def base_path(path):
+    """
+    Path of the base checkpoint of the journal at path
+    """
+    return path + '.base.npz'
+
+def unit_row(t, unit_state):
+    """
+    Journal row of a unit state as of the start of step t
+    """
+    return (unit_state['career'], t - unit_state['age'],
+            t + unit_state['busy'], unit_state['balance'],
+            unit_state['eat_phase'], unit_state['spawn_phase'])
+
+def unit_rows(t, units):
+    """
+    Map the name of every unit of a units dictionary or UnitStore to its
+    journal row as of the start of step t
+    """
+    if isinstance(units, UnitStore):
+        columns = units.columns()
+        careers = [units.career_names[i]
+                   for i in columns['career'].tolist()]
+        born = (t - columns['age']).tolist()
+        wake = (t + columns['busy']).tolist()
+        return dict((name, row) for name, row in
+                    zip(columns['names'].tolist(),
+                        zip(careers, born, wake, columns['balance'].tolist(),
+                            columns['eat_phase'].tolist(),
+                            columns['spawn_phase'].tolist())))
+    return dict((name, unit_row(t, u_rec))
+                for name, u_rec in units.iteritems())
+
+def write_entry(out, entry):
+    """
+    Append one length-prefixed entry to a log
+    """
+    data = pickle.dumps(entry, protocol=2)
+    out.write(LENGTH.pack(len(data)) + data)
+
+def read_entries(path):
+    """
+    Iterate over the entries of a log, stopping at a torn entry
+    """
+    with open(path, 'rb') as log:
+        while True:
+            prefix = log.read(LENGTH.size)
+            if not prefix:
+                return
+            data = ''
+            if len(prefix) == LENGTH.size:
+                data = log.read(LENGTH.unpack(prefix)[0])
+            if len(prefix) < LENGTH.size or len(data) < LENGTH.unpack(
+                    prefix)[0]:
+                logger.warn('ignoring a torn entry at the end of %s', path)
+                return
+            yield pickle.loads(data)
+
+def start_log(path, t):
+    """
+    Replace the log at path, atomically, with an empty log following a base
+    checkpoint of step t, and open it for appending
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        write_entry(out, dict(format=JOURNAL_FORMAT, base_t=t))
+    os.rename(tmp_path, path)
+    return open(path, 'ab')
+
+class UnitChanges(object):
+    """
+    Names of the units that the step functions have born, changed or removed
+    since the last journal entry. A unit changes when its balance does or it
+    starts an op; aging, waiting on an op and staying idle are not changes.
+    The state of a changed unit may be given, for units that are not kept in
+    the main process, and is otherwise looked up when the entry is written.
+    """
+    def __init__(self):
+        self.changed = {}
+        self.removed = set()
+
+    def change(self, name, unit_state=None):
+        """
+        Record a unit that was born or changed
+        """
+        self.changed[name] = unit_state
+
+    def remove(self, name):
+        """
+        Record a unit that died or starved
+        """
+        self.changed.pop(name, None)
+        self.removed.add(name)
+
+    def clear(self):
+        self.changed = {}
+        self.removed = set()
+
+class JournalSink(object):
+    """
+    Journal of a running simulation, compacted every compact_every steps. It
+    starts with a base checkpoint of the simulation as it is attached, and
+    must be attached with Simulation.journal() so that the step functions
+    fill in its UnitChanges.
+    """
+    def __init__(self, path, sim, compact_every=1000):
+        if compact_every < 1:
+            raise ValueError('compaction interval is not positive')
+        self.path = path
+        self.compact_every = compact_every
+        self.log = None
+        self.changes = UnitChanges()
+        self.compact(sim)
+
+    def compact(self, sim):
+        """
+        Write a new base checkpoint and start a new log after it
+        """
+        save_checkpoint(base_path(self.path), sim)
+        if self.log is not None:
+            self.log.close()
+        self.log = start_log(self.path, sim.t)
+        self.steps = 0
+        self.rows = unit_rows(sim.t, sim.units)
+        self.changes.clear()
+        self.market = dict((resource, dict(rec))
+                           for resource, rec in sim.market.iteritems())
+        self.unit_ids = save_unit_ids()
+        self.system = dict(sim.system, t=None)
+        logger.debug('t=%06d: journal compacted into %s', sim.t,
+                     base_path(self.path))
+
+    def record(self, t, sim):
+        """
+        Append the changes of time step t, as reported to the UnitChanges, to
+        the log
+        """
+        units = sim.units
+        rows = self.rows
+        changed = {}
+        for name, unit_state in self.changes.changed.iteritems():
+            if unit_state is None and isinstance(units, UnitStore):
+                unit_state = units.unit(units.slots[name])
+            elif unit_state is None:
+                unit_state = units[name]
+            row = unit_row(sim.t, unit_state)
+            last = rows.get(name)
+            if last == row:
+                continue
+            elif (last is not None and row[2] == sim.t and last[2] <= sim.t
+                    and last[:2] == row[:2] and last[3:] == row[3:]):
+                # An idle unit that kept its balance: any wake time up to
+                # the current step stands for idle
+                continue
+            changed[name] = rows[name] = row
+        # Units born and removed since the last entry were never journaled
+        removed = [name for name in self.changes.removed if name in rows]
+        for name in removed:
+            del rows[name]
+        self.changes.clear()
+        entry = dict(t=sim.t, units=changed, removed=sorted(removed),
+                     market={}, next_unit_ids={},
+                     stats=dict((career, dict(career_rec['stats']))
+                                for career, career_rec
+                                in sim.careers.iteritems()))
+        for resource, rec in sim.market.iteritems():
+            if self.market[resource] != rec:
+                entry['market'][resource] = self.market[resource] = dict(rec)
+        unit_ids = save_unit_ids()
+        for career, next_id in unit_ids.iteritems():
+            if self.unit_ids.get(career) != next_id:
+                entry['next_unit_ids'][career] = next_id
+        system = dict(sim.system, t=None)
+        if system != self.system:
+            entry['system'] = self.system = system
+        write_entry(self.log, entry)
+        self.log.flush()
+        self.unit_ids = unit_ids
+
+        self.steps += 1
+        if self.steps >= self.compact_every:
+            self.compact(sim)
+
+    def close(self):
+        """
+        Close the log, which holds the changes up to the last step
+        """
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+def replay_journal(path, until=None):
+    """
+    Rebuild the state of a journaled simulation as of the start of step until,
+    or of the last journaled step, as a checkpoint header and unit columns
+    """
+    header, columns = read_checkpoint(base_path(path))
+    t = header['system']['t']
+    career_names = header['career_names']
+    rows = unit_rows(t, column_units(columns, career_names))
+    if until is not None and until < t:
+        raise ValueError('journal %s starts at t=%06d' % (path, t))
+
+    entries = read_entries(path)
+    first = next(entries, None)
+    if first is None or first.get('format') != JOURNAL_FORMAT:
+        raise ValueError('%s is not a journal' % path)
+    for entry in entries:
+        if entry['t'] <= t:
+            continue
+        if until is not None and entry['t'] > until:
+            break
+        rows.update(entry['units'])
+        for name in entry['removed']:
+            del rows[name]
+        for resource, rec in entry['market'].iteritems():
+            header['market'][resource] = rec
+        for career, stats in entry['stats'].iteritems():
+            header['careers'][career]['stats'] = stats
+        header['next_unit_ids'].update(entry['next_unit_ids'])
+        if 'system' in entry:
+            header['system'] = dict(entry['system'])
+        t = entry['t']
+    if until is not None and t != until:
+        raise ValueError('journal %s ends at t=%06d' % (path, t))
+
+    # Turn the rows back into units as of the start of step t
+    header['system']['t'] = t
+    units = {}
+    for name, (career, born, wake, balance, eat_phase,
+               spawn_phase) in rows.iteritems():
+        units[name] = dict(name=name, career=career, age=t - born,
+                           busy=max(0, wake - t), balance=balance,
+                           eat_phase=eat_phase, spawn_phase=spawn_phase)
+    return header, unit_columns(units, career_names)
+
+def compact_journal(path):
+    """
+    Fold the log of a journal into its base checkpoint and start a new log
+    """
+    header, columns = replay_journal(path)
+    write_checkpoint(base_path(path), header, columns)
+    start_log(path, header['system']['t']).close()
+    return header['system']['t']
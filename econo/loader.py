@@ -0,0 +1,244 @@
+"""
+econo.loader -- streaming loader for large economic descriptions
+
+load_description() in econo.cli builds the whole document tree of every file
+with the pure-Python YAML loader before parse_units() validates a single unit,
+so for descriptions with millions of units, loading costs more time and memory
+than simulating. load_simulation() instead reads the files as a stream of YAML
+events, with the libyaml parser when PyYAML was built with it. Every section
+other than units is composed and constructed as usual, but the units mapping
+is consumed one unit at a time: each unit is constructed on its own,
+validated and added straight to the unit storage, so no tree of the whole
+section is ever built. For the array store the units are collected into
+compact typed columns rather than unit dictionaries.
+
+Files are merged as by load_description: a top-level section of a later file
+replaces the same section of an earlier one. Because the careers may come
+after the units, or from a later file, the careers of the units are checked
+once all files have been read.
+"""
+import logging; logger = logging.getLogger(__name__)
+from array import array
+from yaml import SafeLoader, YAMLError
+from yaml.events import (AliasEvent, ScalarEvent, SequenceStartEvent,
+        SequenceEndEvent, MappingStartEvent, MappingEndEvent, StreamEndEvent)
+from yaml.nodes import ScalarNode, SequenceNode, MappingNode
+try:
+    from yaml import CSafeLoader
+except ImportError:
+    CSafeLoader = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .market import parse_market
+from .unit import parse_careers, parse_unit, parse_units, parse_unit_ids
+from .store import UnitStore, parse_unit_store
+from .simulation import Simulation, parse_system
+
+class UnitDict(object):
+    """
+    Streamed units, stored as a units dictionary
+    """
+    def __init__(self):
+        self.units = {}
+
+    def add(self, u_name, u_rec):
+        self.units[u_name] = u_rec
+
+    def finish(self, careers):
+        """
+        Check the career of every unit and return the units dictionary
+        """
+        for u_name, u_rec in self.units.iteritems():
+            if u_rec['career'] not in careers:
+                raise ValueError('unit %r has career %r, but that career is'
+                                 ' unknown' % (u_name, u_rec['career']))
+
+        # Copy the units as the YAML constructor does, so that they iterate,
+        # and break balance ties, in the same order as with load_description
+        units = {}
+        units.update(self.units)
+        return units
+
+class UnitColumns(object):
+    """
+    Streamed units, stored as typed columns for a UnitStore
+    """
+    TYPECODES = dict(age='l', busy='l', balance='d', eat_phase='l',
+                     spawn_phase='l', career='i')
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError('the array unit store requires numpy')
+        self.names = []
+        self.career_names = []
+        self.career_index = {}
+        self.columns = {column: array(typecode)
+                        for column, typecode in self.TYPECODES.iteritems()}
+
+    def add(self, u_name, u_rec):
+        career = u_rec['career']
+        if career not in self.career_index:
+            self.career_index[career] = len(self.career_names)
+            self.career_names.append(career)
+        self.names.append(u_name)
+        columns = self.columns
+        columns['career'].append(self.career_index[career])
+        for column in ['age', 'busy', 'eat_phase', 'spawn_phase']:
+            columns[column].append(int(u_rec[column]))
+        columns['balance'].append(float(u_rec['balance']))
+
+    def finish(self, careers):
+        """
+        Check the career of every unit and return a UnitStore holding them
+        """
+        # Map the careers in order of appearance onto the store's indices
+        store_names = sorted(careers.keys())
+        remap = numpy.zeros(len(self.career_names), dtype='int32')
+        for i, career in enumerate(self.career_names):
+            if career not in careers:
+                u_name = self.names[list(self.columns['career']).index(i)]
+                raise ValueError('unit %r has career %r, but that career is'
+                                 ' unknown' % (u_name, career))
+            remap[i] = store_names.index(career)
+
+        # Keep the last of units listed more than once, and give the units
+        # their slots in the order in which parse_unit_store would visit them
+        slots = {}
+        slots.update(dict(zip(self.names, xrange(len(self.names)))))
+        keep = numpy.fromiter(slots.itervalues(), dtype='int64',
+                              count=len(slots))
+        columns = dict(names=[self.names[i] for i in keep.tolist()])
+        for column, dtype in UnitStore.COLUMNS:
+            if column != 'alive':
+                columns[column] = numpy.array(self.columns[column],
+                                              dtype=dtype)[keep]
+        columns['career'] = remap[columns['career']]
+        return UnitStore.from_columns(careers, columns)
+
+def compose(loader, anchors):
+    """
+    Build the representation graph of the next node in the event stream
+    """
+    event = loader.get_event()
+    if isinstance(event, AliasEvent):
+        if event.anchor not in anchors:
+            raise ValueError('found undefined alias %r' % event.anchor)
+        return anchors[event.anchor]
+    if isinstance(event, ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(ScalarNode, event.value, event.implicit)
+        node = ScalarNode(tag, event.value, event.start_mark, event.end_mark,
+                          style=event.style)
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+    elif isinstance(event, SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(SequenceNode, None, event.implicit)
+        node = SequenceNode(tag, [], event.start_mark, None,
+                            flow_style=event.flow_style)
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        while not loader.check_event(SequenceEndEvent):
+            node.value.append(compose(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+    else:
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(MappingNode, None, event.implicit)
+        node = MappingNode(tag, [], event.start_mark, None,
+                           flow_style=event.flow_style)
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        while not loader.check_event(MappingEndEvent):
+            key = compose(loader, anchors)
+            node.value.append((key, compose(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+    return node
+
+def construct(loader, anchors):
+    """
+    Read and construct the next node in the event stream
+    """
+    return loader.construct_document(compose(loader, anchors))
+
+def stream_units(loader, anchors, units):
+    """
+    Validate the units mapping in the event stream one unit at a time,
+    adding each unit to the given streamed unit storage
+    """
+    if not loader.check_event(MappingStartEvent):
+        construct(loader, anchors)
+        raise ValueError('units configuration is not a dictionary')
+    loader.get_event()
+    logger.debug('validating units')
+    while not loader.check_event(MappingEndEvent):
+        u_name = construct(loader, anchors)
+        u_rec = parse_unit(u_name, construct(loader, anchors))
+        units.add(u_name, u_rec)
+    loader.get_event()
+    return units
+
+def load_simulation(description_files, unit_store='dict', compile_ops=False,
+        **options):
+    """
+    Read and merge YAML economic descriptions, in order, streaming their
+    units into the unit storage, and convert them into a Simulation. Other
+    keyword arguments are passed on to Simulation.
+    """
+    Loader = CSafeLoader or SafeLoader
+    description = {}
+    units = None
+    logger.info('parsing input files...')
+    for desc_file in description_files:
+        loader = Loader(desc_file)
+        anchors = {}
+        try:
+            loader.get_event()
+            if loader.check_event(StreamEndEvent):
+                continue
+            loader.get_event()
+            if not loader.check_event(MappingStartEvent):
+                if construct(loader, anchors) is not None:
+                    raise ValueError('description %r is not a dictionary'
+                                     % getattr(desc_file, 'name', desc_file))
+            else:
+                loader.get_event()
+                while not loader.check_event(MappingEndEvent):
+                    key = construct(loader, anchors)
+                    if key == 'units':
+                        if unit_store == 'array':
+                            units = UnitColumns()
+                        else:
+                            units = UnitDict()
+                        stream_units(loader, anchors, units)
+                    else:
+                        description[key] = construct(loader, anchors)
+                loader.get_event()
+            loader.get_event()
+            if not loader.check_event(StreamEndEvent):
+                raise YAMLError('expected a single document in %r'
+                                % getattr(desc_file, 'name', desc_file))
+        finally:
+            loader.dispose()
+            desc_file.close()
+    logger.info('input files parsed')
+
+    # Parse the other sections and check the careers of the units
+    system = parse_system(description.get('system', None))
+    market = parse_market(description.get('market', None))
+    careers = parse_careers(description.get('careers', None), market,
+                            compiled=compile_ops)
+    if units is not None:
+        units = units.finish(careers)
+    elif unit_store == 'array':
+        units = parse_unit_store(description.get('units', None), careers)
+    else:
+        units = parse_units(description.get('units', None), careers)
+    parse_unit_ids(description.get('next_unit_ids', None))
+    return Simulation(system, market, careers, units, **options)
@@ -11,6 +11,80 @@ following form:
     
 """
 import logging; logger = logging.getLogger(__name__)
+from collections import defaultdict
+from math import ceil, floor
+
+def series_price(type_name, initial, rate, start, stop):
+    """
+    Compute the total price of the units of a resource at deltas start through
+    stop - 1 in closed form, so that the cost does not grow with quantity.
+    Linear prices are an arithmetic series clamped at zero and exponential
+    prices are a geometric series, infinite once its terms overflow.
+    """
+    count = stop - start
+    if count <= 0:
+        return 0.0
+
+    # Handle pricing for linear and exponential resources differently
+    if type_name == 'linear':
+        # Trim the range to the deltas where the price is not clamped to zero
+        if rate > 0:
+            start = max(start, _first_nonnegative(initial, rate))
+        elif rate < 0:
+            stop = min(stop, _last_nonnegative(initial, rate) + 1)
+        elif initial < 0.0:
+            return 0.0
+        count = stop - start
+        if count <= 0:
+            return 0.0
+        if count == 1:
+            return max(0.0, initial + start * rate)
+        return count * initial + rate * ((start + stop - 1) * count // 2)
+    elif type_name == 'exponential':
+        if count == 1:
+            return initial * (rate ** start)
+        if rate == 1.0:
+            return initial * count
+        try:
+            return (initial * (rate ** start) * (rate ** count - 1.0) /
+                    (rate - 1.0))
+        except OverflowError:
+            return _geometric_overflow(initial, rate, start, stop)
+    else:
+        assert False, "Resource type must be linear or exponential."
+
+def _geometric_overflow(initial, rate, start, stop):
+    """
+    Sum a geometric series whose closed form overflowed in rate ** start or
+    rate ** count, as the difference of the powers that bound its terms, or
+    return an infinite price if those overflow too
+    """
+    try:
+        return initial * (rate ** stop - rate ** start) / (rate - 1.0)
+    except OverflowError:
+        return initial * float('inf') if initial else 0.0
+
+def _first_nonnegative(initial, rate):
+    """
+    Find the smallest delta at which a rising linear price is not negative
+    """
+    delta = int(ceil(-initial / rate))
+    while initial + (delta - 1) * rate >= 0.0:
+        delta -= 1
+    while initial + delta * rate < 0.0:
+        delta += 1
+    return delta
+
+def _last_nonnegative(initial, rate):
+    """
+    Find the largest delta at which a falling linear price is not negative
+    """
+    delta = int(floor(initial / -rate))
+    while initial + (delta + 1) * rate >= 0.0:
+        delta += 1
+    while initial + delta * rate < 0.0:
+        delta -= 1
+    return delta
 
 def bid_at(market, resource, qty=1):
     """
@@ -20,21 +94,11 @@ def bid_at(market, resource, qty=1):
     assert resource in market, "Resource must be in the market"
     assert qty >= 0, "Quantity must be non-negative"
     res = market[resource]
-    type_name, initial, delta, rate = (res['type'], res['initial'],
-            res['delta'], res['rate'])
 
-    # Handle pricing for linear and exponential resources differently
-    price = 0.0
-    for step in xrange(qty):
-        if res['type'] == 'linear':
-            price += max(0.0, initial + (delta - 1) * rate)
-        elif res['type'] == 'exponential':
-            price += initial * (rate ** (delta - 1))
-        else:
-            assert False, "Resource type must be linear or exponential."
-        delta -= 1
-
-    return price
+    # Selling walks delta downward, one unit at a time
+    delta = res['delta']
+    return series_price(res['type'], res['initial'], res['rate'],
+                        delta - qty, delta)
 
 def sell(market, resource, qty=1):
     """
@@ -55,21 +119,11 @@ def ask_at(market, resource, qty=1):
     assert resource in market, "Resource must be in the market"
     assert qty >= 0, "Quantity must be non-negative"
     res = market[resource]
-    type_name, initial, delta, rate = (res['type'], res['initial'],
-            res['delta'], res['rate'])
-
-    # Handle pricing for linear and exponential resources differently
-    price = 0.0
-    for step in xrange(qty):
-        if res['type'] == 'linear':
-            price += max(0.0, initial + delta * rate)
-        elif res['type'] == 'exponential':
-            price += initial * (rate ** delta)
-        else:
-            assert False, "Resource type must be linear or exponential."
-        delta += 1
 
-    return price
+    # Buying walks delta upward, one unit at a time
+    delta = res['delta']
+    return series_price(res['type'], res['initial'], res['rate'],
+                        delta, delta + qty)
 
 def buy(market, resource, qty=1):
     """
@@ -82,44 +136,109 @@ def buy(market, resource, qty=1):
     rec['delta'] += qty
     rec['bought'] += qty
 
-def price_op(market, op, rate, balance):
+def quote_op(market, op):
     """
-    Compute the per time step profit (loss) on an operation given a market,
-    operation, starting balance, and a per time step interest rate.
+    Compute the balance-independent part of the price of an operation: the
+    total cost of its resource dependencies and the earnings from its products
     """
     # Compute the total cost of resource dependencies
     cost = 0.0
     for resource, count in op.costs.iteritems():
         cost += ask_at(market, resource, qty=count)
 
+    # Compute the earnings amount
+    earnings = 0.0
+    for resource, count in op.products.iteritems():
+        earnings += bid_at(market, resource, qty=count)
+
+    return (cost, earnings)
+
+def price_quote(op, rate, balance, cost, earnings):
+    """
+    Compute the per time step profit (loss) on an operation from its quoted
+    cost and earnings, a starting balance, and a per time step interest rate.
+    """
     # Compute the loan amount
     if cost > balance:
         loan = cost - balance
         loan *= ((1.0 + rate) ** op.time) - 1.0
         cost += loan
 
-    # Compute the earnings amount
-    earnings = 0.0
-    for resource, count in op.products.iteritems():
-        earnings += bid_at(market, resource, qty=count)
-
     # Compute the profit
     profit = earnings - cost
 
     # Compute the earnings rate and minimum balance
     return ((profit / op.time), profit, balance - cost)
 
-def inflate(market, population):
+def price_op(market, op, rate, balance):
+    """
+    Compute the per time step profit (loss) on an operation given a market,
+    operation, starting balance, and a per time step interest rate.
+    """
+    cost, earnings = quote_op(market, op)
+    return price_quote(op, rate, balance, cost, earnings)
+
+class QuoteCache(object):
+    """
+    Cache of op quotes (see quote_op) that re-prices an op only when one of
+    the resources it trades has changed. A resource's delta is the only
+    market state its price depends on, so it serves as the resource's version
+    counter: refresh() compares each delta with the one last seen and drops
+    the quotes of the ops that use any resource that moved. misses counts the
+    quotes computed rather than reused, and issued the resource price quotes
+    (ask_at and bid_at calls) they requested.
+    """
+    def __init__(self):
+        self.seen = {}
+        self.users = defaultdict(set)
+        self.quotes = {}
+        self.misses = 0
+        self.issued = 0
+
+    def refresh(self, market):
+        """
+        Invalidate the quotes that depend on resources changed since the last
+        refresh
+        """
+        for resource, rec in market.iteritems():
+            delta = rec['delta']
+            if self.seen.get(resource) != delta:
+                self.seen[resource] = delta
+                for key in self.users[resource]:
+                    self.quotes.pop(key, None)
+
+    def quote(self, market, op):
+        """
+        Return the (cost, earnings) quote of an op, as of the last refresh
+        """
+        key = id(op)
+        if key not in self.quotes:
+            for resource in op.costs.keys() + op.products.keys():
+                self.users[resource].add(key)
+            self.quotes[key] = quote_op(market, op)
+            self.misses += 1
+            self.issued += len(op.costs) + len(op.products)
+        return self.quotes[key]
+
+    def price(self, market, op, rate, balance):
+        """
+        Equivalent to price_op, using the cached quote of the op
+        """
+        cost, earnings = self.quote(market, op)
+        return price_quote(op, rate, balance, cost, earnings)
+
+def inflate(market, population, steps=1):
     """
-    Consume goods out of the market
+    Consume goods out of the market, for a number of steps with the same
+    population
     """
     for resource, rec in market.iteritems():
-        rec['delta'] += int(rec['inflation_rate'] * population + 0.5)
+        rec['delta'] += steps * int(rec['inflation_rate'] * population + 0.5)
 
 def parse_market(config_market):
     """
-    Convert a dictionary describing market conditions into an appropriate family
-    of data structures. This mostly involves validation.
+    Convert a dictionary describing market conditions into an appropriate
+    family of data structures. This mostly involves validation.
     """
     # The output is the same as the input
     if not isinstance(config_market, dict):
@@ -147,7 +266,8 @@ def parse_market(config_market):
         if not isinstance(rec['rate'], float):
             raise ValueError('resource value model rate is not a float')
         if not isinstance(rec['inflation_rate'], float):
-            raise ValueError('per-capita resource inflation rate is not a float')
+            raise ValueError('per-capita resource inflation rate is not a'
+                             ' float')
         for param in ['bought', 'sold']:
             if param not in rec:
                 rec[param] = 0
@@ -0,0 +1,82 @@
+"""
+econo.metrics -- full-resolution time series of a running simulation
+
+A sink is any object with the following methods, attached to a Simulation
+through its sinks list:
+
+    record(t, sim): called once per time step, after inflation
+    close(): called once at the end of the run
+
+CSVSink records, for every step, the asking price, delta and bought/sold
+counts of every resource and the aggregate statistics of every career. Rows
+are kept as raw values in a fixed-size buffer and only formatted and written,
+in one batch, when the buffer fills or the sink is closed.
+"""
+import logging; logger = logging.getLogger(__name__)
+import csv
+import os
+
+from .market import ask_at
+
+# Resource and career statistics recorded for every step
+RESOURCE_METRICS = ['price', 'delta', 'bought', 'sold']
+CAREER_METRICS = ['population', 'total_balance', 'total_age', 'total_profit',
+                  'avg_earnings', 'avg_profit']
+
+class CSVSink(object):
+    """
+    Append-only CSV file of per-step market and career metrics
+    """
+    def __init__(self, path, market, careers, buffer_steps=1024):
+        self.resources = sorted(market.keys())
+        self.careers = sorted(careers.keys())
+        self.columns = ['t']
+        for resource in self.resources:
+            self.columns.extend('%s.%s' % (resource, metric)
+                                for metric in RESOURCE_METRICS)
+        for career in self.careers:
+            self.columns.extend('%s.%s' % (career, metric)
+                                for metric in CAREER_METRICS)
+
+        # Append to an existing series, such as that of a resumed run
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.out = open(path, 'ab')
+        self.writer = csv.writer(self.out)
+        if is_new:
+            self.writer.writerow(self.columns)
+
+        self.buffer = [None] * buffer_steps
+        self.count = 0
+
+    def record(self, t, sim):
+        """
+        Buffer the metrics of time step t
+        """
+        market = sim.market
+        row = [t]
+        for resource in self.resources:
+            rec = market[resource]
+            row.extend((ask_at(market, resource), rec['delta'], rec['bought'],
+                        rec['sold']))
+        for career in self.careers:
+            stats = sim.careers[career]['stats']
+            row.extend(stats.get(metric, 0) for metric in CAREER_METRICS)
+        self.buffer[self.count] = row
+        self.count += 1
+        if self.count == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """
+        Write out the buffered rows
+        """
+        self.writer.writerows(self.buffer[:self.count])
+        self.out.flush()
+        self.count = 0
+
+    def close(self):
+        """
+        Write out the buffered rows and close the file
+        """
+        self.flush()
+        self.out.close()
@@ -0,0 +1,154 @@
+"""
+econo.monitor -- live, read-only export of the market and career metrics
+
+SharedStateSink publishes, after every step, the metrics CSVSink records
+(the asking price, delta and bought/sold counts of every resource and the
+statistics of every career) into a memory-mapped file, so that any number of
+local monitors can follow a run without pausing it and without any I/O in the
+step loop. Put the file on a memory-backed filesystem such as /dev/shm to
+keep the kernel from writing it back to disk. The file holds:
+
+    magic: 8 bytes, ECONOSHM
+    seq: unsigned 64-bit counter, odd while an update is in progress
+    t: signed 64-bit time step of the metrics
+    count: unsigned 32-bit number of metrics
+    names_size: unsigned 32-bit size of the metric names
+    names: JSON list of the metric names, resource.metric and career.metric,
+        padded with spaces to a multiple of 8 bytes
+    values: a 64-bit float per metric
+
+all in little-endian byte order. The writer makes seq odd, writes t and the
+values and makes seq even again, so a reader that sees the same even seq
+before and after copying the values has a consistent snapshot; otherwise it
+retries. The file is left in place when the run ends, holding the final
+metrics.
+"""
+import logging; logger = logging.getLogger(__name__)
+import json
+import mmap
+import os
+from struct import Struct
+import time
+
+from .market import ask_at
+from .metrics import RESOURCE_METRICS, CAREER_METRICS
+
+MAGIC = 'ECONOSHM'
+HEADER = Struct('<8sQqII')
+SEQ = Struct('<Q')
+SEQ_OFFSET = 8
+T = Struct('<q')
+T_OFFSET = 16
+
+class SharedStateSink(object):
+    """
+    Memory-mapped file of the latest per-step market and career metrics
+    """
+    def __init__(self, path, market, careers):
+        self.resources = sorted(market.keys())
+        self.careers = sorted(careers.keys())
+        self.names = []
+        for resource in self.resources:
+            self.names.extend('%s.%s' % (resource, metric)
+                              for metric in RESOURCE_METRICS)
+        for career in self.careers:
+            self.names.extend('%s.%s' % (career, metric)
+                              for metric in CAREER_METRICS)
+        names = json.dumps(self.names)
+        names += ' ' * (-len(names) % 8)
+        self.values = Struct('<%dd' % len(self.names))
+        self.values_offset = HEADER.size + len(names)
+        size = self.values_offset + self.values.size
+
+        # Lay the file out, then map it
+        with open(path, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, 0, -1, len(self.names), len(names)))
+            out.write(names)
+            out.write('\0' * self.values.size)
+        self.fd = os.open(path, os.O_RDWR)
+        self.map = mmap.mmap(self.fd, size)
+        self.seq = 0
+
+    def record(self, t, sim):
+        """
+        Publish the metrics of time step t
+        """
+        market = sim.market
+        row = []
+        for resource in self.resources:
+            rec = market[resource]
+            row.extend((ask_at(market, resource), rec['delta'], rec['bought'],
+                        rec['sold']))
+        for career in self.careers:
+            stats = sim.careers[career]['stats']
+            row.extend(stats.get(metric, 0) for metric in CAREER_METRICS)
+        self.seq += 1
+        SEQ.pack_into(self.map, SEQ_OFFSET, self.seq)
+        T.pack_into(self.map, T_OFFSET, t)
+        self.values.pack_into(self.map, self.values_offset, *row)
+        self.seq += 1
+        SEQ.pack_into(self.map, SEQ_OFFSET, self.seq)
+
+    def close(self):
+        """
+        Unmap the file, leaving the last metrics in it
+        """
+        if self.map is None:
+            return
+        self.map.close()
+        os.close(self.fd)
+        self.map = None
+
+class SharedStateReader(object):
+    """
+    Read-only view of the metrics published by a SharedStateSink
+    """
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, _, _, count, names_size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not an econo shared state file' % path)
+        self.names = json.loads(self.map[HEADER.size:HEADER.size +
+                                         names_size])
+        self.values = Struct('<%dd' % count)
+        self.values_offset = HEADER.size + names_size
+
+    def read(self, retries=1000):
+        """
+        Return a consistent snapshot of the metrics as a tuple of (seq, t,
+        dictionary of metrics), or None if nothing was published yet
+        """
+        for attempt in xrange(retries):
+            seq = SEQ.unpack_from(self.map, SEQ_OFFSET)[0]
+            if not seq & 1:
+                t = T.unpack_from(self.map, T_OFFSET)[0]
+                values = self.values.unpack_from(self.map, self.values_offset)
+                if SEQ.unpack_from(self.map, SEQ_OFFSET)[0] == seq:
+                    if seq == 0:
+                        return None
+                    return (seq, t, dict(zip(self.names, values)))
+
+            # Let the writer finish its update, which it may have been
+            # preempted in the middle of
+            time.sleep(0.0001)
+        raise ValueError('no consistent snapshot after %d attempts' % retries)
+
+    def follow(self, interval=1.0):
+        """
+        Poll the metrics every interval seconds, yielding (t, metrics) for
+        every new snapshot
+        """
+        last = None
+        while True:
+            snapshot = self.read()
+            if snapshot is not None and snapshot[0] != last:
+                last = snapshot[0]
+                yield snapshot[1], snapshot[2]
+            time.sleep(interval)
+
+    def close(self):
+        self.map.close()
@@ -0,0 +1,267 @@
+"""
+econo.optable -- compiled, integer-indexed op tables for vectorized pricing
+
+Pricing an op through price_op walks its string-keyed costs and products
+dictionaries and quotes each resource separately. compile_ops turns the market
+into a ResourceTable, parallel arrays over an integer resource index:
+
+    names: (list) resource names, in index order
+    linear: (bool array) whether the resource is priced linearly
+    initial: (float64 array) the price of the resource at delta=0
+    rate: (float64 array) the per-delta price change of the resource
+
+and each career's ops into an OpTable, dense cost and product matrices over the
+resources the career trades. A whole career's op set is then priced in one
+vectorized call, with the same closed forms as econo.market.series_price. The
+per-resource prices of each op are added up in the order quote_op adds them,
+the iteration order of its costs and products dictionaries, so that the
+totals, and the choices made from them, are the same to the last bit.
+"""
+import logging; logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class ResourceTable(object):
+    """
+    Static pricing parameters of every resource in a market, as arrays
+    """
+    def __init__(self, market):
+        self.names = sorted(market.keys())
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.linear = numpy.array([market[name]['type'] == 'linear'
+                                   for name in self.names])
+        self.initial = numpy.array([market[name]['initial']
+                                    for name in self.names], dtype='float64')
+        self.rate = numpy.array([market[name]['rate']
+                                 for name in self.names], dtype='float64')
+
+def series_prices(linear, initial, rate, start, stop):
+    """
+    Vectorized econo.market.series_price over arrays of resource parameters
+    and delta ranges
+    """
+    count = stop - start
+    with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # Exponential prices form a geometric series
+        power = rate ** start
+        single = initial * power
+        series = initial * power * (rate ** count - 1.0) / (rate - 1.0)
+        series = numpy.where(rate == 1.0, initial * count, series)
+        exponential = numpy.where(count == 1, single, series)
+
+        # Linear prices form an arithmetic series, trimmed to the deltas at
+        # which the price is not clamped to zero
+        first = numpy.ceil(-initial / rate)
+        first -= (initial + (first - 1) * rate) >= 0.0
+        first += (initial + first * rate) < 0.0
+        last = numpy.floor(initial / -rate)
+        last += (initial + (last + 1) * rate) >= 0.0
+        last -= (initial + last * rate) < 0.0
+        lo = numpy.where(rate > 0, numpy.maximum(start, first), start)
+        hi = numpy.where(rate < 0, numpy.minimum(stop, last + 1), stop)
+        hi = numpy.where((rate == 0) & (initial < 0.0), lo, hi)
+        lo = lo.astype('int64')
+        hi = hi.astype('int64')
+        n = hi - lo
+        arithmetic = numpy.where(
+            n == 1, numpy.maximum(0.0, initial + lo * rate),
+            n * initial + rate * ((lo + hi - 1) * n // 2))
+        arithmetic = numpy.where(n > 0, arithmetic, 0.0)
+
+    prices = numpy.where(linear, arithmetic, exponential)
+    return numpy.where(count > 0, prices, 0.0)
+
+class OpTable(object):
+    """
+    A career's ops compiled into dense matrices over the resources it trades
+    """
+    def __init__(self, ops, resources):
+        self.ops = list(ops)
+        self.resources = resources
+        used = set()
+        for op in self.ops:
+            used.update(op.costs.keys())
+            used.update(op.products.keys())
+        self.names = sorted(used, key=resources.index.get)
+        columns = [resources.index[name] for name in self.names]
+        self.linear = resources.linear[columns]
+        self.initial = resources.initial[columns]
+        self.rate = resources.rate[columns]
+        self.costs = numpy.zeros((len(self.ops), len(self.names)),
+                                 dtype='int64')
+        self.products = numpy.zeros_like(self.costs)
+        for i, op in enumerate(self.ops):
+            for j, name in enumerate(self.names):
+                self.costs[i, j] = op.costs.get(name, 0)
+                self.products[i, j] = op.products.get(name, 0)
+        self.cost_order = self.sum_order(op.costs for op in self.ops)
+        self.product_order = self.sum_order(op.products for op in self.ops)
+        self.time = numpy.array([op.time for op in self.ops], dtype='int64')
+        self.op_quotes = sum(len(op.costs) + len(op.products)
+                             for op in self.ops)
+        self.issued = 0
+        self.loan_factors = {}
+        self.last_deltas = None
+        self.last_quote = None
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __iter__(self):
+        return iter(self.ops)
+
+    def sum_order(self, counts):
+        """
+        Return a matrix of the columns of the resources in each of a sequence
+        of costs or products dictionaries, in iteration order, padded with
+        the index one past the last column
+        """
+        orders = [[self.names.index(name) for name in count]
+                  for count in counts]
+        width = max([len(order) for order in orders] + [0])
+        matrix = numpy.repeat(len(self.names), len(orders) * width)
+        matrix = matrix.reshape((len(orders), width))
+        for i, order in enumerate(orders):
+            matrix[i, :len(order)] = order
+        return matrix
+
+    def total(self, prices, order):
+        """
+        Add up the per-resource prices of every op in the given sum order,
+        one resource at a time as quote_op does, rather than in column order
+        """
+        padded = numpy.zeros((prices.shape[0], prices.shape[1] + 1))
+        padded[:, :-1] = prices
+        rows = numpy.arange(prices.shape[0])
+        total = numpy.zeros(prices.shape[0])
+        for k in xrange(order.shape[1]):
+            total = total + padded[rows, order[:, k]]
+        return total
+
+    def loan_factor(self, rate):
+        """
+        Return the per-op factor by which a loan grows over the op's time
+        """
+        if rate not in self.loan_factors:
+            self.loan_factors[rate] = ((1.0 + rate) ** self.time) - 1.0
+        return self.loan_factors[rate]
+
+    def quote(self, market):
+        """
+        Vectorized econo.market.quote_op: return arrays of the total cost and
+        earnings of every op. The quote is reused while the deltas of the
+        resources the career trades are unchanged; issued counts the resource
+        price quotes of the quotes computed, as quote_op would request them.
+        """
+        deltas = numpy.array([market[name]['delta'] for name in self.names],
+                             dtype='int64')
+        if self.last_deltas is not None and (deltas == self.last_deltas).all():
+            return self.last_quote
+        costs = series_prices(self.linear, self.initial, self.rate, deltas,
+                              deltas + self.costs)
+        earnings = series_prices(self.linear, self.initial, self.rate,
+                                 deltas - self.products, deltas)
+        self.last_deltas = deltas
+        self.issued += self.op_quotes
+        self.last_quote = (self.total(costs, self.cost_order),
+                           self.total(earnings, self.product_order))
+        return self.last_quote
+
+    def price(self, market, rate, balance):
+        """
+        Vectorized econo.market.price_op: return arrays of the profit rate,
+        profit and low balance of every op
+        """
+        cost, earnings = self.quote(market)
+        loan = numpy.where(cost > balance,
+                           (cost - balance) * self.loan_factor(rate), 0.0)
+        cost = cost + loan
+        profit = earnings - cost
+        return (profit / self.time, profit, balance - cost)
+
+    def choose(self, market, rate, balance, min_balance, max_time,
+            noop_profit):
+        """
+        Vectorized econo.unit.choose_op: pick the first op with the highest
+        profit rate among the affordable ops that beat the no-op. Every op is
+        priced; the resource price quotes are only issued when the quote of
+        the table is not reused.
+        """
+        if not self.ops:
+            return (None, noop_profit, noop_profit, 0, 0)
+        issued = self.issued
+        profit_rate, profit, low_balance = self.price(market, rate, balance)
+        valid = ~((low_balance < min_balance) & (low_balance < balance))
+        valid &= self.time <= max_time
+        valid &= profit_rate > noop_profit
+        quotes = self.issued - issued
+        if not valid.any():
+            return (None, noop_profit, noop_profit, len(self.ops), quotes)
+        best = numpy.argmax(numpy.where(valid, profit_rate, -numpy.inf))
+        return (self.ops[best], float(profit[best]), float(profit_rate[best]),
+                len(self.ops), quotes)
+
+    def choose_batch(self, market, rate, balances, min_balance, max_times):
+        """
+        Vectorized choose over many units facing the same market: return the
+        index of the chosen op of each unit (-1 for the no-op), and arrays of
+        their profits and profit rates
+        """
+        balances = numpy.asarray(balances, dtype='float64')
+        max_times = numpy.asarray(max_times, dtype='int64')
+        noop_profit = numpy.where(balances < 0.0, -((-balances) * rate), 0.0)
+        if not self.ops:
+            return (numpy.repeat(-1, len(balances)), noop_profit, noop_profit)
+
+        # Price every op for every unit, as rows of a units-by-ops matrix
+        cost, earnings = self.quote(market)
+        balance = balances[:, None]
+        loan = numpy.where(cost > balance,
+                           (cost - balance) * self.loan_factor(rate), 0.0)
+        cost = cost + loan
+        profit = earnings - cost
+        profit_rate = profit / self.time
+        low_balance = balance - cost
+
+        # Pick the best affordable op of each unit that beats its no-op
+        valid = ~((low_balance < min_balance) & (low_balance < balance))
+        valid &= self.time <= max_times[:, None]
+        valid &= profit_rate > noop_profit[:, None]
+        best = numpy.argmax(numpy.where(valid, profit_rate, -numpy.inf),
+                            axis=1)
+        rows = numpy.arange(len(balances))
+        chosen = valid[rows, best]
+        return (numpy.where(chosen, best, -1),
+                numpy.where(chosen, profit[rows, best], noop_profit),
+                numpy.where(chosen, profit_rate[rows, best], noop_profit))
+
+def batch_table(career_rec, market):
+    """
+    Return the OpTable of a career for batched op choice: its compiled table
+    if it has one, otherwise one compiled on first use and cached under the
+    'batch_table' key
+    """
+    if 'table' in career_rec:
+        return career_rec['table']
+    if 'batch_table' not in career_rec:
+        if numpy is None:
+            raise ImportError('batched op choice requires numpy')
+        career_rec['batch_table'] = OpTable(career_rec['ops'],
+                                            ResourceTable(market))
+    return career_rec['batch_table']
+
+def compile_ops(careers, market):
+    """
+    Attach an OpTable to every career, under the 'table' key
+    """
+    if numpy is None:
+        raise ImportError('compiled op tables require numpy')
+    resources = ResourceTable(market)
+    for career, career_rec in careers.iteritems():
+        logger.debug('compiling %d ops of %r career', len(career_rec['ops']),
+                     career)
+        career_rec['table'] = OpTable(career_rec['ops'], resources)
+    return resources
@@ -0,0 +1,159 @@
+"""
+econo.order -- balance-ordered index of a units dictionary
+
+step_time visits the units in order of balance. Sorting every unit on every
+step costs O(n log n), although only the units that eat, spawn or perform an
+operation change their balance. A BalanceIndex keeps the units sorted between
+steps as a list of entries:
+
+    (key, tie, name, unit state)
+
+where key is the balance, negated for descending order. Units are refiled
+only when their key changes: order() drops their old entries, sorts the
+refiled ones and merges them into the rest, which are still in order, so the
+work per step is a linear merge plus O(k log k) for the k refiled units.
+
+In the exact order, tie is the unit name, which keeps the entries in a
+definite order, but units with equal balances are visited in the order of
+the units dictionary, as a stable sort of its items would visit them: order()
+puts every run of equal keys in that order, at the cost of a pass over the
+dictionary in the steps that have such runs. With name_ties, they are visited
+in order of name instead, as the event scheduler always visits them and the
+array store does with name_ties (see econo.store), so that every unit storage
+and schedule visits the units in the same order.
+
+With a resolution, the order is approximate: balances are rounded down to
+multiples of the resolution before they are compared, so units whose balance
+moves within the same multiple keep their place, and units with balances in
+the same multiple are visited in the order they were filed: tie is then a
+filing sequence number.
+
+The direction of the order is the 'order' system parameter, descending (the
+richest unit first) or ascending, and the resolution is 'order_resolution'
+(0.0 for the exact order). Only step_time keeps a BalanceIndex: the event
+scheduler and the array store sort just the units due to act, by their exact
+balance, in the given direction.
+"""
+import logging; logger = logging.getLogger(__name__)
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import count
+from math import floor
+
+ORDERS = ['descending', 'ascending']
+
+class BalanceIndex(object):
+    """
+    Units sorted by balance, refiled as their balances change
+    """
+    def __init__(self, units, order='descending', resolution=0.0,
+            name_ties=False):
+        if order not in ORDERS:
+            raise ValueError('unit order neither descending nor ascending')
+        self.sign = -1.0 if order == 'descending' else 1.0
+        self.resolution = resolution
+        self.units = units
+        self.name_ties = name_ties
+        self.seq = count()
+        self.entries = []
+        self.keys = {}
+        self.pending = {}
+        self.stale = set()
+        self.counts = defaultdict(int)
+        self.tied = set()
+        for unit_state in units.itervalues():
+            self.file(unit_state)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key(self, balance):
+        """
+        Compute the sort key of a balance
+        """
+        if self.resolution:
+            return self.sign * floor(balance / self.resolution)
+        return self.sign * balance
+
+    def file(self, unit_state):
+        """
+        File a new unit, or refile a unit whose balance may have changed
+        """
+        name = unit_state['name']
+        key = self.key(unit_state['balance'])
+        if name in self.keys:
+            if self.keys[name] == key:
+                return
+            self.stale.add(name)
+            self.uncount(self.keys[name])
+        self.keys[name] = key
+        self.count(key)
+        tie = next(self.seq) if self.resolution else name
+        self.pending[name] = (key, tie, name, unit_state)
+
+    def remove(self, unit_state):
+        """
+        Forget a unit that has died
+        """
+        name = unit_state['name']
+        key = self.keys.pop(name, None)
+        if key is not None:
+            self.stale.add(name)
+            self.pending.pop(name, None)
+            self.uncount(key)
+
+    def count(self, key):
+        """
+        Count a unit filed under a key, noting keys shared by several units
+        """
+        self.counts[key] += 1
+        if self.counts[key] == 2:
+            self.tied.add(key)
+
+    def uncount(self, key):
+        """
+        Forget a unit filed under a key
+        """
+        self.counts[key] -= 1
+        if self.counts[key] == 1:
+            self.tied.discard(key)
+        elif not self.counts[key]:
+            del self.counts[key]
+
+    def order(self):
+        """
+        Merge the refiled units into the index and return its entries, in
+        order
+        """
+        entries = self.entries
+        if self.stale:
+            stale = self.stale
+            entries = [entry for entry in entries if entry[2] not in stale]
+            self.stale = set()
+        if self.pending:
+            entries.extend(sorted(self.pending.itervalues()))
+            entries.sort()
+            self.pending = {}
+        self.entries = entries
+        if self.tied and not (self.resolution or self.name_ties):
+            self.order_ties(entries)
+        return entries
+
+    def order_ties(self, entries):
+        """
+        Put every run of entries with equal keys in the order of the units
+        dictionary, in place. The next merge sorts them back by name.
+        """
+        runs = []
+        names = set()
+        for key in self.tied:
+            start = stop = bisect_left(entries, (key,))
+            while stop < len(entries) and entries[stop][0] == key:
+                stop += 1
+            runs.append((start, stop))
+            names.update(entry[2] for entry in entries[start:stop])
+        rank = dict((name, i) for i, name in
+                    enumerate(name for name in self.units if name in names))
+        for start, stop in runs:
+            entries[start:stop] = sorted(entries[start:stop],
+                                         key=lambda entry: rank[entry[2]])
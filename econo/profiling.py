@@ -0,0 +1,122 @@
+"""
+econo.profiling -- per-phase timers and counters for the step loop
+
+A Profiler is passed to the step functions through their profiler argument
+and accumulates wall-clock time per phase:
+
+    order: building and sorting the list of units to visit
+    eat, spawn: quoting and buying food and babykits
+    choose: pricing ops and choosing one (choose_op)
+    perform: trading and updating the unit (perform_op)
+    age: aging, busy countdown and deaths
+    stats: aggregating the per-career statistics
+    inflate: inflating the market
+
+and counts of events:
+
+    units: units present at the start of each step
+    choices: op choices made by idle units
+    ops: ops priced while choosing; with a quote cache, only the ops whose
+        quotes were recomputed, and with op bounds, only those the bound did
+        not rule out
+    quotes: resource price quotes issued (eating, spawning, op pricing and op
+        bounds), as counted by choose_op; quotes reused from a quote cache or
+        a compiled op table are not issued again
+    births, deaths, starvations
+
+The units that were skipped as busy are units minus choices. Time spent in
+the step loop outside these phases, such as the busy countdown and aging of
+the dict stores, is reported as other. When the
+profiler argument is None the step functions skip all of this; the checks sit
+only on the branches where a unit eats, spawns, chooses an op or dies, so
+disabled profiling costs nothing measurable.
+
+A Profiler is also a sink (see econo.metrics): attached to a Simulation, it
+logs a sample of the phase times and counts every sample_every steps, and a
+summary table when closed.
+"""
+import logging; logger = logging.getLogger(__name__)
+from timeit import default_timer as clock
+
+PHASES = ['order', 'eat', 'spawn', 'choose', 'perform', 'age', 'stats',
+          'inflate']
+COUNTERS = ['units', 'choices', 'ops', 'quotes', 'births', 'deaths',
+            'starvations']
+
+class Profiler(object):
+    """
+    Accumulator of per-phase times and event counts
+    """
+    def __init__(self, sample_every=0):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.steps = 0
+        self.elapsed = 0.0
+        self.sample_every = sample_every
+        self.last_sample = (dict(self.times), dict(self.counts))
+
+    def lap(self, phase, start):
+        """
+        Charge the time since start to a phase and return the current time
+        """
+        now = clock()
+        self.times[phase] += now - start
+        return now
+
+    def count(self, counter, n=1):
+        """
+        Add to an event counter
+        """
+        self.counts[counter] += n
+
+    def choice(self, priced, quotes, n=1):
+        """
+        Count n op choices, which priced a total of priced ops and issued
+        quotes resource price quotes (see choose_op)
+        """
+        self.counts['choices'] += n
+        self.counts['ops'] += priced
+        self.counts['quotes'] += quotes
+
+    def record(self, t, sim):
+        """
+        Count a step and log a sample every sample_every steps
+        """
+        self.steps += 1
+        if self.sample_every and self.steps % self.sample_every == 0:
+            times, counts = self.last_sample
+            logger.info('t=%06d: profile: %s', t, ', '.join(
+                ['%s %.4fs' % (phase, self.times[phase] - times[phase])
+                 for phase in PHASES] +
+                ['%s %d' % (counter, self.counts[counter] - counts[counter])
+                 for counter in COUNTERS]))
+            self.last_sample = (dict(self.times), dict(self.counts))
+
+    def summary(self):
+        """
+        Format the accumulated times and counts as a table
+        """
+        steps = max(self.steps, 1)
+        times = dict(self.times,
+                     other=max(0.0, self.elapsed - sum(self.times.values())))
+        total = sum(times.values()) or 1.0
+        lines = ['%-12s %12s %8s %14s' % ('phase', 'seconds', 'share',
+                                          'ms/step')]
+        for phase in PHASES + ['other']:
+            lines.append('%-12s %12.4f %7.1f%% %14.4f' % (
+                phase, times[phase], 100.0 * times[phase] / total,
+                1000.0 * times[phase] / steps))
+        lines.append('%-12s %12s %8s %14s' % ('counter', 'total', '',
+                                              'per step'))
+        counts = dict(self.counts,
+                      busy=self.counts['units'] - self.counts['choices'])
+        for counter in COUNTERS + ['busy']:
+            lines.append('%-12s %12d %8s %14.2f' % (
+                counter, counts[counter], '', counts[counter] / float(steps)))
+        return '\n'.join(lines)
+
+    def close(self):
+        """
+        Log the summary table
+        """
+        logger.info('profile over %d steps:\n%s', self.steps, self.summary())
@@ -0,0 +1,312 @@
+"""
+econo.region -- regional economies that trade with each other every few steps
+
+A region is a complete economy, with its own market and population, read from
+its own description. Regions step independently for an epoch of
+exchange_every steps, each in its own worker process, and only trade at the
+end of every epoch: for every resource traded in all regions, goods move one
+unit at a time from the region where the resource is cheapest to buy to the
+region where it sells for the most, until no region can sell a unit for more
+than it costs in another, or max_trade units of the resource have moved.
+Every unit moved is bought from the market of the exporting region and sold
+into the market of the importing region, so it moves their deltas and their
+bought and sold counts as the trades of units do.
+
+When no region's price of a resource falls as its delta grows, exchange()
+does not move the units one by one: while the same two regions would keep
+trading, it finds how many units they trade, by bisecting on quantity, and
+moves them in one purchase and one sale. Two regions trade once, and more
+regions once for every change of the cheapest or the dearest region, with the
+same result as moving unit by unit. A resource whose price can fall in some
+region is still moved unit by unit.
+
+Regions seed the random number generator with seed plus their position and
+start from the unit id table of their own description. Both are kept per
+region, so running every region in turn in the main process gives the same
+trajectories as running them in workers.
+"""
+import logging; logger = logging.getLogger(__name__)
+from collections import defaultdict
+from multiprocessing import Pipe, Process
+import os
+import random
+
+from .market import ask_at, bid_at, buy, sell, series_price
+from .unit import parse_unit_ids, save_unit_ids
+
+class Region(object):
+    """
+    A Simulation with its own unit id table and random number generator state,
+    so that several regions can take turns in one process. Create it right
+    after loading the simulation, while the unit id table is its own.
+    """
+    def __init__(self, name, sim, seed):
+        self.name = name
+        self.sim = sim
+        self.unit_ids = save_unit_ids()
+        state = random.getstate()
+        random.seed(seed)
+        self.random_state = random.getstate()
+        random.setstate(state)
+
+    def run(self, steps):
+        """
+        Step the region a number of times and return its report
+        """
+        parse_unit_ids(self.unit_ids)
+        state = random.getstate()
+        random.setstate(self.random_state)
+        for step in xrange(steps):
+            self.sim.step()
+        self.random_state = random.getstate()
+        random.setstate(state)
+        self.unit_ids = save_unit_ids()
+        return self.report()
+
+    def report(self):
+        """
+        Summarize the state of the region, including a copy of its market
+        """
+        sim = self.sim
+        return dict(name=self.name, t=sim.t, population=sim.population(),
+                    market=dict((resource, dict(rec))
+                                for resource, rec in sim.market.iteritems()),
+                    careers=dict((career, dict(career_rec['stats']))
+                                 for career, career_rec
+                                 in sim.careers.iteritems()))
+
+    def save(self):
+        """
+        Close the region and rewrite it into a description
+        """
+        parse_unit_ids(self.unit_ids)
+        self.sim.close()
+        return self.sim.save()
+
+def exchange(markets, max_trade=10000):
+    """
+    Trade the resources common to several markets between them, updating the
+    markets in place. Returns, for every market, a dictionary mapping each
+    resource to the number of units exported and imported.
+    """
+    trades = [defaultdict(lambda: [0, 0]) for market in markets]
+    if len(markets) < 2:
+        return trades
+    shared = set(markets[0])
+    for market in markets[1:]:
+        shared.intersection_update(market)
+    for resource in sorted(shared):
+        moved = 0
+        lots = all(nondecreasing(market[resource]) for market in markets)
+        asks = [(ask_at(market, resource), i)
+                for i, market in enumerate(markets)]
+        bids = [(bid_at(market, resource), -i)
+                for i, market in enumerate(markets)]
+        while moved < max_trade:
+            ask, source = min(asks)
+            bid, dest = max(bids)
+            dest = -dest
+            if source == dest or bid <= ask:
+                break
+            qty = 1
+            if lots:
+                other_ask = min([ask for ask in asks
+                                 if ask[1] not in (source, dest)] +
+                                [(float('inf'), len(markets))])
+                other_bid = max([bid for bid in bids
+                                 if -bid[1] not in (source, dest)] +
+                                [(float('-inf'), 1)])
+                qty = lot_size(markets[source][resource],
+                               markets[dest][resource], other_ask, other_bid,
+                               source, dest, max_trade - moved)
+            buy(markets[source], resource, qty=qty)
+            sell(markets[dest], resource, qty=qty)
+            trades[source][resource][0] += qty
+            trades[dest][resource][1] += qty
+            moved += qty
+            # Only the quotes of the two markets traded in have changed
+            for i in (source, dest):
+                asks[i] = (ask_at(markets[i], resource), i)
+                bids[i] = (bid_at(markets[i], resource), -i)
+    return trades
+
+def nondecreasing(rec):
+    """
+    Check that the price of a resource never falls as its delta grows
+    """
+    if rec['type'] == 'linear':
+        return rec['rate'] >= 0.0
+    return rec['initial'] >= 0.0 and rec['rate'] >= 1.0
+
+def unit_price(rec, delta):
+    """
+    Compute the price of the single unit of a resource at a delta, as ask_at
+    quotes it at that delta and bid_at at the next, or infinity if it is too
+    large for a float
+    """
+    try:
+        return series_price(rec['type'], rec['initial'], rec['rate'], delta,
+                            delta + 1)
+    except OverflowError:
+        return float('inf')
+
+def lot_size(source, dest, other_ask, other_bid, i, j, limit):
+    """
+    Count the units, up to limit, that the unit by unit exchange moves in a
+    row from the market record source, of the i-th market, to dest, of the
+    j-th, whose prices must not fall as their deltas grow: while the unit
+    bought from source is cheaper than the unit sold to dest, and than the
+    cheapest (ask, index) other_ask of the other markets, and the unit sold
+    to dest beats the best (bid, -index) other_bid of the others. The first
+    unit must qualify. Moving units only raises the asks of source and
+    lowers the bids of dest, so once a unit fails, every later unit does.
+    """
+    def moves(n):
+        ask = (unit_price(source, source['delta'] + n), i)
+        bid = (unit_price(dest, dest['delta'] - 1 - n), -j)
+        return bid[0] > ask[0] and ask < other_ask and bid > other_bid
+
+    # Double the lot until a unit fails, then bisect for the first that does
+    lo, hi = 1, 2
+    while hi < limit and moves(hi - 1):
+        lo, hi = hi, 2 * hi
+    hi = min(hi, limit)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if moves(mid):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def apply_trades(market, trades):
+    """
+    Apply the exports and imports of a market, as computed by exchange() on a
+    copy of it
+    """
+    for resource, (exported, imported) in trades.iteritems():
+        buy(market, resource, qty=exported)
+        sell(market, resource, qty=imported)
+
+def region_worker(conn, region):
+    """
+    Serve the requests of a Regions for one region
+    """
+    while True:
+        request = conn.recv()
+        if request[0] == 'run':
+            try:
+                result = region.run(request[1])
+            except Exception as exc:
+                result = exc
+            conn.send(result)
+        elif request[0] == 'trade':
+            apply_trades(region.sim.market, request[1])
+        elif request[0] == 'save':
+            conn.send(region.save())
+            break
+    conn.close()
+
+def region_names(paths):
+    """
+    Name regions after the base names of their description files, numbering
+    repeated names
+    """
+    names = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in names:
+            name = '%s_%d' % (name, len(names))
+        names.append(name)
+    return names
+
+class Regions(object):
+    """
+    Several regions, each stepped in its own worker process, or in turn in the
+    main process when serial
+    """
+    def __init__(self, regions, exchange_every=10, max_trade=10000,
+            serial=False):
+        if exchange_every < 1:
+            raise ValueError('exchange interval is not positive')
+        self.regions = regions
+        self.exchange_every = exchange_every
+        self.max_trade = max_trade
+        self.traded = 0
+        self.workers = []
+        if serial:
+            return
+        for region in self.regions:
+            conn, worker_conn = Pipe()
+            worker = Process(target=region_worker, args=(worker_conn, region))
+            worker.daemon = True
+            worker.start()
+            worker_conn.close()
+            self.workers.append((worker, conn))
+
+    def run(self, steps):
+        """
+        Step every region a number of times and return their reports
+        """
+        if not self.workers:
+            return [region.run(steps) for region in self.regions]
+        for worker, conn in self.workers:
+            conn.send(('run', steps))
+        reports = [conn.recv() for worker, conn in self.workers]
+        for report in reports:
+            if isinstance(report, Exception):
+                raise report
+        return reports
+
+    def epoch(self, steps=None):
+        """
+        Step every region for an epoch, then trade between them. Returns the
+        reports of the regions, as of after the trade.
+        """
+        reports = self.run(steps or self.exchange_every)
+        markets = [report['market'] for report in reports]
+        trades = exchange(markets, max_trade=self.max_trade)
+        for i, region in enumerate(self.regions):
+            if self.workers:
+                self.workers[i][1].send(('trade', dict(trades[i])))
+            else:
+                apply_trades(region.sim.market, trades[i])
+            reports[i]['traded'] = sum(exported for exported, imported
+                                       in trades[i].itervalues())
+        self.traded += sum(report['traded'] for report in reports)
+        return reports
+
+    def save(self):
+        """
+        Stop the workers and rewrite every region into a description, in a
+        dictionary keyed by region name
+        """
+        if not self.workers:
+            return dict((region.name, region.save())
+                        for region in self.regions)
+        for worker, conn in self.workers:
+            conn.send(('save',))
+        descriptions = [conn.recv() for worker, conn in self.workers]
+        for worker, conn in self.workers:
+            conn.close()
+            worker.join()
+        self.workers = []
+        return dict((region.name, description)
+                    for region, description
+                    in zip(self.regions, descriptions))
+
+def combined_report(reports):
+    """
+    Combine the reports of the regions into totals over all regions and the
+    range of the price of every common resource
+    """
+    shared = set(reports[0]['market'])
+    for report in reports[1:]:
+        shared.intersection_update(report['market'])
+    prices = {}
+    for resource in sorted(shared):
+        asks = [ask_at(report['market'], resource) for report in reports]
+        prices[resource] = (min(asks), max(asks))
+    return dict(population=sum(report['population'] for report in reports),
+                traded=sum(report.get('traded', 0) for report in reports),
+                prices=prices)
@@ -0,0 +1,240 @@
+"""
+econo.schedule -- event-driven stepping of unit populations
+
+step_time visits every unit on every step, although most units are only
+counting down their busy time or waiting for their eat or spawn phase. A
+Scheduler instead files each unit in a calendar bucket under the next step at
+which it has something to do:
+
+    wake: the first step at which the unit is no longer busy
+    eat: the next step at which age == eat_phase (mod eat_every)
+    spawn: the next step at which age == spawn_phase (mod spawn_every)
+    death: the step at the end of which the unit reaches max_age
+
+Each step then only visits the units in its bucket. Age and busy time become
+implicit: the scheduler records the step at which each unit was born (age 0)
+and the step at which it wakes, and writes the derived age and busy values
+back into a unit's state whenever it visits the unit or is synchronized.
+"""
+import logging; logger = logging.getLogger(__name__)
+from collections import defaultdict
+from timeit import default_timer as clock
+
+from .market import buy, ask_at
+from .unit import (choose_op, career_ops, perform_op, spawn_unit, reset_stats,
+        finish_stats)
+
+class Scheduler(object):
+    """
+    Calendar of pending unit events, usable in place of step_time
+    """
+    def __init__(self):
+        self.t = None
+        self.born = {}
+        self.wake = {}
+        self.due_at = {}
+        self.calendar = defaultdict(list)
+        self.totals = {}
+
+    def start(self, t, careers, units, max_age, eat_every, spawn_every):
+        """
+        File every unit in the calendar as of the start of step t
+        """
+        self.t = t
+        self.max_age = max_age
+        self.eat_every = eat_every
+        self.spawn_every = spawn_every
+        for career in careers:
+            self.totals[career] = dict(population=0, born=0, balance=0.0)
+        for name, unit_state in units.iteritems():
+            self.add(t, unit_state, t - unit_state['age'],
+                     t + unit_state['busy'])
+
+    def add(self, t, unit_state, born, wake):
+        """
+        Register a unit that exists at the start of step t
+        """
+        name = unit_state['name']
+        self.born[name] = born
+        self.wake[name] = wake
+        totals = self.totals[unit_state['career']]
+        totals['population'] += 1
+        totals['born'] += born
+        totals['balance'] += unit_state['balance']
+        self.schedule(t, unit_state)
+
+    def remove(self, unit_state):
+        """
+        Forget a unit that has died
+        """
+        name = unit_state['name']
+        totals = self.totals[unit_state['career']]
+        totals['population'] -= 1
+        totals['born'] -= self.born.pop(name)
+        totals['balance'] -= unit_state['balance']
+        self.wake.pop(name)
+        self.due_at.pop(name)
+
+    def next_event(self, t, unit_state):
+        """
+        Compute the first step at or after t at which a unit must be visited
+        """
+        name = unit_state['name']
+        age = t - self.born[name]
+        eat = t + (unit_state['eat_phase'] - age) % self.eat_every
+        spawn = t + (unit_state['spawn_phase'] - age) % self.spawn_every
+        death = max(t, self.born[name] + self.max_age - 1)
+        return min(max(t, self.wake[name]), eat, spawn, death)
+
+    def schedule(self, t, unit_state):
+        """
+        File a unit under its next event at or after step t
+        """
+        due = self.next_event(t, unit_state)
+        self.due_at[unit_state['name']] = due
+        self.calendar[due].append(unit_state['name'])
+
+    def sync(self, units):
+        """
+        Write the implicit age and busy time of every unit into its state, as
+        of the start of the next step
+        """
+        for name, unit_state in units.iteritems():
+            unit_state['age'] = self.t - self.born[name]
+            unit_state['busy'] = max(0, self.wake[name] - self.t)
+
+    def step(self, t, market, careers, units, rate, min_balance=-100,
+            max_age=1000, eat_every=100, spawn_every=200, order='descending',
+            quote_cache=None, op_bounds=None, profiler=None, changes=None):
+        """
+        Advance the units by one time step with the same rules as
+        econo.unit.step_time, visiting only the units with an event due.
+        Changes are recorded as step_time does.
+        """
+        if self.t is None:
+            self.start(t, careers, units, max_age, eat_every, spawn_every)
+        assert t == self.t, "Steps must be taken in order"
+
+        # Reset aggregate statistics
+        spawn = reset_stats(careers)
+
+        # Iterate over the due units in order of balance, breaking ties by name
+        if profiler is not None:
+            start = clock()
+            profiler.count('units', len(units))
+        names = sorted(name for name in set(self.calendar.pop(t, []))
+                       if self.due_at.get(name) == t)
+        unit_list = [(name, units[name]) for name in names]
+        unit_list.sort(key=lambda x: x[1]['balance'],
+                       reverse=(order == 'descending'))
+        newborns = []
+        dead = []
+        if profiler is not None:
+            profiler.lap('order', start)
+        for key, unit_state in unit_list:
+            totals = self.totals[unit_state['career']]
+            balance = unit_state['balance']
+            unit_state['age'] = t - self.born[key]
+            unit_state['busy'] = max(0, self.wake[key] - t)
+
+            # Eat if necessary
+            if (unit_state['age'] % eat_every) == unit_state['eat_phase']:
+                if profiler is not None:
+                    start = clock()
+                cost = ask_at(market, 'food')
+                if (unit_state['balance'] - cost) < min_balance:
+                    logger.debug('unit %(name)r (age %(age)d) starved',
+                                 unit_state)
+                    units.pop(key)
+                    dead.append(unit_state)
+                    if profiler is not None:
+                        profiler.count('starvations')
+                else:
+                    unit_state['balance'] -= cost
+                    buy(market, 'food')
+                if profiler is not None:
+                    profiler.count('quotes')
+                    profiler.lap('eat', start)
+
+            # Spawn if appropriate and able
+            if (unit_state['age'] % spawn_every) == unit_state['spawn_phase']:
+                if profiler is not None:
+                    start = clock()
+                cost = ask_at(market, 'babykits')
+                if (unit_state['balance'] - cost) < min_balance:
+                    logger.debug('unit %(name)r (age %(age)d) could not'
+                                 ' spawn', unit_state)
+                else:
+                    unit_state['balance'] -= cost
+                    buy(market, 'babykits')
+                    newborns.append(spawn_unit(t, careers, units, key,
+                                               eat_every, spawn_every,
+                                               career=spawn))
+                    if profiler is not None:
+                        profiler.count('births')
+                if profiler is not None:
+                    profiler.count('quotes')
+                    profiler.lap('spawn', start)
+
+            # Choose and perform an operation
+            if unit_state['busy'] == 0:
+                if profiler is not None:
+                    start = clock()
+                ops = career_ops(careers[unit_state['career']])
+                max_time = max_age - unit_state['age']
+                op, profit, _, priced, quotes = choose_op(
+                    market, ops, rate, unit_state['balance'], min_balance,
+                    max_time, quote_cache=quote_cache, op_bounds=op_bounds)
+                if profiler is not None:
+                    start = profiler.lap('choose', start)
+                    profiler.choice(priced, quotes)
+                perform_op(market, unit_state, op, profit)
+                careers[unit_state['career']]['stats']['total_profit'] += \
+                        profit
+                self.wake[key] = t + 1 + unit_state['busy']
+                if changes is not None and unit_state['busy']:
+                    changes.change(key)
+                if profiler is not None:
+                    profiler.lap('perform', start)
+            else:
+                unit_state['busy'] -= 1
+            totals['balance'] += unit_state['balance'] - balance
+            if changes is not None and unit_state['balance'] != balance:
+                changes.change(key)
+
+            # Age the unit
+            unit_state['age'] += 1
+            if unit_state['age'] >= max_age:
+                logger.debug('t=%06d: unit %r dies of old age', t, key)
+                if key in units:
+                    units.pop(key)
+                    dead.append(unit_state)
+                    if profiler is not None:
+                        profiler.count('deaths')
+            elif key in units:
+                self.schedule(t + 1, unit_state)
+            if changes is not None and key not in units:
+                changes.remove(key)
+
+        # Compute the aggregate stats of the units present at the start of the
+        # step, which excludes newborns but includes the dead
+        if profiler is not None:
+            start = clock()
+        self.t = t + 1
+        for name in newborns:
+            self.add(t + 1, units[name], t + 1, t + 1)
+            if changes is not None:
+                changes.change(name)
+        for career, totals in self.totals.iteritems():
+            stats = careers[career]['stats']
+            stats['total_balance'] = totals['balance']
+            stats['population'] = totals['population']
+            stats['total_age'] = (totals['population'] * (t + 1) -
+                                  totals['born'])
+        for name in newborns:
+            careers[units[name]['career']]['stats']['population'] -= 1
+        for unit_state in dead:
+            self.remove(unit_state)
+        finish_stats(careers)
+        if profiler is not None:
+            profiler.lap('stats', start)
@@ -0,0 +1,286 @@
+"""
+econo.server -- a resident simulation served over a Unix-domain socket
+
+econo serve parses an economy once and keeps it in memory, so that clients
+can step, inspect and tune it without parsing and dumping the description on
+every run. Clients connect to a Unix-domain socket and exchange JSON objects,
+one per line. Every request has a cmd and may carry an id, which is echoed in
+its reply; replies have ok set to true, or to false with an error message.
+
+    {"cmd": "step", "steps": N}: advance the economy by N steps (default 1)
+        and reply with the new t once they are done
+    {"cmd": "query", "what": W}: reply with the status (t and population,
+        the default), system, market (with the price of every resource),
+        careers (their statistics) or, with "name", a unit
+    {"cmd": "mutate", "params": {NAME: VALUE, ...}}: set system or market
+        parameters, named as for econo sweep (e.g. interest_rate,
+        market.rate, market.food.rate), except t
+    {"cmd": "snapshot", "path": P}: write the economy to P, as a checkpoint
+        if P ends in .npz and as a YAML description otherwise
+    {"cmd": "subscribe"} and {"cmd": "unsubscribe"}: start or stop streaming
+        an event with the market and career metrics of every step
+    {"cmd": "shutdown"}: stop the server once the steps requested so far are
+        done
+
+The server runs one asyncore event loop. Step requests are queued and
+performed one step per turn of the loop, so other requests are answered and
+step events are streamed while a long step request is in progress. A step
+that fails answers its request with the error and drops the rest of it; the
+economy is left as the failed step left it.
+"""
+import logging; logger = logging.getLogger(__name__)
+import asynchat
+import asyncore
+from collections import deque
+from copy import deepcopy
+import json
+import os
+import socket
+import stat
+
+from .market import ask_at, bid_at
+from .metrics import RESOURCE_METRICS, CAREER_METRICS
+from .branch import override_simulation
+from .checkpoint import save_checkpoint
+from .writer import iter_units, write_description
+
+def required(request, key):
+    """
+    Read a field that a request must carry
+    """
+    if key not in request:
+        raise ValueError('request has no %r' % key)
+    return request[key]
+
+class StreamSink(object):
+    """
+    Sink that sends the metrics of every step to the subscribed channels
+    """
+    def __init__(self):
+        self.channels = set()
+
+    def record(self, t, sim):
+        """
+        Send the metrics of time step t to every subscriber
+        """
+        if not self.channels:
+            return
+        market = sim.market
+        event = dict(event='step', t=t, market={}, careers={})
+        for resource, rec in market.iteritems():
+            event['market'][resource] = dict(
+                (metric, ask_at(market, resource) if metric == 'price'
+                         else rec[metric])
+                for metric in RESOURCE_METRICS)
+        for career, career_rec in sim.careers.iteritems():
+            stats = career_rec['stats']
+            event['careers'][career] = dict(
+                (metric, stats.get(metric, 0)) for metric in CAREER_METRICS)
+        for channel in self.channels:
+            channel.send_message(event)
+
+    def close(self):
+        self.channels.clear()
+
+class ServerChannel(asynchat.async_chat):
+    """
+    Connection to one client, reading a request per line
+    """
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.channels)
+        self.server = server
+        self.incoming = []
+        self.set_terminator('\n')
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.incoming)
+        self.incoming = []
+        if line.strip():
+            self.server.handle(self, line)
+
+    def send_message(self, message):
+        self.push(json.dumps(message) + '\n')
+
+    def handle_close(self):
+        self.server.forget(self)
+        self.close()
+
+class SimulationServer(asyncore.dispatcher):
+    """
+    Listening socket and request handlers of a served Simulation
+    """
+    def __init__(self, sim, path):
+        self.channels = {}
+        asyncore.dispatcher.__init__(self, map=self.channels)
+        self.sim = sim
+        self.path = path
+        self.jobs = deque()
+        self.running = True
+        self.sink = StreamSink()
+        sim.sinks.append(self.sink)
+
+        # Replace a stale socket left behind by an earlier server
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.bind(path)
+        self.listen(5)
+        logger.info('serving t=%06d on %s', sim.t, path)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            ServerChannel(pair[0], self)
+
+    def forget(self, channel):
+        """
+        Drop the subscription and pending steps of a closed channel
+        """
+        self.sink.channels.discard(channel)
+        self.jobs = deque(job for job in self.jobs if job[0] is not channel)
+
+    def serve(self):
+        """
+        Run the event loop, stepping the simulation whenever steps are
+        pending, until shut down
+        """
+        try:
+            while self.running or self.jobs:
+                asyncore.loop(timeout=0.0 if self.jobs else 1.0, count=1,
+                              map=self.channels)
+                if self.jobs:
+                    self.advance()
+            # Let the last replies drain
+            while any(channel.producer_fifo for channel
+                      in self.channels.values()
+                      if isinstance(channel, ServerChannel)):
+                asyncore.loop(timeout=0.1, count=1, map=self.channels)
+        finally:
+            self.sim.close()
+            asyncore.close_all(map=self.channels)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def advance(self):
+        """
+        Perform one step of the oldest step request
+        """
+        job = self.jobs[0]
+        try:
+            self.sim.step()
+        except Exception as exc:
+            logger.exception('t=%06d: step failed', self.sim.t)
+            self.jobs.popleft()
+            self.reply(job[0], job[1], ok=False, t=self.sim.t,
+                       error='step failed: %s: %s' % (type(exc).__name__,
+                                                      exc))
+            return
+        job[2] -= 1
+        if job[2] <= 0:
+            self.jobs.popleft()
+            self.reply(job[0], job[1], t=self.sim.t)
+
+    def reply(self, channel, request_id, ok=True, **fields):
+        fields['ok'] = ok
+        if request_id is not None:
+            fields['id'] = request_id
+        channel.send_message(fields)
+
+    def handle(self, channel, line):
+        """
+        Decode and dispatch a request
+        """
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request is not an object')
+            request_id = request.get('id')
+            cmd = required(request, 'cmd')
+            handler = getattr(self, 'cmd_%s' % cmd, None)
+            if handler is None:
+                raise ValueError('unknown command %r' % cmd)
+            fields = handler(channel, request)
+        except (IOError, OSError, KeyError, TypeError, ValueError,
+                ImportError) as exc:
+            logger.warn('request %r failed: %s', line, exc)
+            if isinstance(exc, KeyError):
+                error = 'no such key: %s' % exc
+            else:
+                error = str(exc)
+            self.reply(channel, request_id, ok=False, error=error)
+        else:
+            if fields is not None:
+                self.reply(channel, request_id, **fields)
+
+    def cmd_step(self, channel, request):
+        steps = request.get('steps', 1)
+        if not isinstance(steps, (int, long)) or isinstance(steps, bool):
+            raise ValueError('number of steps is not an integer')
+        if steps < 1:
+            raise ValueError('number of steps is not positive')
+        if not self.running:
+            raise ValueError('the server is shutting down')
+        self.jobs.append([channel, request.get('id'), steps])
+
+    def cmd_query(self, channel, request):
+        sim = self.sim
+        what = request.get('what', 'status')
+        if what == 'status':
+            return dict(t=sim.t, population=len(sim.units),
+                        pending=sum(job[2] for job in self.jobs))
+        elif what == 'system':
+            return dict(system=sim.system)
+        elif what == 'market':
+            market = deepcopy(sim.market)
+            for resource, rec in market.iteritems():
+                rec['ask'] = ask_at(sim.market, resource)
+                rec['bid'] = bid_at(sim.market, resource)
+            return dict(market=market)
+        elif what == 'careers':
+            return dict(careers=dict((career, career_rec['stats'])
+                                     for career, career_rec
+                                     in sim.careers.iteritems()))
+        elif what == 'unit':
+            sim.sync()
+            name = required(request, 'name')
+            if name not in sim.units:
+                raise ValueError('no unit named %r' % name)
+            if sim.unit_store == 'array':
+                return dict(unit=sim.units.unit(sim.units.slots[name]))
+            return dict(unit=sim.units[name])
+        raise ValueError('unknown query %r' % what)
+
+    def cmd_mutate(self, channel, request):
+        params = required(request, 'params')
+        if not isinstance(params, dict):
+            raise ValueError('params is not an object')
+        override_simulation(self.sim, sorted(params.items()))
+        logger.info('t=%06d: parameters changed: %r', self.sim.t, params)
+        return dict(t=self.sim.t)
+
+    def cmd_snapshot(self, channel, request):
+        sim = self.sim
+        path = required(request, 'path')
+        if path.endswith('.npz'):
+            save_checkpoint(path, sim)
+        else:
+            sections = sim.save_header()
+            with open(path, 'w') as out:
+                write_description(out, sections, iter_units(sim.units))
+        return dict(t=sim.t, path=path)
+
+    def cmd_subscribe(self, channel, request):
+        self.sink.channels.add(channel)
+        return dict(t=self.sim.t)
+
+    def cmd_unsubscribe(self, channel, request):
+        self.sink.channels.discard(channel)
+        return dict(t=self.sim.t)
+
+    def cmd_shutdown(self, channel, request):
+        self.running = False
+        return dict(t=self.sim.t)
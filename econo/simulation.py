@@ -0,0 +1,331 @@
+"""
+econo.simulation -- a complete economy and the loop that advances it
+
+A Simulation bundles everything needed to continue a run: the system
+configuration, the market, the careers, the units (a dictionary or a
+UnitStore) and the step function chosen for them. Its step() method performs
+one iteration of the main loop: step the units, then inflate the market by the
+resulting population. Sinks (see econo.metrics) attached to a Simulation are
+fed after every step. A Profiler (see econo.profiling) attached with profile()
+is passed on to the step function and also times the inflation of the market.
+A Tracer (see econo.trace) attached with trace() follows a sample of units
+through the scan schedule. A JournalSink (see econo.journal) attached with
+journal() is told which units every step changed. With clearing, an array
+store is stepped by batch market clearing (see econo.clearing), in
+clearing_rounds rounds per step, by clearing_jobs worker processes; its units
+are then only brought up to date by sync(). With name_ties, the scan schedule
+and the array store visit units with equal balances in order of name, as the
+event scheduler does, rather than in the order of their storage.
+"""
+import logging; logger = logging.getLogger(__name__)
+from timeit import default_timer as clock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .market import inflate, parse_market, save_market, QuoteCache
+from .unit import (parse_careers, parse_units, step_time, save_careers,
+        save_units, parse_unit_ids, save_unit_ids, CareerTotals, quiet_steps,
+        fast_forward_units)
+from .store import (UnitStore, parse_unit_store, save_unit_store, step_store,
+        quiet_store_steps, fast_forward_store)
+from .schedule import Scheduler
+from .bound import OpBounds
+from .order import ORDERS, BalanceIndex
+from .optable import compile_ops
+from .clearing import Clearing
+
+def parse_system(config_system):
+    """
+    Validate a dictionary describing the system configuration
+    """
+    if not isinstance(config_system, dict):
+        raise ValueError('system configuration is not a dictionary')
+    if not isinstance(config_system['t'], int):
+        raise ValueError('iteration number t is not an integer')
+    if not isinstance(config_system['interest_rate'], float):
+        raise ValueError('interest rate is not a float')
+    if not isinstance(config_system['min_balance'], float):
+        raise ValueError('minimum balance is not a float')
+    if not isinstance(config_system['max_age'], int):
+        raise ValueError('maximum age is not an integer')
+    elif config_system['max_age'] < 1:
+        raise ValueError('maximum age is not positive')
+    if not isinstance(config_system['eat_every'], int):
+        raise ValueError('eat interval is not an integer')
+    elif config_system['eat_every'] < 1:
+        raise ValueError('eat interval is not positive')
+    if not isinstance(config_system['spawn_every'], int):
+        raise ValueError('spawn interval is not an integer')
+    elif config_system['spawn_every'] < 1:
+        raise ValueError('spawn interval is not positive')
+    if 'order' not in config_system:
+        config_system['order'] = 'descending'
+    elif config_system['order'] not in ORDERS:
+        raise ValueError('unit order neither descending nor ascending')
+    if 'order_resolution' not in config_system:
+        config_system['order_resolution'] = 0.0
+    elif not isinstance(config_system['order_resolution'], float):
+        raise ValueError('order resolution is not a float')
+    elif config_system['order_resolution'] < 0.0:
+        raise ValueError('order resolution is negative')
+    return config_system
+
+class Simulation(object):
+    """
+    A parsed economy, ready to be stepped
+    """
+    def __init__(self, system, market, careers, units, schedule='scan',
+            quote_cache=False, bound_ops=False, batch_ops=False,
+            clearing=False, clearing_jobs=1, clearing_rounds=1,
+            name_ties=False):
+        self.system = system
+        self.market = market
+        self.careers = careers
+        self.units = units
+        self.t = system['t']
+        self.sinks = []
+        self.profiler = None
+
+        # Choose the step function for the unit storage and schedule
+        self.scheduler = None
+        self.totals = None
+        self.index = None
+        self.clearing = None
+        if clearing:
+            if not isinstance(units, UnitStore):
+                raise ValueError('batch clearing requires the array unit'
+                                 ' store')
+            if schedule == 'events' or batch_ops:
+                raise ValueError('batch clearing replaces the event scheduler'
+                                 ' and batched op choice')
+            if not all('table' in career_rec
+                       for career_rec in careers.itervalues()):
+                compile_ops(careers, market)
+            self.clearing = Clearing(careers, units, jobs=clearing_jobs,
+                                     rounds=clearing_rounds)
+            self.step_units = self.clearing.step
+        elif isinstance(units, UnitStore):
+            if schedule == 'events':
+                raise ValueError('the event scheduler requires the dict unit'
+                                 ' store')
+            self.step_units = step_store
+        elif schedule == 'events':
+            if batch_ops:
+                raise ValueError('batched op choice requires the scan'
+                                 ' schedule')
+            self.scheduler = Scheduler()
+            self.step_units = self.scheduler.step
+        else:
+            self.totals = CareerTotals(careers, units)
+            self.index = BalanceIndex(units, order=system['order'],
+                                      resolution=system['order_resolution'],
+                                      name_ties=name_ties)
+            self.step_units = step_time
+        self.step_options = {}
+        if name_ties and self.step_units is step_store:
+            self.step_options['name_ties'] = True
+        if self.totals is not None:
+            self.step_options['totals'] = self.totals
+            self.step_options['index'] = self.index
+        if quote_cache and self.clearing is None:
+            self.step_options['quote_cache'] = QuoteCache()
+        if bound_ops and self.clearing is None:
+            self.step_options['op_bounds'] = OpBounds()
+        if batch_ops:
+            if numpy is None:
+                raise ImportError('batched op choice requires numpy')
+            self.step_options['batch_ops'] = True
+
+    @property
+    def unit_store(self):
+        return 'array' if isinstance(self.units, UnitStore) else 'dict'
+
+    def population(self):
+        """
+        Count the units present at the start of the last step
+        """
+        if self.totals is not None:
+            return self.totals.present
+        population = 0
+        for career_rec in self.careers.values():
+            population += career_rec['stats']['population']
+        return population
+
+    def profile(self, profiler):
+        """
+        Attach a Profiler to the step loop and to the sinks
+        """
+        self.profiler = profiler
+        self.step_options['profiler'] = profiler
+        self.sinks.append(profiler)
+
+    def trace(self, tracer):
+        """
+        Attach a Tracer to the step loop and to the sinks. Only the scan
+        schedule over the dict unit store, without batched op choice, records
+        unit events.
+        """
+        if self.step_units is not step_time or self.step_options.get(
+                'batch_ops'):
+            raise ValueError('unit tracing requires the scan schedule and'
+                             ' the dict unit store, without batched op'
+                             ' choice')
+        self.step_options['tracer'] = tracer
+        self.sinks.append(tracer)
+
+    def journal(self, sink):
+        """
+        Attach a JournalSink (see econo.journal), whose UnitChanges the step
+        functions fill in with the units they change
+        """
+        self.step_options['changes'] = sink.changes
+        self.sinks.append(sink)
+
+    def step(self):
+        """
+        Simulate one time step and return its iteration number
+        """
+        t = self.t
+        system = self.system
+        profiler = self.profiler
+        if profiler is not None:
+            step_start = clock()
+        self.step_units(t, self.market, self.careers, self.units,
+                        system['interest_rate'],
+                        min_balance=system['min_balance'],
+                        max_age=system['max_age'],
+                        eat_every=system['eat_every'],
+                        spawn_every=system['spawn_every'],
+                        order=system['order'],
+                        **self.step_options)
+        if profiler is not None:
+            start = clock()
+        inflate(self.market, self.population())
+        if profiler is not None:
+            profiler.elapsed += profiler.lap('inflate', start) - step_start
+        self.t = t + 1
+        for sink in self.sinks:
+            sink.record(t, self)
+        return t
+
+    def close(self):
+        """
+        Close the attached sinks, and stop any clearing workers
+        """
+        for sink in self.sinks:
+            sink.close()
+        if self.clearing is not None:
+            self.units = self.clearing.collect()
+            self.clearing.close()
+
+    def sync(self):
+        """
+        Bring the units up to date with the current time step
+        """
+        if self.scheduler is not None and self.scheduler.t is not None:
+            self.scheduler.sync(self.units)
+        if self.clearing is not None:
+            self.units = self.clearing.collect()
+
+    def refresh(self):
+        """
+        Rebuild everything derived from the system and market parameters,
+        after they were changed in place between steps
+        """
+        if self.clearing is not None and self.clearing.workers:
+            raise ValueError('parameters cannot change while clearing'
+                             ' workers hold the op tables')
+        if any('table' in career_rec
+               for career_rec in self.careers.itervalues()):
+            compile_ops(self.careers, self.market)
+        for career_rec in self.careers.itervalues():
+            career_rec.pop('batch_table', None)
+        if self.scheduler is not None:
+            self.sync()
+            self.scheduler = Scheduler()
+            self.step_units = self.scheduler.step
+        if self.index is not None:
+            self.index = BalanceIndex(self.units, order=self.system['order'],
+                                      resolution=self.system[
+                                          'order_resolution'],
+                                      name_ties=self.index.name_ties)
+            self.step_options['index'] = self.index
+        if 'quote_cache' in self.step_options:
+            self.step_options['quote_cache'] = QuoteCache()
+        if 'op_bounds' in self.step_options:
+            self.step_options['op_bounds'] = OpBounds()
+
+    def save(self):
+        """
+        Rewrite the simulation into a description that can be serialized, as
+        of the start of the next time step, which it stores as system.t
+        """
+        description = self.save_header()
+        if self.unit_store == 'array':
+            description['units'] = save_unit_store(self.units)
+        else:
+            description['units'] = save_units(self.units)
+        return description
+
+    def fast_forward(self, limit):
+        """
+        Skip up to limit time steps in which no unit eats, spawns, chooses an
+        operation or dies, with the same result as stepping through them, and
+        return the number of steps skipped. Steps are only skipped by the scan
+        schedule and the array store, without batch clearing, and never while
+        sinks are attached, since they record every step.
+        """
+        if (limit <= 0 or self.sinks or self.scheduler is not None or
+                self.clearing is not None):
+            return 0
+        system = self.system
+        options = dict(max_age=system['max_age'],
+                       eat_every=system['eat_every'],
+                       spawn_every=system['spawn_every'])
+        if self.unit_store == 'array':
+            steps = quiet_store_steps(self.units, limit, **options)
+            if steps:
+                fast_forward_store(self.careers, self.units, steps)
+        else:
+            steps = quiet_steps(self.units, limit, **options)
+            if steps:
+                fast_forward_units(self.careers, self.units, self.totals,
+                                   steps)
+        if steps:
+            inflate(self.market, self.population(), steps=steps)
+            logger.debug('t=%06d: skipped %d quiet steps', self.t, steps)
+            self.t += steps
+        return steps
+
+    def save_header(self):
+        """
+        Rewrite every section of the description but the units, which
+        econo.writer streams out separately, with system.t set to the next
+        time step
+        """
+        self.sync()
+        self.system['t'] = self.t
+        return dict(system=self.system,
+                    market=save_market(self.market),
+                    careers=save_careers(self.careers),
+                    next_unit_ids=save_unit_ids())
+
+def parse_simulation(description, unit_store='dict', compile_ops=False,
+        **options):
+    """
+    Convert a dictionary describing an economy into a Simulation. Other
+    keyword arguments are passed on to Simulation.
+    """
+    system = parse_system(description.get('system', None))
+    market = parse_market(description.get('market', None))
+    careers = parse_careers(description.get('careers', None), market,
+                            compiled=compile_ops)
+    if unit_store == 'array':
+        units = parse_unit_store(description.get('units', None), careers)
+    else:
+        units = parse_units(description.get('units', None), careers)
+    parse_unit_ids(description.get('next_unit_ids', None))
+    return Simulation(system, market, careers, units, **options)
@@ -0,0 +1,391 @@
+"""
+econo.store -- array-backed storage for large unit populations
+
+A UnitStore holds the same per-unit state as the units dictionary described in
+econo.unit, but as parallel NumPy columns indexed by slot:
+
+    age, busy, eat_phase, spawn_phase: (int64 arrays)
+    balance: (float64 array)
+    career: (int32 array) index into UnitStore.career_names
+    alive: (bool array) whether the slot currently holds a unit
+    names: (list) the name of the unit in each slot
+
+Slots vacated by deaths are reused by later births, so the columns only grow
+when the population reaches a new peak.
+"""
+import logging; logger = logging.getLogger(__name__)
+from random import randint
+from timeit import default_timer as clock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .market import buy, ask_at
+from .unit import (choose_op, career_ops, perform_op, perform_batch, new_name,
+        parse_units, reset_stats, finish_stats, spawn_career)
+
+class UnitStore(object):
+    """
+    Struct-of-arrays container for unit state
+    """
+    COLUMNS = [('age', 'int64'), ('busy', 'int64'), ('balance', 'float64'),
+               ('eat_phase', 'int64'), ('spawn_phase', 'int64'),
+               ('career', 'int32'), ('alive', 'bool')]
+
+    def __init__(self, careers, capacity=1024):
+        if numpy is None:
+            raise ImportError('the array unit store requires numpy')
+        self.career_names = sorted(careers.keys())
+        self.career_index = {career: i
+                             for i, career in enumerate(self.career_names)}
+        for column, dtype in self.COLUMNS:
+            setattr(self, column, numpy.zeros(capacity, dtype=dtype))
+        self.names = [None] * capacity
+        self.slots = {}
+        self.free = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, name):
+        return name in self.slots
+
+    @property
+    def capacity(self):
+        return len(self.names)
+
+    def _grow(self):
+        """
+        Double the length of every column
+        """
+        capacity = self.capacity
+        for column, dtype in self.COLUMNS:
+            grown = numpy.zeros(capacity * 2, dtype=dtype)
+            grown[:capacity] = getattr(self, column)
+            setattr(self, column, grown)
+        self.names.extend([None] * capacity)
+
+    def add(self, name, career, age=0, busy=0, balance=0.0, eat_phase=0,
+            spawn_phase=0):
+        """
+        Store a new unit, reusing a free slot if one is available
+        """
+        if self.free:
+            slot = self.free.pop()
+        else:
+            if self.size == self.capacity:
+                self._grow()
+            slot = self.size
+            self.size += 1
+        self.age[slot] = age
+        self.busy[slot] = busy
+        self.balance[slot] = balance
+        self.eat_phase[slot] = eat_phase
+        self.spawn_phase[slot] = spawn_phase
+        self.career[slot] = self.career_index[career]
+        self.alive[slot] = True
+        self.names[slot] = name
+        self.slots[name] = slot
+        return slot
+
+    def remove(self, slot):
+        """
+        Release the slot held by a unit
+        """
+        self.alive[slot] = False
+        self.slots.pop(self.names[slot])
+        self.names[slot] = None
+        self.free.append(slot)
+
+    def live_slots(self):
+        """
+        Return the slots currently holding units, in slot order
+        """
+        return numpy.flatnonzero(self.alive[:self.size])
+
+    def unit(self, slot):
+        """
+        Return the state of the unit in a slot as a unit dictionary
+        """
+        return dict(age=int(self.age[slot]), busy=int(self.busy[slot]),
+                    career=self.career_names[self.career[slot]],
+                    balance=float(self.balance[slot]),
+                    eat_phase=int(self.eat_phase[slot]),
+                    spawn_phase=int(self.spawn_phase[slot]),
+                    name=self.names[slot])
+
+    def columns(self):
+        """
+        Return the live units as a dictionary of compact columns: names,
+        career indices into career_names, and each numeric state column
+        """
+        live = self.live_slots()
+        columns = dict(names=numpy.array([self.names[slot]
+                                          for slot in live.tolist()]))
+        for column, dtype in self.COLUMNS:
+            if column != 'alive':
+                columns[column] = getattr(self, column)[live]
+        return columns
+
+    @classmethod
+    def from_columns(cls, careers, columns):
+        """
+        Build a UnitStore from the output of columns(), whose career indices
+        must refer to the sorted names of the given careers
+        """
+        count = len(columns['names'])
+        store = cls(careers, capacity=max(1024, 2 * count))
+        for column, dtype in cls.COLUMNS:
+            if column != 'alive':
+                getattr(store, column)[:count] = columns[column]
+        store.alive[:count] = True
+        store.names[:count] = [str(name) for name in columns['names']]
+        store.slots = dict(zip(store.names[:count], xrange(count)))
+        store.size = count
+        return store
+
+def parse_unit_store(config_units, careers):
+    """
+    Validate a dictionary describing units (people) and load it into a
+    UnitStore
+    """
+    units = parse_units(config_units, careers)
+    store = UnitStore(careers, capacity=max(1024, 2 * len(units)))
+    for u_name, u_rec in units.iteritems():
+        store.add(u_name, u_rec['career'], age=u_rec['age'],
+                  busy=u_rec['busy'], balance=u_rec['balance'],
+                  eat_phase=u_rec['eat_phase'],
+                  spawn_phase=u_rec['spawn_phase'])
+    return store
+
+def save_unit_store(store):
+    """
+    Rewrite a UnitStore into a units dictionary that can be serialized
+    """
+    config_units = {}
+    for slot in store.live_slots().tolist():
+        u_rec = store.unit(slot)
+        config_units[u_rec.pop('name')] = u_rec
+    return config_units
+
+def spawn_store_unit(t, careers, store, parent, eat_every, spawn_every,
+        career=None):
+    """
+    Add a new unit to a UnitStore, assigning it the given career or else the
+    currently most lucrative career
+    """
+    if career is None:
+        career = spawn_career(careers)
+    name = new_name(career)
+    spawn_phase = randint(0, spawn_every - 1)
+    eat_phase = randint(0, eat_every - 1)
+    store.add(name, career, spawn_phase=spawn_phase, eat_phase=eat_phase)
+    logger.debug('t=%06d: %r gives birth to %r', t, parent, name)
+    return name
+
+def step_store(t, market, careers, store, rate, min_balance=-100,
+        max_age=1000, eat_every=100, spawn_every=200, order='descending',
+        quote_cache=None, op_bounds=None, batch_ops=False, profiler=None,
+        changes=None, name_ties=False):
+    """
+    Advance a UnitStore by one time step with the same rules as
+    econo.unit.step_time. Only units that eat, spawn or choose an operation
+    this step are visited one at a time, in order of balance; busy countdown,
+    aging, deaths and the per-career statistics are vectorized passes over
+    the units present at the start of the step. See step_time for batch_ops
+    and changes. Units with equal balances are visited in order of slot, or
+    of name with name_ties.
+    """
+    # Reset aggregate statistics
+    spawn = reset_stats(careers)
+
+    # Find the units that must act this step
+    if profiler is not None:
+        start = clock()
+    live = store.live_slots()
+    age = store.age[live]
+    due_eat = (age % eat_every) == store.eat_phase[live]
+    due_spawn = (age % spawn_every) == store.spawn_phase[live]
+    busy = store.busy[live] > 0
+    acting = due_eat | due_spawn | ~busy
+    active = live[acting]
+
+    # Visit the acting units in order of balance, breaking ties by slot
+    balances = store.balance[active]
+    if order == 'descending':
+        balances = -balances
+    if name_ties:
+        names = numpy.array([store.names[slot] for slot in active.tolist()])
+        visit = numpy.lexsort((names, balances))
+    else:
+        visit = numpy.argsort(balances, kind='mergesort')
+    active_eat = due_eat[acting][visit].tolist()
+    active_spawn = due_spawn[acting][visit].tolist()
+    active_idle = (~busy[acting])[visit].tolist()
+    dead = []
+    batch = [] if batch_ops else None
+    if profiler is not None:
+        profiler.lap('order', start)
+        profiler.count('units', len(live))
+    for i, slot in enumerate(active[visit].tolist()):
+        name = store.names[slot]
+        balance = float(store.balance[slot])
+
+        # Eat if necessary
+        if active_eat[i]:
+            if profiler is not None:
+                start = clock()
+            cost = ask_at(market, 'food')
+            if (balance - cost) < min_balance:
+                logger.debug('unit %r (age %d) starved', name,
+                             store.age[slot])
+                dead.append(slot)
+                if profiler is not None:
+                    profiler.count('starvations')
+            else:
+                balance -= cost
+                buy(market, 'food')
+            if profiler is not None:
+                profiler.count('quotes')
+                profiler.lap('eat', start)
+
+        # Spawn if appropriate and able
+        if active_spawn[i]:
+            if profiler is not None:
+                start = clock()
+            cost = ask_at(market, 'babykits')
+            if (balance - cost) < min_balance:
+                logger.debug('unit %r (age %d) could not spawn', name,
+                             store.age[slot])
+            else:
+                balance -= cost
+                buy(market, 'babykits')
+                newborn = spawn_store_unit(t, careers, store, name,
+                                           eat_every, spawn_every,
+                                           career=spawn)
+                if changes is not None:
+                    changes.change(newborn)
+                if profiler is not None:
+                    profiler.count('births')
+            if profiler is not None:
+                profiler.count('quotes')
+                profiler.lap('spawn', start)
+
+        # Choose and perform an operation
+        if active_idle[i] and batch is not None:
+            unit_state = dict(balance=balance, busy=0, slot=slot,
+                              career=store.career_names[store.career[slot]])
+            batch.append((unit_state, max_age - int(store.age[slot])))
+        elif active_idle[i]:
+            if profiler is not None:
+                start = clock()
+            career = store.career_names[store.career[slot]]
+            max_time = max_age - int(store.age[slot])
+            ops = career_ops(careers[career])
+            op, profit, _, priced, quotes = choose_op(
+                market, ops, rate, balance, min_balance, max_time,
+                quote_cache=quote_cache, op_bounds=op_bounds)
+            if profiler is not None:
+                start = profiler.lap('choose', start)
+                profiler.choice(priced, quotes)
+            unit_state = dict(balance=balance, busy=0)
+            perform_op(market, unit_state, op, profit)
+            balance = unit_state['balance']
+            store.busy[slot] = unit_state['busy']
+            careers[career]['stats']['total_profit'] += profit
+            if changes is not None and unit_state['busy']:
+                changes.change(name)
+            if profiler is not None:
+                profiler.lap('perform', start)
+        if changes is not None and balance != store.balance[slot]:
+            changes.change(name)
+        store.balance[slot] = balance
+
+    # Choose and perform the operations of a batch
+    if batch:
+        if profiler is not None:
+            start = clock()
+        quotes = perform_batch(market, careers, batch, rate, min_balance)
+        for unit_state, _ in batch:
+            slot = unit_state['slot']
+            if changes is not None and (unit_state['busy'] or
+                    unit_state['balance'] != store.balance[slot]):
+                changes.change(store.names[slot])
+            store.balance[slot] = unit_state['balance']
+            store.busy[slot] = unit_state['busy']
+        if profiler is not None:
+            profiler.choice(sum(len(careers[unit_state['career']]['ops'])
+                                for unit_state, _ in batch), quotes,
+                            n=len(batch))
+            profiler.lap('choose', start)
+
+    # Count down busy units and age everyone present at the start of the step
+    if profiler is not None:
+        start = clock()
+    store.busy[live[busy]] -= 1
+    store.age[live] += 1
+
+    # Remove starved units and units that die of old age
+    old = live[store.age[live] >= max_age]
+    for slot in old.tolist():
+        logger.debug('t=%06d: unit %r dies of old age', t, store.names[slot])
+    for slot in set(dead) | set(old.tolist()):
+        if changes is not None:
+            changes.remove(store.names[slot])
+        store.remove(slot)
+    if profiler is not None:
+        profiler.count('deaths', len(set(old.tolist()) - set(dead)))
+        start = profiler.lap('age', start)
+
+    # Compute avg_earnings per career and other aggregate stats
+    store_stats(careers, store, live)
+    if profiler is not None:
+        profiler.lap('stats', start)
+
+def store_stats(careers, store, live):
+    """
+    Compute the per-career statistics of the units in the given slots
+    """
+    n_careers = len(store.career_names)
+    career = store.career[live]
+    total_balance = numpy.bincount(career, weights=store.balance[live],
+                                   minlength=n_careers)
+    total_age = numpy.bincount(career, weights=store.age[live],
+                               minlength=n_careers)
+    population = numpy.bincount(career, minlength=n_careers)
+    for i, career in enumerate(store.career_names):
+        stats = careers[career]['stats']
+        stats['total_balance'] = float(total_balance[i])
+        stats['total_age'] = int(total_age[i])
+        stats['population'] = int(population[i])
+    finish_stats(careers)
+
+def quiet_store_steps(store, limit, max_age=1000, eat_every=100,
+        spawn_every=200):
+    """
+    Count the time steps, up to limit, before the next step in which a unit of
+    a UnitStore eats, spawns, chooses an operation or dies
+    """
+    live = store.live_slots()
+    if not len(live) or limit <= 0:
+        return max(limit, 0)
+    age = store.age[live]
+    steps = min(limit, int(store.busy[live].min()),
+                int(((store.eat_phase[live] - age) % eat_every).min()),
+                int(((store.spawn_phase[live] - age) % spawn_every).min()),
+                max_age - 1 - int(age.max()))
+    return max(steps, 0)
+
+def fast_forward_store(careers, store, steps):
+    """
+    Advance a UnitStore through time steps in which no unit acts (see
+    quiet_store_steps), with the same result as step_store
+    """
+    live = store.live_slots()
+    store.busy[live] -= steps
+    store.age[live] += steps
+    reset_stats(careers)
+    store_stats(careers, store, live)
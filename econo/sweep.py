@@ -0,0 +1,163 @@
+"""
+econo.sweep -- parameter sweeps and seeded replicates over a process pool
+
+A sweep takes a base description and a parameter grid, a dictionary mapping
+parameter names to lists of values. Parameter names are either system keys
+(interest_rate, min_balance, max_age, eat_every, spawn_every) or market keys:
+market.<param> sets a parameter of every resource and
+market.<resource>.<param> sets it for one resource. Every combination of
+values is a scenario, and every scenario is run a number of times with
+different, explicit random seeds.
+
+Runs are independent: each worker parses its own copy of the description,
+seeds the random number generator and starts from the description's own unit
+id table, so pool workers can be reused across runs.
+"""
+import logging; logger = logging.getLogger(__name__)
+from copy import deepcopy
+from itertools import product
+from math import sqrt
+from multiprocessing import Pool
+import random
+
+from .market import ask_at
+from .simulation import parse_simulation
+
+# System parameters that count time steps and must be positive
+POSITIVE_PARAMETERS = ('max_age', 'eat_every', 'spawn_every')
+
+def expand_grid(grid):
+    """
+    List every combination of the values in a parameter grid, as a list of
+    (name, value) pairs in sorted name order
+    """
+    names = sorted(grid.keys())
+    return [zip(names, values)
+            for values in product(*[grid[name] for name in names])]
+
+def apply_overrides(description, overrides):
+    """
+    Set the parameters of a description named by a list of (name, value)
+    pairs. Values are converted to the type of the value they replace (see
+    convert_override).
+    """
+    for name, value in overrides:
+        path = name.split('.')
+        if path[0] == 'market' and len(path) == 2:
+            targets = [(rec, path[1])
+                       for rec in description['market'].values()]
+        elif path[0] == 'market' and len(path) == 3:
+            targets = [(description['market'][path[1]], path[2])]
+        elif len(path) == 1:
+            targets = [(description['system'], path[0])]
+        else:
+            raise ValueError('unknown sweep parameter %r' % name)
+        for rec, key in targets:
+            if key not in rec:
+                raise ValueError('unknown sweep parameter %r' % name)
+            rec[key] = convert_override(name, rec[key], value)
+    return description
+
+def convert_override(name, current, value):
+    """
+    Convert a parameter value to the type of the value it replaces, refusing
+    values that the conversion would change, such as 50.5 for an integer
+    parameter, that are not numbers where a number is expected, or that are
+    not positive for the intervals and ages in POSITIVE_PARAMETERS
+    """
+    if isinstance(current, basestring):
+        if not isinstance(value, basestring):
+            raise ValueError('sweep parameter %r value %r is not a string'
+                             % (name, value))
+        return value
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        raise ValueError('sweep parameter %r value %r is not a number'
+                         % (name, value))
+    try:
+        converted = type(current)(value)
+    except (OverflowError, ValueError):
+        converted = None
+    if converted != value:
+        raise ValueError('sweep parameter %r value %r is not a(n) %s'
+                         % (name, value, type(current).__name__))
+    if name in POSITIVE_PARAMETERS and converted < 1:
+        raise ValueError('sweep parameter %r value %r is not positive'
+                         % (name, value))
+    return converted
+
+def run_scenario(task):
+    """
+    Run one replicate of one scenario and summarize its final state. The
+    task is a tuple of (description, overrides, seed, steps, options).
+    """
+    description, overrides, seed, steps, options = task
+    description = apply_overrides(deepcopy(description), overrides)
+    random.seed(seed)
+    sim = parse_simulation(description, **options)
+    return run_summary(sim, steps)
+
+def run_summary(sim, steps):
+    """
+    Run a simulation for a number of steps, or until extinction, and
+    summarize its final state
+    """
+    extinct_at = None
+    for _ in xrange(steps):
+        t = sim.step()
+        if len(sim.units) == 0:
+            extinct_at = t
+            break
+    summary = dict(population=len(sim.units),
+                   extinct=int(extinct_at is not None))
+    for career, career_rec in sim.careers.iteritems():
+        summary['%s.population' % career] = career_rec['stats']['population']
+        summary['%s.avg_profit' % career] = career_rec['stats']['avg_profit']
+    for resource in sim.market:
+        summary['%s.price' % resource] = ask_at(sim.market, resource)
+    return summary
+
+def sweep(description, grid, replicates=1, steps=1000, seed=0, jobs=None,
+        **options):
+    """
+    Run every scenario of a parameter grid the given number of times over a
+    process pool. Returns one row per scenario: the parameter values, the
+    number of replicates, and the mean and standard deviation of every
+    summary statistic over the replicates. Other keyword arguments are passed
+    on to parse_simulation.
+    """
+    scenarios = expand_grid(grid)
+    for overrides in scenarios:
+        apply_overrides(dict(system=deepcopy(description['system']),
+                             market=deepcopy(description['market'])),
+                        overrides)
+    tasks = [(description, overrides, seed + i * replicates + r, steps,
+              options)
+             for i, overrides in enumerate(scenarios)
+             for r in xrange(replicates)]
+    logger.info('sweeping %d scenarios x %d replicates', len(scenarios),
+                replicates)
+    pool = Pool(processes=jobs)
+    try:
+        summaries = pool.map(run_scenario, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return merge_replicates(scenarios, summaries, replicates)
+
+def merge_replicates(scenarios, summaries, replicates):
+    """
+    Merge the summaries of the replicates of every scenario, listed scenario
+    by scenario, into one row per scenario
+    """
+    rows = []
+    for i, overrides in enumerate(scenarios):
+        runs = summaries[i * replicates:(i + 1) * replicates]
+        row = dict(overrides, replicates=replicates)
+        for key in sorted(runs[0].keys()):
+            values = [run[key] for run in runs]
+            mean = sum(values) / float(len(values))
+            row[key + '.mean'] = mean
+            row[key + '.std'] = sqrt(sum((value - mean) ** 2
+                                         for value in values) / len(values))
+        rows.append(row)
+    return rows
@@ -0,0 +1,175 @@
+"""
+econo.trace -- sampled per-unit trajectories in fixed-size ring buffers
+
+A Tracer follows a sample of the units: those whose name hashes below the
+sample fraction, optionally only in some careers. The choice is made the first
+time the Tracer sees a unit and is remembered until the unit dies, so it
+costs untraced units one dictionary lookup per step. Every traced unit gets a
+TraceBuffer, a preallocated array of fixed-width records
+
+    t, event, balance, op, profit
+
+that keeps only the last capacity records, so memory stays bounded however
+long a unit lives. step_time records these events:
+
+    eat, starve: the unit paid for food, or could not and starved
+    spawn, no_spawn: the unit paid for a babykit, or could not afford it
+    op: the unit chose and started an op (no-op included), with its profit
+    death: the unit died of old age
+
+Balances are as of after the event. The buffer of a unit is written out to
+the trace file, oldest record first, when the unit dies, and those of the
+units still alive when the tracer is closed. dump() returns the records of a
+unit on demand.
+"""
+import logging; logger = logging.getLogger(__name__)
+from array import array
+import csv
+from zlib import crc32
+
+# Events, in the order of their codes in the records
+EVENTS = ['eat', 'starve', 'spawn', 'no_spawn', 'op', 'death']
+EAT, STARVE, SPAWN, NO_SPAWN, OP, DEATH = range(len(EVENTS))
+
+# Fields of a record
+FIELDS = ['t', 'event', 'balance', 'op', 'profit']
+
+class TraceBuffer(object):
+    """
+    Ring buffer of the last capacity trace records of a unit
+    """
+    def __init__(self, name, career, capacity=256):
+        self.name = name
+        self.career = career
+        self.capacity = capacity
+        self.records = array('d', [0.0]) * (capacity * len(FIELDS))
+        self.count = 0
+
+    def append(self, t, event, balance, op=-1, profit=0.0):
+        """
+        Record an event, overwriting the oldest record once the buffer is full
+        """
+        i = (self.count % self.capacity) * len(FIELDS)
+        records = self.records
+        records[i] = t
+        records[i + 1] = event
+        records[i + 2] = balance
+        records[i + 3] = op
+        records[i + 4] = profit
+        self.count += 1
+
+    def __iter__(self):
+        """
+        Iterate over the records held, oldest first, as tuples
+        """
+        width = len(FIELDS)
+        start = max(0, self.count - self.capacity)
+        for n in xrange(start, self.count):
+            i = (n % self.capacity) * width
+            yield tuple(self.records[i:i + width])
+
+class Tracer(object):
+    """
+    Sampled tracing of unit trajectories, written to a CSV file. Attach it to
+    a Simulation with Simulation.trace(); it is also a sink, which writes out
+    the units still traced when it is closed.
+    """
+    def __init__(self, path, sample=0.01, careers=None, capacity=256):
+        if not 0.0 <= sample <= 1.0:
+            raise ValueError('trace sample is not a fraction')
+        if capacity < 1:
+            raise ValueError('trace capacity is not positive')
+        self.threshold = int(sample * 0x100000000)
+        self.careers = set(careers) if careers else None
+        self.capacity = capacity
+        self.buffers = {}
+        self.op_names = {}
+        self.op_indices = {}
+        self.traced = 0
+        self.out = open(path, 'wb')
+        self.writer = csv.writer(self.out)
+        self.writer.writerow(['unit', 'career'] + FIELDS)
+
+    def follow(self, unit_state):
+        """
+        Return the TraceBuffer of a unit if it is traced, and None otherwise
+        """
+        name = unit_state['name']
+        try:
+            return self.buffers[name]
+        except KeyError:
+            pass
+        career = unit_state['career']
+        if ((crc32(name) & 0xffffffff) < self.threshold and
+                (self.careers is None or career in self.careers)):
+            trace = TraceBuffer(name, career, capacity=self.capacity)
+            self.traced += 1
+        else:
+            trace = None
+        self.buffers[name] = trace
+        return trace
+
+    def op_index(self, careers, career, op):
+        """
+        Map an op to its index in the ops of its career, or -1 for the no-op,
+        to store it in a record
+        """
+        if op is None:
+            return -1
+        if career not in self.op_indices:
+            names = [career_op.name for career_op in careers[career]['ops']]
+            self.op_names[career] = names
+            self.op_indices[career] = dict((name, i)
+                                           for i, name in enumerate(names))
+        return self.op_indices[career][op.name]
+
+    def dump(self, name):
+        """
+        Return the records of a traced unit, oldest first, as dictionaries
+        with the event and op names resolved
+        """
+        trace = self.buffers.get(name)
+        if trace is None:
+            return []
+        return self.records(trace)
+
+    def records(self, trace):
+        """
+        Resolve the records of a TraceBuffer into dictionaries
+        """
+        names = self.op_names.get(trace.career, [])
+        return [dict(t=int(t), event=EVENTS[int(event)], balance=balance,
+                     op=names[int(op)] if op >= 0 else None, profit=profit)
+                for t, event, balance, op, profit in trace]
+
+    def finish(self, name):
+        """
+        Write out the records of a unit that has died and forget it
+        """
+        trace = self.buffers.pop(name, None)
+        if trace is not None:
+            self.write(trace)
+
+    def write(self, trace):
+        """
+        Write the records of a TraceBuffer to the trace file
+        """
+        for record in self.records(trace):
+            self.writer.writerow([trace.name, trace.career] +
+                                 [record[field] for field in FIELDS])
+
+    def record(self, t, sim):
+        """
+        Nothing to do per step: events are recorded by the step function
+        """
+
+    def close(self):
+        """
+        Write out the records of the units still traced and close the file
+        """
+        if self.out.closed:
+            return
+        for name in sorted(self.buffers):
+            self.finish(name)
+        self.out.close()
+        logger.info('traced %d units', self.traced)
@@ -16,8 +16,12 @@ import logging; logger = logging.getLogger(__name__)
 from collections import namedtuple, defaultdict
 from copy import deepcopy
 from random import randint
+from timeit import default_timer as clock
 
 from .market import sell, buy, price_op, ask_at
+from .optable import OpTable, batch_table, compile_ops
+from .order import BalanceIndex
+from .trace import EAT, STARVE, SPAWN, NO_SPAWN, OP, DEATH
 
 # The Op class takes three components: costs, products, and time
 # - name: friendly name for the operation
@@ -26,10 +30,19 @@ from .market import sell, buy, price_op, ask_at
 # - time: number of time steps consumed by unit
 Op = namedtuple('Op', 'name costs products time')
 
-def choose_op(market, ops, rate, balance, min_balance, max_time):
+def choose_op(market, ops, rate, balance, min_balance, max_time,
+        quote_cache=None, op_bounds=None):
     """
     Given a market, a set of valid operations, an interest rate, and a starting
-    balance, determine the most profitable operation to perform
+    balance, determine the most profitable operation to perform. A QuoteCache
+    may be given to reuse the quotes of ops whose resources have not moved,
+    OpBounds (see econo.bound) to skip pricing the ops that cannot win, and
+    the ops may be given as a compiled OpTable to price them all at once.
+    Returns the chosen op (None for the no-op), its profit and profit rate,
+    the number of ops actually priced: with a QuoteCache, only the ops whose
+    quotes had to be recomputed, and the number of resource price quotes
+    issued: those of the ops priced and of the bounds, but none for reused
+    quotes.
     """
     # Determine the no-op profit
     noop_profit = 0.0
@@ -37,12 +50,37 @@ def choose_op(market, ops, rate, balance, min_balance, max_time):
         shortfall = -balance
         noop_profit = -(shortfall * rate)
 
+    # Price compiled ops in one vectorized pass
+    if isinstance(ops, OpTable):
+        return ops.choose(market, rate, balance, min_balance, max_time,
+                          noop_profit)
+
+    if quote_cache is not None:
+        quote_cache.refresh(market)
+        misses = quote_cache.misses
+        issued = quote_cache.issued
+        price = quote_cache.price
+    else:
+        price = price_op
+    if op_bounds is not None:
+        bids = op_bounds.issued
+        best_op, best_profit, best_rate, priced, quotes = op_bounds.choose(
+            market, ops, rate, balance, min_balance, max_time, noop_profit,
+            price=price)
+        if quote_cache is not None:
+            priced = quote_cache.misses - misses
+            quotes = quote_cache.issued - issued
+        quotes += op_bounds.issued - bids
+        return (best_op, best_profit, best_rate, priced, quotes)
+
     # Determine the most profitable operation
     best_op = None
     best_rate = noop_profit
     best_profit = noop_profit
+    quotes = 0
     for op in ops:
-        profit_rate, profit, low_balance = price_op(market, op, rate, balance)
+        quotes += len(op.costs) + len(op.products)
+        profit_rate, profit, low_balance = price(market, op, rate, balance)
         if low_balance < min_balance and low_balance < balance:
             continue
         elif op.time > max_time:
@@ -52,7 +90,57 @@ def choose_op(market, ops, rate, balance, min_balance, max_time):
             best_rate = profit_rate
             best_profit = profit
 
-    return (best_op, best_profit, best_rate)
+    if quote_cache is not None:
+        return (best_op, best_profit, best_rate, quote_cache.misses - misses,
+                quote_cache.issued - issued)
+    return (best_op, best_profit, best_rate, len(ops), quotes)
+
+def choose_ops(market, career_rec, rate, balances, min_balance, max_times):
+    """
+    Batched choose_op for many units of the same career facing the same
+    market: price the ops of the career once, in its OpTable (see
+    econo.optable.batch_table), then pick the best op for each balance and
+    maximum time. Returns lists of the chosen ops (None for the no-op) and of
+    their profits, and the number of resource price quotes issued.
+    """
+    ops = batch_table(career_rec, market)
+    issued = ops.issued
+    best, profits, _ = ops.choose_batch(market, rate, balances, min_balance,
+                                        max_times)
+    return ([ops.ops[i] if i >= 0 else None for i in best.tolist()],
+            profits.tolist(), ops.issued - issued)
+
+def perform_batch(market, careers, batch, rate, min_balance):
+    """
+    Let a batch of idle units choose their operations against the current
+    market, career by career, and then perform them in batch order. The batch
+    is a list of (unit state, maximum op time) pairs. Returns the number of
+    resource price quotes issued.
+    """
+    by_career = defaultdict(list)
+    for i, (unit_state, max_time) in enumerate(batch):
+        by_career[unit_state['career']].append(i)
+    choices = [None] * len(batch)
+    quotes = 0
+    for career, indices in by_career.iteritems():
+        balances = [batch[i][0]['balance'] for i in indices]
+        max_times = [batch[i][1] for i in indices]
+        ops, profits, issued = choose_ops(market, careers[career], rate,
+                                          balances, min_balance, max_times)
+        quotes += issued
+        for i, op, profit in zip(indices, ops, profits):
+            choices[i] = (op, profit)
+    for (unit_state, _), (op, profit) in zip(batch, choices):
+        perform_op(market, unit_state, op, profit)
+        careers[unit_state['career']]['stats']['total_profit'] += profit
+    return quotes
+
+def career_ops(career_rec):
+    """
+    Return the ops of a career in the form choose_op prices fastest: the
+    compiled OpTable if there is one, otherwise the list of Op objects
+    """
+    return career_rec.get('table', career_rec['ops'])
 
 def perform_op(market, unit_state, op, profit):
     """
@@ -87,18 +175,28 @@ def new_name(career):
     name = '%s_%04d' % (career, NEXT_UNIT_ID[career])
     return name
 
-def spawn_unit(t, careers, units, parent, eat_every, spawn_every):
+def spawn_career(careers):
     """
-    Add a new unit to the units dictionary, assigning it the currently most
-    lucrative career
+    Choose the currently most lucrative career for a new unit, preferring
+    careers that have no units at all
     """
+    if not careers:
+        return None
     empty_careers = [career for career, career_rec in careers.iteritems()
-                     if career_rec['stats']['population'] == 0]
+                     if career_rec['stats'].get('population', 0) == 0]
     if empty_careers:
-        career = empty_careers[0]
-    else:
-        career = max(careers.keys(), key=lambda k:
-                careers[k]['stats']['avg_profit'])
+        return empty_careers[0]
+    return max(careers.keys(),
+               key=lambda k: careers[k]['stats'].get('avg_profit', 0.0))
+
+def spawn_unit(t, careers, units, parent, eat_every, spawn_every,
+        career=None):
+    """
+    Add a new unit to the units dictionary, assigning it the given career or
+    else the currently most lucrative career
+    """
+    if career is None:
+        career = spawn_career(careers)
     name = new_name(career)
     units[name] = dict(age=0, busy=0, career=career, balance=0, name=name,
             spawn_phase=randint(0, spawn_every - 1), eat_phase=randint(0,
@@ -106,55 +204,207 @@ def spawn_unit(t, careers, units, parent, eat_every, spawn_every):
     logger.debug('t=%06d: %r gives birth to %r', t, parent, name)
     return name
 
-def step_time(t, market, careers, units, rate, min_balance=-100, max_age=1000,
-        eat_every=100, spawn_every=200):
+def reset_stats(careers):
     """
+    Clear the per-step aggregate statistics of every career, and return the
+    career that the units born during the step take up (see spawn_career).
+    The populations stay cleared until the end of the step, so the choice is
+    the same for every birth and is made once, here.
     """
-    # Reset aggregate statistics
     for career_rec in careers.values():
         career_rec['stats']['total_balance'] = 0.0
         career_rec['stats']['total_age'] = 0
         career_rec['stats']['population'] = 0
         career_rec['stats']['total_profit'] = 0.0
         career_rec['stats'].setdefault('avg_profit', 0.0)
+    return spawn_career(careers)
+
+def finish_stats(careers):
+    """
+    Derive the average statistics of every career from its totals
+    """
+    for career, career_rec in careers.items():
+        career_rec['stats']['avg_earnings'] = (
+            career_rec['stats']['total_balance'] /
+            (career_rec['stats']['total_age'] + 1))
+        career_rec['stats']['avg_profit'] = (
+                career_rec['stats']['total_profit'] /
+                (career_rec['stats']['population'] + 1))
+
+class CareerTotals(object):
+    """
+    Running totals of the balance, age and population of the live units of
+    every career. step_time keeps them up to date as units are born, die,
+    trade and age, and derives the per-step career statistics from them
+    instead of summing over every unit. Every rescan_every steps it sums the
+    balances over the units instead (see rescan), so that the rounding error
+    of the running updates does not build up and the statistics of those
+    steps, such as the default reports, are exactly those of a full scan.
+    """
+    rescan_every = 100
+
+    def __init__(self, careers, units):
+        self.population = dict.fromkeys(careers, 0)
+        self.balance = dict.fromkeys(careers, 0.0)
+        self.age = dict.fromkeys(careers, 0)
+        self.present = 0
+        for unit_state in units.itervalues():
+            self.add(unit_state)
+
+    def add(self, unit_state):
+        """
+        Count a unit that has been born or loaded
+        """
+        career = unit_state['career']
+        self.population[career] += 1
+        self.balance[career] += unit_state['balance']
+        self.age[career] += unit_state['age']
+
+    def remove(self, unit_state):
+        """
+        Forget a unit that has died
+        """
+        career = unit_state['career']
+        self.population[career] -= 1
+        self.balance[career] -= unit_state['balance']
+        self.age[career] -= unit_state['age']
+        if self.population[career] == 0:
+            # Drop the rounding error the balance updates left behind
+            self.balance[career] = 0.0
+            self.age[career] = 0
+
+    def rescan(self, unit_list, dead):
+        """
+        Sum the balances of the units visited in a step, in the order they
+        were visited, those that died included. Returns the balance totals of
+        the units that survive, to replace the totals once the dead are
+        forgotten.
+        """
+        dead = set(id(unit_state) for unit_state in dead)
+        self.balance = dict.fromkeys(self.balance, 0.0)
+        live = dict.fromkeys(self.balance, 0.0)
+        for entry in unit_list:
+            unit_state = entry[3]
+            career = unit_state['career']
+            self.balance[career] += unit_state['balance']
+            if id(unit_state) not in dead:
+                live[career] += unit_state['balance']
+        return live
+
+def step_time(t, market, careers, units, rate, min_balance=-100, max_age=1000,
+        eat_every=100, spawn_every=200, order='descending', quote_cache=None,
+        op_bounds=None, batch_ops=False, profiler=None, totals=None,
+        index=None, tracer=None, changes=None):
+    """
+    Advance a units dictionary by one time step. The CareerTotals and the
+    BalanceIndex (see econo.order) of the units, if given, must be passed to
+    every step; without them they are rebuilt from the units. A Tracer (see
+    econo.trace) records the events of the units it follows, and UnitChanges
+    (see econo.journal) the units born, changed or removed.
+    """
+    # Reset aggregate statistics
+    spawn = reset_stats(careers)
+    if totals is None:
+        totals = CareerTotals(careers, units)
+    started = dict(totals.population)
+    totals.present = len(units)
+
+    # Idle units either decide one at a time, each seeing the trades of the
+    # units before it, or, with batch_ops, all decide after everyone has eaten
+    # and spawned and then trade in order
+    batch = [] if batch_ops else None
 
     # Iterate over all units in order of balance
-    # TODO: Make the direction of order configurable
-    unit_list = [(k, v) for k, v in units.items()]
-    unit_list.sort(key=lambda x: x[1]['balance'], reverse=True)
-    for key, unit_state in unit_list:
+    if profiler is not None:
+        start = clock()
+    if index is None:
+        index = BalanceIndex(units, order=order)
+    unit_list = index.order()
+    if profiler is not None:
+        profiler.lap('order', start)
+        profiler.count('units', len(unit_list))
+    dead = []
+    for _, _, key, unit_state in unit_list:
+        start_balance = unit_state['balance']
+        trace = tracer.follow(unit_state) if tracer is not None else None
+
         # Eat if necessary
         if (unit_state['age'] % eat_every) == unit_state['eat_phase']:
+            if profiler is not None:
+                start = clock()
             cost = ask_at(market, 'food')
             if (unit_state['balance'] - cost) < min_balance:
                 logger.debug('unit %(name)r (age %(age)d) starved', unit_state)
                 units.pop(key)
+                if profiler is not None:
+                    profiler.count('starvations')
+                if trace is not None:
+                    trace.append(t, STARVE, unit_state['balance'])
             else:
                 unit_state['balance'] -= cost
                 buy(market, 'food')
+                if trace is not None:
+                    trace.append(t, EAT, unit_state['balance'])
+            if profiler is not None:
+                profiler.count('quotes')
+                profiler.lap('eat', start)
 
         # Spawn if appropriate and able
         if (unit_state['age'] % spawn_every) == unit_state['spawn_phase']:
+            if profiler is not None:
+                start = clock()
             cost = ask_at(market, 'babykits')
             if (unit_state['balance'] - cost) < min_balance:
                 logger.debug('unit %(name)r (age %(age)d) could not'
                              ' spawn', unit_state)
+                if trace is not None:
+                    trace.append(t, NO_SPAWN, unit_state['balance'])
             else:
                 unit_state['balance'] -= cost
                 buy(market, 'babykits')
-                spawn_unit(t, careers, units, key, eat_every, spawn_every)
+                newborn = spawn_unit(t, careers, units, key, eat_every,
+                                     spawn_every, career=spawn)
+                totals.add(units[newborn])
+                index.file(units[newborn])
+                if changes is not None:
+                    changes.change(newborn)
+                if profiler is not None:
+                    profiler.count('births')
+                if trace is not None:
+                    trace.append(t, SPAWN, unit_state['balance'])
+            if profiler is not None:
+                profiler.count('quotes')
+                profiler.lap('spawn', start)
 
         # Choose and perform an operation
-        if unit_state['busy'] == 0:
-            ops = careers[unit_state['career']]['ops']
+        if unit_state['busy'] == 0 and batch is not None:
+            batch.append((unit_state, max_age - unit_state['age']))
+        elif unit_state['busy'] == 0:
+            if profiler is not None:
+                start = clock()
+            ops = career_ops(careers[unit_state['career']])
             balance = unit_state['balance']
             max_time = max_age - unit_state['age']
-            op, profit, _ = choose_op(market, ops, rate, balance, min_balance,
-                                      max_time)
+            op, profit, _, priced, quotes = choose_op(
+                market, ops, rate, balance, min_balance, max_time,
+                quote_cache=quote_cache, op_bounds=op_bounds)
+            if profiler is not None:
+                start = profiler.lap('choose', start)
+                profiler.choice(priced, quotes)
             perform_op(market, unit_state, op, profit)
             careers[unit_state['career']]['stats']['total_profit'] += profit
+            if changes is not None and unit_state['busy']:
+                changes.change(key)
+            if trace is not None:
+                trace.append(t, OP, unit_state['balance'],
+                             tracer.op_index(careers, unit_state['career'],
+                                             op), profit)
+            if profiler is not None:
+                profiler.lap('perform', start)
         else:
             unit_state['busy'] -= 1
+        totals.balance[unit_state['career']] += (unit_state['balance'] -
+                                                 start_balance)
 
         # Age the unit
         unit_state['age'] += 1
@@ -162,25 +412,103 @@ def step_time(t, market, careers, units, rate, min_balance=-100, max_age=1000,
             logger.debug('t=%06d: unit %r dies of old age', t, key)
             if key in units:
                 units.pop(key)
-
-    # Compute avg_earnings per career and other aggregate stats
-    for key, unit_state in unit_list:
-        career = unit_state['career']
-        careers[career]['stats']['total_balance'] += unit_state['balance']
-        careers[career]['stats']['total_age'] += unit_state['age']
-        careers[career]['stats']['population'] += 1
-    for career, career_rec in careers.items():
-        career_rec['stats']['avg_earnings'] = (
-            career_rec['stats']['total_balance'] /
-            (career_rec['stats']['total_age'] + 1))
-        career_rec['stats']['avg_profit'] = (
-                career_rec['stats']['total_profit'] /
-                (career_rec['stats']['population'] + 1))
-
-def parse_careers(config_careers, market):
+                if profiler is not None:
+                    profiler.count('deaths')
+                if trace is not None:
+                    trace.append(t, DEATH, unit_state['balance'])
+        if key not in units:
+            index.remove(unit_state)
+            dead.append(unit_state)
+            if tracer is not None:
+                tracer.finish(key)
+            if changes is not None:
+                changes.remove(key)
+        elif unit_state['balance'] != start_balance:
+            index.file(unit_state)
+            if changes is not None:
+                changes.change(key)
+
+    # Choose and perform the operations of a batch
+    if batch:
+        if profiler is not None:
+            start = clock()
+        balances = [unit_state['balance'] for unit_state, _ in batch]
+        quotes = perform_batch(market, careers, batch, rate, min_balance)
+        for (unit_state, _), balance in zip(batch, balances):
+            totals.balance[unit_state['career']] += (unit_state['balance'] -
+                                                     balance)
+            if unit_state['name'] in units:
+                index.file(unit_state)
+                if changes is not None and (unit_state['busy'] or
+                        unit_state['balance'] != balance):
+                    changes.change(unit_state['name'])
+        if profiler is not None:
+            profiler.choice(sum(len(careers[unit_state['career']]['ops'])
+                                for unit_state, _ in batch), quotes,
+                            n=len(batch))
+            profiler.lap('choose', start)
+
+    # Compute avg_earnings per career and other aggregate stats from the
+    # totals, which still count the units that died during the step and whose
+    # newborns have neither balance nor age yet, and then forget the dead
+    if profiler is not None:
+        start = clock()
+    live = None
+    if t % totals.rescan_every == 0:
+        live = totals.rescan(unit_list, dead)
+    for career, career_rec in careers.iteritems():
+        totals.age[career] += started[career]
+        stats = career_rec['stats']
+        stats['total_balance'] = totals.balance[career]
+        stats['total_age'] = totals.age[career]
+        stats['population'] = started[career]
+    for unit_state in dead:
+        totals.remove(unit_state)
+    if live is not None:
+        totals.balance.update(live)
+    finish_stats(careers)
+    if profiler is not None:
+        profiler.lap('stats', start)
+
+def quiet_steps(units, limit, max_age=1000, eat_every=100, spawn_every=200):
+    """
+    Count the time steps, up to limit, before the next step in which a unit of
+    a units dictionary eats, spawns, chooses an operation or dies
+    """
+    steps = limit
+    for unit_state in units.itervalues():
+        age = unit_state['age']
+        steps = min(steps, unit_state['busy'],
+                    (unit_state['eat_phase'] - age) % eat_every,
+                    (unit_state['spawn_phase'] - age) % spawn_every,
+                    max_age - 1 - age)
+        if steps <= 0:
+            return 0
+    return steps
+
+def fast_forward_units(careers, units, totals, steps):
+    """
+    Advance a units dictionary through time steps in which no unit acts (see
+    quiet_steps), with the same result as step_time
+    """
+    for unit_state in units.itervalues():
+        unit_state['age'] += steps
+        unit_state['busy'] -= steps
+    reset_stats(careers)
+    totals.present = len(units)
+    for career, career_rec in careers.iteritems():
+        totals.age[career] += steps * totals.population[career]
+        stats = career_rec['stats']
+        stats['total_balance'] = totals.balance[career]
+        stats['total_age'] = totals.age[career]
+        stats['population'] = totals.population[career]
+    finish_stats(careers)
+
+def parse_careers(config_careers, market, compiled=False):
     """
     Convert a dictionary describing careers into an appropriate family of data
-    structures, including Op objects
+    structures, including Op objects. If compiled is set, each career also
+    gets an OpTable (see econo.optable) under its 'table' key.
     """
     # Initialize output structure
     careers = {}
@@ -229,6 +557,10 @@ def parse_careers(config_careers, market):
             logger.debug('... can %r', op.name)
             rec['ops'].append(op)
 
+    # Compile the ops into integer-indexed tables
+    if compiled:
+        compile_ops(careers, market)
+
     return careers
 
 def save_careers(careers):
@@ -269,21 +601,31 @@ def parse_units(config_units, careers):
     # Iterate over each unit
     logger.debug('validating units')
     for u_name, u_rec in units.iteritems():
-        logger.debug('... %s', u_name)
-        for param in ['age', 'busy', 'career', 'balance']:
-            if param not in u_rec:
-                raise ValueError('unit %r lacking a(n) %r' % (u_name, param))
-        for param in ['eat_phase', 'spawn_phase']:
-            if param not in u_rec:
-                logger.warn('unit %r getting default %s of 0', u_name, param)
-                u_rec[param] = 0
-        u_rec['name'] = u_name
+        parse_unit(u_name, u_rec)
         if u_rec['career'] not in careers:
             raise ValueError('unit %r has career %r, but that career is unknown'
                     % (u_name, u_rec['career']))
 
     return units
 
+def parse_unit(u_name, u_rec):
+    """
+    Validate the dictionary describing one unit and set its defaults and name.
+    Its career is checked by the caller, once the careers are known.
+    """
+    logger.debug('... %s', u_name)
+    if not isinstance(u_rec, dict):
+        raise ValueError('unit %r configuration is not a dictionary' % u_name)
+    for param in ['age', 'busy', 'career', 'balance']:
+        if param not in u_rec:
+            raise ValueError('unit %r lacking a(n) %r' % (u_name, param))
+    for param in ['eat_phase', 'spawn_phase']:
+        if param not in u_rec:
+            logger.warn('unit %r getting default %s of 0', u_name, param)
+            u_rec[param] = 0
+    u_rec['name'] = u_name
+    return u_rec
+
 def save_units(units):
     """
     Rewrite units structure into a format that can be serialized. This mostly
@@ -300,9 +642,11 @@ def save_units(units):
 
 def parse_unit_ids(config_unit_ids):
     """
-    Load unit id table
+    Load unit id table, replacing the ids issued so far so that every run
+    starts from its own table
     """
     global NEXT_UNIT_ID
+    NEXT_UNIT_ID.clear()
     if not isinstance(config_unit_ids, dict):
         return
     for career, next_id in config_unit_ids.items():
@@ -0,0 +1,103 @@
+"""
+econo.writer -- streaming writer for large economic descriptions
+
+Simulation.save() returns the whole description as one tree, with a deep copy
+of every unit in it, and dumping that tree builds the whole YAML document in
+memory before a byte of it is written, so saving a large population costs
+several times the memory of simulating it. write_description() instead
+writes the sections one by one to the output file, with the libyaml emitter
+when PyYAML was built with it. The units section is written last, a chunk of
+units at a time, each unit copied without its name just before it is dumped.
+
+The output is the same block-style YAML document as dumping the saved tree,
+with the sections and the units in sorted order, and reads back with
+econo.loader.load_simulation. write_regions() writes the descriptions of
+several regions (see econo.region) in the same way, each indented under the
+name of its region.
+"""
+import logging; logger = logging.getLogger(__name__)
+from yaml import dump
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+from .store import UnitStore
+
+def iter_units(units):
+    """
+    Iterate over the units of a dictionary or UnitStore in name order, as
+    (name, unit record without its name) pairs
+    """
+    if isinstance(units, UnitStore):
+        for name, slot in sorted(units.slots.iteritems()):
+            u_rec = units.unit(slot)
+            u_rec.pop('name')
+            yield name, u_rec
+    else:
+        for name in sorted(units):
+            u_rec = dict(units[name])
+            u_rec.pop('name')
+            yield name, u_rec
+
+def write_description(out, sections, units, chunk_size=1000, indent=''):
+    """
+    Write a description to a file, from a dictionary of every section but
+    the units and an iterable of (name, unit record) pairs in name order,
+    with every line prefixed by indent
+    """
+    for section in sorted(sections):
+        out.write(indent_text(dump({section: sections[section]},
+                                   Dumper=SafeDumper,
+                                   default_flow_style=False), indent))
+
+    # Dump the units a chunk at a time, indented under the units key
+    out.write(indent + 'units:')
+    chunk = {}
+    written = 0
+    for name, u_rec in units:
+        chunk[name] = u_rec
+        if len(chunk) == chunk_size:
+            written += write_units(out, chunk, written, indent)
+            chunk = {}
+    if chunk or not written:
+        written += write_units(out, chunk, written, indent)
+    out.flush()
+    logger.debug('wrote %d units', written)
+
+def write_units(out, chunk, written, indent=''):
+    """
+    Write a chunk of units under the units key, and return their number
+    """
+    if not chunk:
+        out.write(' {}\n')
+        return 0
+    if not written:
+        out.write('\n')
+    text = dump(chunk, Dumper=SafeDumper, default_flow_style=False)
+    out.write(indent_text(text, indent + '  '))
+    return len(chunk)
+
+def write_regions(out, descriptions, chunk_size=1000):
+    """
+    Write the descriptions of several regions to a file, from a dictionary
+    of descriptions keyed by region name, in name order. Each description is
+    dropped from the dictionary once it is written.
+    """
+    for name in sorted(descriptions):
+        description = descriptions.pop(name)
+        units = description.pop('units')
+        out.write(dump({name: None}, Dumper=SafeDumper,
+                       default_flow_style=False).replace(' null\n', '\n'))
+        write_description(out, description,
+                          ((u_name, units.pop(u_name))
+                           for u_name in sorted(units)),
+                          chunk_size, indent='  ')
+
+def indent_text(text, indent):
+    """
+    Prefix every line of a text with indent
+    """
+    if not indent:
+        return text
+    return ''.join(indent + line for line in text.splitlines(True))
@@ -14,6 +14,9 @@ setup(
     install_requires=[
         'pyyaml',
         ],
+    extras_require={
+        'array': ['numpy'],
+        },
     entry_points={
         'console_scripts':
             ['econo = econo.cli:main',
@@ -0,0 +1,101 @@
+"""
+Golden trajectory tests: every exact configuration must reproduce, step by
+step, the trajectories of the reference configuration recorded under
+tests/golden (see econo.bench.save_golden), all breaking balance ties by name,
+while the reference configuration by default breaks them in the order of the
+units dictionary
+"""
+import os
+import random
+
+import pytest
+
+from econo.bench import check_golden, load_golden, same_record, trajectory
+from econo.generate import generate_description
+from econo.simulation import parse_simulation
+
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), 'golden')
+GOLDEN_FILES = sorted(os.path.join(GOLDEN_DIR, name)
+                      for name in os.listdir(GOLDEN_DIR)
+                      if name.endswith('.yaml'))
+
+# Configurations that must not change the trajectory. Batched op choice and
+# batch clearing decide differently by design and are not listed.
+CONFIGURATIONS = [
+    dict(),
+    dict(schedule='events'),
+    dict(unit_store='array'),
+    dict(compile_ops=True),
+    dict(quote_cache=True),
+    dict(bound_ops=True),
+    dict(unit_store='array', compile_ops=True, quote_cache=True,
+         bound_ops=True),
+]
+
+def skip_without_numpy(options):
+    if options.get('unit_store') == 'array' or options.get('compile_ops'):
+        pytest.importorskip('numpy')
+
+@pytest.mark.parametrize('path', GOLDEN_FILES)
+def test_reference_matches_golden(path):
+    golden = load_golden(path)
+    description = generate_description(**golden['generate'])
+    records = trajectory(description, golden['steps'], golden['seed'],
+                         dict(name_ties=True))
+    assert len(records) == len(golden['trajectory']) == golden['steps']
+    for expected, actual in zip(golden['trajectory'], records):
+        assert actual == expected
+
+@pytest.mark.parametrize('options', CONFIGURATIONS)
+@pytest.mark.parametrize('path', GOLDEN_FILES)
+def test_configuration_matches_golden(path, options):
+    skip_without_numpy(options)
+    assert check_golden(path, **options) is None
+
+@pytest.mark.parametrize('options', CONFIGURATIONS)
+def test_configuration_matches_reference_totals(options):
+    skip_without_numpy(options)
+    golden = load_golden(GOLDEN_FILES[0])
+    description = generate_description(**golden['generate'])
+    reference = trajectory(description, golden['steps'], golden['seed'],
+                           dict(name_ties=True), totals=True)
+    candidate = trajectory(description, golden['steps'], golden['seed'],
+                           dict(options, name_ties=True), totals=True)
+    for expected, actual in zip(reference, candidate):
+        assert same_record(expected, actual)
+
+def test_reference_breaks_balance_ties_in_dict_order():
+    # The scan schedule visits the units as the stable sort of the units
+    # dictionary by balance did, newborns tied at zero included
+    random.seed(0)
+    sim = parse_simulation(generate_description(units=30, careers=3, ops=2,
+                                                resources=4, seed=2))
+    tied = 0
+    for _ in xrange(200):
+        expected = [name for name, u_rec in
+                    sorted(sim.units.items(), key=lambda x: x[1]['balance'],
+                           reverse=True)]
+        assert [entry[2] for entry in sim.index.order()] == expected
+        tied += len(sim.index.tied)
+        sim.step()
+    assert tied
+
+@pytest.mark.parametrize('options', CONFIGURATIONS)
+def test_name_ties_break_balance_ties_alike(options):
+    skip_without_numpy(options)
+    options = dict(options, name_ties=True)
+    # Units of both careers, tied on balance, all eat at the first step at a
+    # rising food price, so the visit order decides what each one pays
+    description = generate_description(units=0, careers=2, ops=1,
+                                       resources=3, seed=1)
+    description['market']['food']['rate'] = 1.5
+    for name in ['career_01_0001', 'career_00_0002', 'career_00_0001',
+                 'career_01_0002', 'career_00_0003']:
+        description['units'][name] = dict(age=1, busy=5, career=name[:9],
+                                          balance=100.0, eat_phase=1,
+                                          spawn_phase=150)
+    reference = trajectory(description, 3, 0, dict(name_ties=True),
+                           totals=True)
+    for expected, actual in zip(reference, trajectory(description, 3, 0,
+                                                      options, totals=True)):
+        assert same_record(expected, actual)
@@ -0,0 +1,60 @@
+"""
+Journal tests: for every step function, replaying the journal after any step
+must rebuild the units as they are in the running simulation, although only
+the units that the step functions report as changed are journaled
+"""
+import random
+
+import pytest
+
+from econo.checkpoint import column_units
+from econo.generate import generate_description
+from econo.journal import JournalSink, replay_journal
+from econo.simulation import parse_simulation
+from econo.store import UnitStore
+
+CONFIGURATIONS = [
+    dict(),
+    dict(batch_ops=True),
+    dict(schedule='events'),
+    dict(unit_store='array'),
+    dict(unit_store='array', batch_ops=True),
+    dict(unit_store='array', compile_ops=True, clearing=True),
+    dict(unit_store='array', compile_ops=True, clearing=True,
+         clearing_jobs=2, clearing_rounds=3),
+]
+
+def unit_states(t, units):
+    """
+    The state of every unit of a units dictionary or UnitStore, with busy
+    clamped at zero as a journal replay leaves it
+    """
+    if isinstance(units, UnitStore):
+        units = dict((name, units.unit(slot))
+                     for name, slot in units.slots.iteritems())
+    return dict((name, (u_rec['career'], t - u_rec['age'],
+                        max(0, u_rec['busy']), u_rec['balance'],
+                        u_rec['eat_phase'], u_rec['spawn_phase']))
+                for name, u_rec in units.iteritems())
+
+@pytest.mark.parametrize('options', CONFIGURATIONS)
+def test_replay_matches_simulation(tmpdir, options):
+    if options.get('unit_store') == 'array' or options.get('batch_ops'):
+        pytest.importorskip('numpy')
+    random.seed(0)
+    sim = parse_simulation(generate_description(units=100, careers=4, ops=3,
+                                                resources=5, seed=1),
+                           **options)
+    path = str(tmpdir.join('journal'))
+    sim.journal(JournalSink(path, sim, compact_every=17))
+    try:
+        for _ in xrange(60):
+            sim.step()
+            header, columns = replay_journal(path)
+            replayed = column_units(columns, header['career_names'])
+            assert header['system']['t'] == sim.t
+            sim.sync()
+            assert (unit_states(sim.t, replayed) ==
+                    unit_states(sim.t, sim.units))
+    finally:
+        sim.close()
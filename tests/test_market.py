@@ -0,0 +1,187 @@
+"""
+Equivalence tests of the closed-form market pricing against the per-unit loop
+it replaced: exact wherever the closed form is exact (linear prices on
+integer and other dyadic values, single units, exponential rates of exactly
+1.0, the clamp boundaries and empty ranges), and to a tolerance for the
+geometric series, whose sum is rounded differently from the loop. Geometric
+series whose terms overflow, which stopped the loop, are priced at infinity.
+"""
+import random
+
+import pytest
+
+from econo.market import (series_price, _first_nonnegative,
+        _last_nonnegative, ask_at, bid_at)
+
+def loop_price(type_name, initial, rate, start, stop):
+    """
+    The per-unit pricing loop of ask_at, walking delta from start to stop - 1
+    """
+    price = 0.0
+    for delta in xrange(start, stop):
+        if type_name == 'linear':
+            price += max(0.0, initial + delta * rate)
+        else:
+            price += initial * (rate ** delta)
+    return price
+
+def loop_first_nonnegative(initial, rate, low=-10000, high=10000):
+    for delta in xrange(low, high):
+        if initial + delta * rate >= 0.0:
+            return delta
+
+def loop_last_nonnegative(initial, rate, low=-10000, high=10000):
+    for delta in xrange(high, low, -1):
+        if initial + delta * rate >= 0.0:
+            return delta
+
+def assert_close(actual, expected):
+    """
+    Compare a geometric series with the loop, which rounds every term
+    """
+    assert actual == pytest.approx(expected, rel=1e-9, abs=1e-9)
+
+LINEAR_CASES = [
+    # Clamp boundary: the price crosses zero inside the range
+    (-5.0, 1.0, 0, 10),
+    (-5.0, 1.0, 5, 6),
+    (-5.0, 1.0, 4, 6),
+    (5.0, -1.0, 0, 10),
+    (5.0, -1.0, 5, 6),
+    (5.0, -1.0, 6, 7),
+    (-4.5, 0.5, 0, 20),
+    (0.375, -0.125, 0, 10),
+    # Entirely clamped or entirely unclamped ranges
+    (-100.0, 1.0, 0, 10),
+    (100.0, -1.0, 200, 210),
+    (10.0, 2.0, 0, 50),
+    # Zero rate
+    (3.0, 0.0, -5, 5),
+    (-3.0, 0.0, -5, 5),
+    (0.0, 0.0, 0, 3),
+    # Negative and zero deltas
+    (10.0, 1.0, -20, 0),
+    (10.0, 1.0, -3, 3),
+    (10.0, -1.0, -20, -10),
+    (0.0, 1.0, 0, 1),
+    # Empty ranges
+    (10.0, 1.0, 7, 7),
+    (10.0, 1.0, 7, 3),
+]
+
+EXPONENTIAL_EXACT_CASES = [
+    # Rate of exactly 1.0
+    (2.0, 1.0, 0, 10),
+    (2.0, 1.0, -10, 10),
+    (2.0, 1.0, 5, 6),
+    # Single units
+    (1.0, 1.01, 0, 1),
+    (3.0, 0.99, -7, -6),
+    # Empty ranges
+    (2.0, 1.5, 4, 4),
+    (2.0, 1.5, 4, 2),
+]
+
+GEOMETRIC_CASES = [
+    # Growing and shrinking prices over negative and zero deltas
+    (1.0, 1.01, -50, 50),
+    (3.0, 0.99, -20, 0),
+    (3.0, 0.5, -5, 5),
+    (0.001, 1.001, 1000, 1100),
+]
+
+@pytest.mark.parametrize('initial,rate,start,stop', LINEAR_CASES)
+def test_linear_series_matches_loop(initial, rate, start, stop):
+    assert (series_price('linear', initial, rate, start, stop) ==
+            loop_price('linear', initial, rate, start, stop))
+
+@pytest.mark.parametrize('initial,rate,start,stop', EXPONENTIAL_EXACT_CASES)
+def test_exponential_exact_cases_match_loop(initial, rate, start, stop):
+    assert (series_price('exponential', initial, rate, start, stop) ==
+            loop_price('exponential', initial, rate, start, stop))
+
+@pytest.mark.parametrize('initial,rate,start,stop', GEOMETRIC_CASES)
+def test_geometric_series_matches_loop(initial, rate, start, stop):
+    assert_close(series_price('exponential', initial, rate, start, stop),
+                 loop_price('exponential', initial, rate, start, stop))
+
+@pytest.mark.parametrize('initial,rate,start,stop', [
+    # rate ** count overflows, although no term of the series does
+    (1.0, 1.5, -1500, 500),
+    (3.0, 1.2, -4000, 3000),
+    (1.0, 1.01, -75000, 1000),
+])
+def test_long_geometric_series_match_loop(initial, rate, start, stop):
+    assert_close(series_price('exponential', initial, rate, start, stop),
+                 loop_price('exponential', initial, rate, start, stop))
+
+@pytest.mark.parametrize('initial,rate,start,stop', [
+    # Terms that overflow make the price infinite
+    (1.0, 1.01, 0, 200000),
+    (1.0, 0.5, -5000, 0),
+    (-1.0, 1.5, 0, 10 ** 9),
+])
+def test_overflowing_geometric_series_is_infinite(initial, rate, start, stop):
+    price = series_price('exponential', initial, rate, start, stop)
+    assert price == initial * float('inf')
+
+@pytest.mark.parametrize('type_name', ['linear', 'exponential'])
+def test_empty_range_is_free(type_name):
+    assert series_price(type_name, 5.0, 1.5, 3, 3) == 0.0
+
+@pytest.mark.parametrize('initial,rate', [
+    (-5.0, 1.0), (5.0, 1.0), (0.0, 1.0), (-4.5, 0.5), (-0.3, 0.1),
+    (-1e-9, 1e-3), (7.0, 3.0), (-7.0, 3.0)])
+def test_first_nonnegative_matches_loop(initial, rate):
+    assert (_first_nonnegative(initial, rate) ==
+            loop_first_nonnegative(initial, rate))
+
+@pytest.mark.parametrize('initial,rate', [
+    (5.0, -1.0), (-5.0, -1.0), (0.0, -1.0), (4.5, -0.5), (0.3, -0.1),
+    (1e-9, -1e-3), (7.0, -3.0), (-7.0, -3.0)])
+def test_last_nonnegative_matches_loop(initial, rate):
+    assert (_last_nonnegative(initial, rate) ==
+            loop_last_nonnegative(initial, rate))
+
+def test_random_linear_ranges_match_loop():
+    rng = random.Random(0)
+    for _ in xrange(2000):
+        # Quarters keep every partial sum of the loop exact
+        initial = rng.randint(-200, 200) * 0.25
+        rate = rng.randint(-12, 12) * 0.25
+        start = rng.randint(-100, 100)
+        stop = start + rng.randint(0, 60)
+        assert (series_price('linear', initial, rate, start, stop) ==
+                loop_price('linear', initial, rate, start, stop))
+
+def test_random_single_units_match_loop():
+    rng = random.Random(0)
+    for _ in xrange(2000):
+        type_name = rng.choice(['linear', 'exponential'])
+        if type_name == 'linear':
+            initial = rng.uniform(-50.0, 50.0)
+            rate = rng.uniform(-3.0, 3.0)
+        else:
+            initial = rng.uniform(0.01, 10.0)
+            rate = rng.uniform(0.9, 1.1)
+        start = rng.randint(-100, 100)
+        assert (series_price(type_name, initial, rate, start, start + 1) ==
+                loop_price(type_name, initial, rate, start, start + 1))
+
+def test_random_geometric_ranges_match_loop():
+    rng = random.Random(0)
+    for _ in xrange(2000):
+        initial = rng.uniform(0.01, 10.0)
+        rate = rng.choice([1.0, rng.uniform(0.9, 1.1)])
+        start = rng.randint(-100, 100)
+        stop = start + rng.randint(0, 60)
+        assert_close(series_price('exponential', initial, rate, start, stop),
+                     loop_price('exponential', initial, rate, start, stop))
+
+def test_ask_and_bid_walk_in_opposite_directions():
+    market = dict(food=dict(type='linear', initial=-2.0, rate=1.0, delta=3,
+                            bought=0, sold=0))
+    assert (ask_at(market, 'food', qty=4) ==
+            loop_price('linear', -2.0, 1.0, 3, 7))
+    assert (bid_at(market, 'food', qty=6) ==
+            loop_price('linear', -2.0, 1.0, -3, 3))
@@ -0,0 +1,30 @@
+"""
+Exact-equivalence tests of the compiled op tables against quote_op, for ops
+that trade several resources
+"""
+import random
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from econo.generate import generate_description
+from econo.market import quote_op
+from econo.unit import parse_careers
+
+@pytest.mark.parametrize('seed', range(5))
+def test_table_quotes_match_quote_op(seed):
+    description = generate_description(units=0, careers=3, ops=6,
+                                       resources=8, cost_fanout=4,
+                                       product_fanout=4, seed=seed)
+    market = description['market']
+    careers = parse_careers(description['careers'], market, compiled=True)
+    rng = random.Random(seed)
+    for _ in xrange(20):
+        for rec in market.itervalues():
+            rec['delta'] = rng.randint(-300, 300)
+        for career_rec in careers.itervalues():
+            table = career_rec['table']
+            costs, earnings = table.quote(market)
+            for i, op in enumerate(table.ops):
+                assert (costs[i], earnings[i]) == quote_op(market, op)
@@ -0,0 +1,92 @@
+"""
+Equivalence tests of the inter-region exchange against the unit by unit loop
+it replaced: the same units must move between the same regions, leaving every
+market with the same delta and bought and sold counts
+"""
+import copy
+import random
+from collections import defaultdict
+
+import pytest
+
+from econo.market import ask_at, bid_at, buy, sell
+from econo.region import exchange
+
+def loop_exchange(markets, max_trade=10000):
+    """
+    The unit by unit exchange loop, moving one unit at a time from the
+    cheapest market to the dearest
+    """
+    trades = [defaultdict(lambda: [0, 0]) for market in markets]
+    shared = set(markets[0])
+    for market in markets[1:]:
+        shared.intersection_update(market)
+    for resource in sorted(shared):
+        moved = 0
+        while moved < max_trade:
+            ask, source = min((ask_at(market, resource), i)
+                              for i, market in enumerate(markets))
+            bid, dest = max((bid_at(market, resource), -i)
+                            for i, market in enumerate(markets))
+            dest = -dest
+            if source == dest or bid <= ask:
+                break
+            buy(markets[source], resource)
+            sell(markets[dest], resource)
+            trades[source][resource][0] += 1
+            trades[dest][resource][1] += 1
+            moved += 1
+    return trades
+
+def make_market(type_name, initial, rate, delta):
+    return dict(food=dict(type=type_name, initial=initial, rate=rate,
+                          delta=delta, bought=0, sold=0))
+
+def assert_same_exchange(markets, max_trade=10000):
+    expected = copy.deepcopy(markets)
+    expected_trades = loop_exchange(expected, max_trade)
+    trades = exchange(markets, max_trade)
+    assert markets == expected
+    assert [dict(t) for t in trades] == [dict(t) for t in expected_trades]
+
+@pytest.mark.parametrize('deltas', [
+    # Two regions trade until their prices meet
+    (-300, 300),
+    (300, -300),
+    # Equal prices tie and nothing moves
+    (0, 0, 0),
+    # Every region joins the trade as the prices converge
+    (-300, 0, 300),
+    (-200, -200, 200, 200),
+    (100, -400, 50, -30, 250),
+])
+def test_exponential_prices_match_loop(deltas):
+    assert_same_exchange([make_market('exponential', 10.0, 1.01, delta)
+                          for delta in deltas])
+
+@pytest.mark.parametrize('max_trade', [0, 1, 5, 100])
+def test_max_trade_matches_loop(max_trade):
+    assert_same_exchange([make_market('linear', 1.0, 0.5, delta)
+                          for delta in (-100, 40, 100)], max_trade)
+
+@pytest.mark.parametrize('initial,rate', [
+    # Prices that do not grow with delta, or fall below zero
+    (5.0, 0.0), (5.0, -0.5), (-20.0, 1.0)])
+def test_flat_and_falling_linear_prices_match_loop(initial, rate):
+    assert_same_exchange([make_market('linear', initial, rate, delta)
+                          for delta in (-50, 0, 50)])
+
+def test_random_markets_match_loop():
+    rng = random.Random(0)
+    for _ in xrange(500):
+        type_name = rng.choice(['linear', 'exponential'])
+        if type_name == 'linear':
+            initial = rng.choice([0.0, -5.0, rng.uniform(0.0, 20.0)])
+            rate = rng.choice([0.0, 0.5, rng.uniform(-1.0, 3.0)])
+        else:
+            initial = rng.choice([1.0, rng.uniform(0.1, 20.0)])
+            rate = rng.choice([1.0, 1.01, rng.uniform(0.9, 1.3)])
+        markets = [make_market(type_name, initial * rng.choice([1.0, 2.0]),
+                               rate, rng.randint(-300, 300))
+                   for _ in xrange(rng.randint(2, 5))]
+        assert_same_exchange(markets, rng.choice([0, 1, 5, 100, 1000]))